@@ -0,0 +1,69 @@
+"""
+Runs the benchmark scenarios
+
+    python -m benchmarks [scenario ...] [--save NAME] [--compare NAME] [--threshold 0.1]
+"""
+
+import sys
+import asyncio
+import argparse
+from typing import Dict as D, List as L, Any as A
+from benchmarks.harness import save_baseline, load_baseline, compare
+from benchmarks.scenarios import SCENARIOS, run
+
+def _report(results:L[D[str,A]]) -> None:
+    print(f"{'scenario':<10} {'requests':>8} {'errors':>6} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9} {'rss MiB':>8}  extra")
+    for result in results:
+        extra = {k: v for k, v in result.items() if k not in (
+            "name", "requests", "concurrency", "errors", "first_error", "p50", "p99", "rps", "peak_rss_mb"
+        )}
+        print(
+            f"{result['name']:<10} {result['requests']:>8} {result['errors']:>6} {result['p50'] * 1000:>9.2f} "
+            f"{result['p99'] * 1000:>9.2f} {result['rps']:>9.1f} {result['peak_rss_mb']:>8.1f}  "
+            + " ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in extra.items())
+        )
+        if result["first_error"]:
+            print(f"{'':<10} first error: {result['first_error']}")
+
+def main() -> int:
+    """
+    Command line entry point, exits with 1 when a scenario failed or a compared metric regressed
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline benchmarks against local stand-ins")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=f"one of {', '.join(SCENARIOS)}, all by default")
+    parser.add_argument("--requests", type=int, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, help="concurrent clients per scenario")
+    parser.add_argument("--latency", type=float, default=0.005, help="stand-in response delay in seconds")
+    parser.add_argument("--interval", type=float, default=0.01, help="delay between streamed messages in seconds")
+    parser.add_argument("--save", metavar="NAME", help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare the results with a baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    options = {"requests": args.requests, "concurrency": args.concurrency, "latency": args.latency, "interval": args.interval}
+    results:L[D[str,A]] = []
+    failed:D[str,str] = {}
+    for name in args.scenarios or list(SCENARIOS):
+        try:
+            results.extend(asyncio.run(run(name, options)))
+        except Exception as exc: # pylint: disable=broad-except
+            failed[name] = f"{type(exc).__name__}: {exc}"
+    _report(results)
+    for name, error in failed.items():
+        print(f"{name:<10} failed: {error}")
+    if args.save:
+        print(f"\nBaseline saved to {save_baseline(args.save, results)}")
+    if args.compare:
+        changes = compare(results, load_baseline(args.compare), args.threshold)
+        print(f"\nCompared with {args.compare}, regressions beyond {args.threshold:.0%} marked with !")
+        for change in changes:
+            mark = "!" if change["regression"] else " "
+            print(f"{mark} {change['name']:<10} {change['metric']:<12} {change['before']:>10.4f} -> {change['after']:>10.4f} ({change['change']:+.1%})")
+        if any(change["regression"] for change in changes):
+            return 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""
+Fauna stand-in
+
+aiofauna posts every query to a fixed `https://db.fauna.com`, so instead of a
+server this module evaluates the serialized query in process, covering the
+functions the models use: documents, collections, indexes with terms and
+values, pagination with cursors and `Map`/`Lambda` over pages.
+"""
+
+import json
+import time
+import asyncio
+import itertools
+from typing import Optional as O, Dict as D, List as L, Tuple as T, Any as A
+from aiofauna.client import AsyncFaunaClient, to_json
+from aiofauna.errors import AioFaunaException
+
+class Ref:
+    """
+    Document, collection or index reference
+    """
+    def __init__(self, id_:str, collection:O[str]=None):
+        self.id = id_
+        self.collection = collection
+
+    def __eq__(self, other:A) -> bool:
+        return isinstance(other, Ref) and (self.id, self.collection) == (other.id, other.collection)
+
+    def __hash__(self) -> int:
+        return hash((self.id, self.collection))
+
+    def wire(self) -> D[str,A]:
+        """Ref in the wire format of query results"""
+        kind = "collections" if self.collection not in ("collections", "indexes") else None
+        parent = {"@ref": {"id": self.collection, "collection": {"@ref": {"id": kind}}}} if kind else {"@ref": {"id": self.collection}}
+        return {"@ref": {"id": self.id, "collection": parent}}
+
+def _wire(value:A) -> A:
+    if isinstance(value, Ref):
+        return value.wire()
+    if isinstance(value, dict):
+        return {k: _wire(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_wire(v) for v in value]
+    return value
+
+def _sort_key(value:A, reverse:bool) -> A:
+    if isinstance(value, Ref):
+        value = int(value.id) if value.id.isdigit() else value.id
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, -value if reverse else value)
+    return (1, str(value))
+
+class FaunaStandIn:
+    """
+
+    In-memory database evaluating aiofauna queries
+
+    """
+    def __init__(self, latency:float=0.0):
+        self.latency = latency
+        self.collections:D[str,D[str,D[str,A]]] = {}
+        self.indexes:D[str,D[str,A]] = {}
+        self.queries = 0
+        self._ids = itertools.count(10 ** 17)
+        self._original:A = None
+
+    def install(self) -> None:
+        """
+        Routes every `AsyncFaunaClient.query` call to this database
+        """
+        stand_in = self
+        self._original = AsyncFaunaClient.query
+
+        async def query(_client:AsyncFaunaClient, expr:A) -> A:
+            return await stand_in.query(expr)
+
+        AsyncFaunaClient.query = query # type: ignore
+
+    def uninstall(self) -> None:
+        """
+        Restores the real client
+        """
+        if self._original is not None:
+            AsyncFaunaClient.query = self._original # type: ignore
+            self._original = None
+
+    async def query(self, expr:A) -> A:
+        """
+        Evaluates a query, serialized and parsed as the real client would
+        """
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self.eval(json.loads(to_json(expr)), {})
+        return json.loads(json.dumps(_wire(result)))
+
+    def _document(self, ref:Ref) -> D[str,A]:
+        document = self.collections.get(ref.collection or "", {}).get(ref.id)
+        if document is None:
+            raise AioFaunaException(f"instance not found: {ref.collection}/{ref.id}")
+        return document
+
+    def _entries(self, index:D[str,A], terms:L[A]) -> L[A]:
+        documents = self.collections.get(index["source"], {}).values()
+        matched = [d for d in documents if [self._field(d, f) for f in index["terms"]] == terms]
+        if not index["values"]:
+            return sorted((d["ref"] for d in matched), key=lambda ref: _sort_key(ref, False))
+        rows = [[self._field(d, v["field"]) for v in index["values"]] for d in matched]
+        reverse = [bool(v.get("reverse")) for v in index["values"]]
+        return sorted(rows, key=lambda row: [_sort_key(value, rev) for value, rev in zip(row, reverse)])
+
+    @staticmethod
+    def _field(document:D[str,A], path:L[str]) -> A:
+        value:A = document
+        for name in path:
+            value = value.get(name) if isinstance(value, dict) else None
+        return value
+
+    def _paginate(self, set_:T[str,L[A]], size:int, after:O[L[A]]) -> D[str,A]:
+        name, terms = set_
+        index = self.indexes[name]
+        entries = self._entries(index, terms)
+        start = 0
+        if after is not None:
+            reverse = [bool(v.get("reverse")) for v in index["values"]] or [False]
+            position = [_sort_key(value, rev) for value, rev in zip(after if isinstance(after, list) else [after], reverse)]
+            keyed = [[_sort_key(value, rev) for value, rev in zip(e if isinstance(e, list) else [e], reverse)] for e in entries]
+            start = next((i for i, key in enumerate(keyed) if key >= position), len(entries))
+        page:D[str,A] = {"data": entries[start:start + size]}
+        if start + size < len(entries):
+            following = entries[start + size]
+            page["after"] = following if isinstance(following, list) else [following]
+        return page
+
+    def eval(self, expr:A, scope:D[str,A]) -> A: # pylint: disable=too-many-return-statements, too-many-branches
+        """
+        Value of a wire format expression
+        """
+        if isinstance(expr, list):
+            return [self.eval(item, scope) for item in expr]
+        if not isinstance(expr, dict):
+            return expr
+        if "object" in expr:
+            return {k: self.eval(v, scope) for k, v in expr["object"].items()}
+        if "var" in expr:
+            return scope[expr["var"]]
+        if "collection" in expr and len(expr) == 1:
+            return Ref(self.eval(expr["collection"], scope), "collections")
+        if "index" in expr and len(expr) == 1:
+            return Ref(self.eval(expr["index"], scope), "indexes")
+        if "ref" in expr and "id" in expr:
+            return Ref(str(self.eval(expr["id"], scope)), self.eval(expr["ref"], scope).id)
+        if "exists" in expr:
+            ref = self.eval(expr["exists"], scope)
+            if ref.collection == "collections":
+                return ref.id in self.collections
+            if ref.collection == "indexes":
+                return ref.id in self.indexes
+            return ref.id in self.collections.get(ref.collection, {})
+        if "create_collection" in expr:
+            name = self.eval(expr["create_collection"], scope)["name"]
+            self.collections.setdefault(name, {})
+            return {"ref": Ref(name, "collections"), "name": name}
+        if "create_index" in expr:
+            params = self.eval(expr["create_index"], scope)
+            self.indexes[params["name"]] = {
+                "source": params["source"].id,
+                "terms": [term["field"] for term in params.get("terms") or []],
+                "values": params.get("values") or []
+            }
+            return {"ref": Ref(params["name"], "indexes"), "name": params["name"]}
+        if "create" in expr:
+            collection = self.eval(expr["create"], scope).id
+            data = self.eval(expr["params"], scope).get("data", {})
+            ref = Ref(str(next(self._ids)), collection)
+            document = {"ref": ref, "ts": int(time.time() * 1e6), "data": data}
+            self.collections.setdefault(collection, {})[ref.id] = document
+            return document
+        if "update" in expr:
+            document = self._document(self.eval(expr["update"], scope))
+            document["data"] = {**document["data"], **self.eval(expr["params"], scope).get("data", {})}
+            document["ts"] = int(time.time() * 1e6)
+            return document
+        if "delete" in expr:
+            ref = self.eval(expr["delete"], scope)
+            document = self._document(ref)
+            del self.collections[ref.collection][ref.id]
+            return document
+        if "match" in expr:
+            terms = self.eval(expr.get("terms", []), scope)
+            return (self.eval(expr["match"], scope).id, terms if isinstance(terms, list) else [terms])
+        if "get" in expr:
+            target = self.eval(expr["get"], scope)
+            if isinstance(target, tuple):
+                entries = self._entries(self.indexes[target[0]], target[1])
+                if not entries:
+                    raise AioFaunaException("set not found")
+                target = entries[0]
+            return self._document(target)
+        if "select" in expr:
+            value = self.eval(expr["from"], scope)
+            for step in self.eval(expr["select"], scope) if isinstance(expr["select"], list) else [expr["select"]]:
+                value = value[step]
+            return value
+        if "paginate" in expr:
+            after = self.eval(expr["after"], scope) if "after" in expr else None
+            return self._paginate(self.eval(expr["paginate"], scope), expr.get("size", 64), after)
+        if "map" in expr:
+            page = self.eval(expr["collection"], scope)
+            func = expr["map"]
+            mapped = [self.eval(func["expr"], {**scope, func["lambda"]: item}) for item in page["data"]]
+            return {**page, "data": mapped}
+        raise AioFaunaException(f"unsupported expression: {list(expr)}")
@@ -0,0 +1,263 @@
+"""
+Benchmark harness
+
+Starts the stand-ins, runs the application in a child process configured
+against them and measures request latency, throughput and the peak resident
+memory of the application process.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import tempfile
+import subprocess
+from typing import Optional as O, Dict as D, List as L, Any as A, Callable as C, Awaitable as W
+from aiohttp import ClientSession, ClientTimeout
+from benchmarks.stubs import Latency, DockerStub, GitHubStub, CloudflareStub, Auth0Stub
+from benchmarks.s3 import S3Stub
+from benchmarks.redis_server import InProcessRedis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, "benchmarks", "baselines")
+AUTH0_DOMAIN = "auth0.bench.test"
+REDIS_PASSWORD = "bench"
+
+# Lower is better for every metric but throughput
+METRICS = {"p50": "lower", "p99": "lower", "rps": "higher", "peak_rss_mb": "lower"}
+
+class Stack:
+    """
+
+    Every upstream stand-in, started on free local ports
+
+    """
+    def __init__(self, latency:float=0.005, interval:float=0.01, docker_hosts:int=1):
+        self.redis = InProcessRedis(REDIS_PASSWORD)
+        self.docker = [DockerStub(Latency(latency, interval)) for _ in range(docker_hosts)]
+        self.github = GitHubStub(Latency(latency))
+        self.cloudflare = CloudflareStub(Latency(latency))
+        self.auth0 = Auth0Stub(AUTH0_DOMAIN, Latency(latency))
+        self.s3 = S3Stub(Latency(latency))
+        self.latency = latency
+        self.directory = tempfile.TemporaryDirectory(prefix="kubectl-bench-")
+
+    @property
+    def stubs(self) -> L[A]:
+        """Every aiohttp stub"""
+        return [*self.docker, self.github, self.cloudflare, self.auth0, self.s3]
+
+    async def start(self) -> None:
+        """
+        Starts every stand-in
+        """
+        await self.redis.start()
+        await asyncio.gather(*[stub.start() for stub in self.stubs])
+
+    async def stop(self) -> None:
+        """
+        Stops every stand-in
+        """
+        await asyncio.gather(*[stub.stop() for stub in self.stubs])
+        await self.redis.stop()
+        self.directory.cleanup()
+
+    def environ(self, **overrides:str) -> D[str,str]:
+        """
+        Application settings pointing at the stand-ins
+        """
+        nginx = os.path.join(self.directory.name, "nginx")
+        os.makedirs(nginx, exist_ok=True)
+        environ = {
+            **os.environ,
+            "FAUNA_SECRET": "bench",
+            "API_KEY": "bench",
+            "GITHUB_TOKEN": "bench",
+            "AUTH0_DOMAIN": AUTH0_DOMAIN,
+            "REDIS_HOST": "127.0.0.1",
+            "REDIS_PORT": str(self.redis.port),
+            "REDIS_USER": "default",
+            "REDIS_PASSWORD": REDIS_PASSWORD,
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+            "AWS_S3_BUCKET": "bench",
+            "AWS_S3_ENDPOINT": self.s3.url,
+            "CF_API_KEY": "bench",
+            "CF_EMAIL": "bench@bench.test",
+            "CF_ZONE_ID": "bench",
+            "CF_ACCOUNT_ID": "bench",
+            "IP_ADDR": "127.0.0.1",
+            "DOCKER_HOSTS": ",".join(stub.url for stub in self.docker),
+            "DOCKER_SOCKET": "",
+            "NGINX_BIN": "true",
+            "NGINX_CONF_DIRS": nginx,
+            "TEMPLATES_DIR": os.path.join(ROOT, "templates"),
+            "CONTENT_CACHE_DIR": os.path.join(self.directory.name, "content"),
+            "SSH_KEY_POOL_SIZE": "0",
+            "BENCH_GITHUB_URL": self.github.url,
+            "BENCH_CLOUDFLARE_URL": self.cloudflare.url,
+            "BENCH_AUTH0_URL": self.auth0.url,
+            "BENCH_FAUNA_LATENCY": str(self.latency),
+            "PYTHONPATH": ROOT,
+        }
+        environ.update(overrides)
+        return environ
+
+def free_port() -> int:
+    """Port nothing listens on right now"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class Server:
+    """
+
+    The application running in a child process
+
+    """
+    def __init__(self, environ:D[str,str]):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.environ = {**environ, "BENCH_PORT": str(self.port)}
+        self.log = tempfile.TemporaryFile()
+        self.process:O[subprocess.Popen] = None
+
+    async def start(self, timeout:float=60.0) -> None:
+        """
+        Starts the application and waits until it answers
+        """
+        self.process = subprocess.Popen( # pylint: disable=consider-using-with
+            [sys.executable, "-m", "benchmarks.server"], cwd=ROOT, env=self.environ, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        deadline = time.monotonic() + timeout
+        async with ClientSession(timeout=ClientTimeout(total=2)) as session:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Application exited with {self.process.returncode}:\n{self.output()}")
+                try:
+                    async with session.get(f"{self.url}/") as response:
+                        if response.status == 200:
+                            return
+                except (OSError, asyncio.TimeoutError):
+                    pass
+                await asyncio.sleep(0.1)
+        raise RuntimeError(f"Application did not start within {timeout}s:\n{self.output()}")
+
+    def output(self, lines:int=40) -> str:
+        """Last lines written by the application"""
+        self.log.seek(0)
+        return "\n".join(self.log.read().decode("utf-8", "replace").splitlines()[-lines:])
+
+    def peak_rss(self) -> float:
+        """Peak resident memory of the application in MiB"""
+        try:
+            with open(f"/proc/{self.process.pid}/status", encoding="utf-8") as status: # type: ignore
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return 0.0
+
+    async def stop(self) -> None:
+        """
+        Stops the application, running its shutdown hooks
+        """
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.process.wait, 30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+def _percentile(values:L[float], percent:float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+async def measure(
+    name:str,
+    request:C[[int],W[A]],
+    count:int,
+    concurrency:int,
+    server:Server,
+    **extra:A
+) -> D[str,A]:
+    """
+    Calls `request(i)` `count` times, `concurrency` at a time, and summarizes the
+    latencies, the failures and the throughput of the whole run
+    """
+    latencies:L[float] = []
+    errors:L[str] = []
+    indexes = iter(range(count))
+
+    async def worker() -> None:
+        for index in indexes:
+            started = time.perf_counter()
+            try:
+                await request(index)
+            except Exception as exc: # pylint: disable=broad-except
+                errors.append(f"{type(exc).__name__}: {exc}")
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "name": name,
+        "requests": count,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50": _percentile(latencies, 50),
+        "p99": _percentile(latencies, 99),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": server.peak_rss(),
+        **extra
+    }
+
+def baseline_path(name:str) -> str:
+    """File of a named baseline"""
+    return name if name.endswith(".json") else os.path.join(BASELINES, f"{name}.json")
+
+def save_baseline(name:str, results:L[D[str,A]]) -> str:
+    """
+    Stores the results as a named baseline, returns its path
+    """
+    path = baseline_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file_:
+        json.dump({"created": time.time(), "python": sys.version.split()[0], "results": results}, file_, indent=2)
+    return path
+
+def load_baseline(name:str) -> D[str,D[str,A]]:
+    """
+    Results of a named baseline by scenario
+    """
+    with open(baseline_path(name), encoding="utf-8") as file_:
+        return {result["name"]: result for result in json.load(file_)["results"]}
+
+def compare(results:L[D[str,A]], baseline:D[str,D[str,A]], threshold:float) -> L[D[str,A]]:
+    """
+    Relative change of every metric against the baseline, flagged as a regression
+    when it got worse by more than `threshold`
+    """
+    changes = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+        for metric, better in METRICS.items():
+            before, after = previous.get(metric) or 0.0, result.get(metric) or 0.0
+            if not before:
+                continue
+            change = (after - before) / before
+            worse = change > threshold if better == "lower" else change < -threshold
+            changes.append({"name": result["name"], "metric": metric, "before": before, "after": after, "change": change, "regression": worse})
+    return changes
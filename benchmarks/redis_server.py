@@ -0,0 +1,288 @@
+"""
+In-process Redis stand-in
+
+A RESP2 server on the running event loop implementing the commands the
+services use: strings, hashes, lists with BRPOP, bitmaps, pub/sub, SCAN and
+the port allocator scripts, which are run natively instead of through Lua.
+"""
+
+import time
+import asyncio
+import fnmatch
+import hashlib
+from collections import defaultdict
+from typing import Optional as O, Dict as D, List as L, Set as S, Any as A, Callable as C
+
+class RedisError(Exception):
+    """
+    Error reply sent back to the client
+    """
+
+def _encode(value:A) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, RedisError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+    if isinstance(value, str):
+        if value == "OK":
+            return b"+OK\r\n"
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+class InProcessRedis:
+    """
+
+    Minimal Redis server for the benchmarks, listening on a local port
+
+    """
+    def __init__(self, password:O[str]=None):
+        self.password = password
+        self.data:D[bytes,A] = {}
+        self.expires:D[bytes,float] = {}
+        self.scripts:D[str,bytes] = {}
+        self.channels:D[bytes,S[asyncio.StreamWriter]] = defaultdict(set)
+        self.pushed:O[asyncio.Condition] = None
+        self.server:O[asyncio.AbstractServer] = None
+        self.connections:S[asyncio.Task] = set()
+        self.port = 0
+        self.commands = 0
+
+    async def start(self, port:int=0) -> int:
+        """
+        Starts listening, returns the port
+        """
+        self.pushed = asyncio.Condition()
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self) -> None:
+        """
+        Stops listening and ends the open connections, blocked BRPOP calls included
+        """
+        if self.server is not None:
+            self.server.close()
+            for task in self.connections:
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+
+    def _get(self, key:bytes, default:A=None) -> A:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline < time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key, default)
+
+    @staticmethod
+    async def _read(reader:asyncio.StreamReader) -> O[L[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    async def _serve(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        subscribed:S[bytes] = set()
+        task = asyncio.current_task()
+        self.connections.add(task) # type: ignore
+        try:
+            while True:
+                args = await self._read(reader)
+                if args is None:
+                    break
+                self.commands += 1
+                name = args[0].decode().upper()
+                if name in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                    for channel in args[1:]:
+                        if name == "SUBSCRIBE":
+                            subscribed.add(channel)
+                            self.channels[channel].add(writer)
+                        else:
+                            subscribed.discard(channel)
+                            self.channels[channel].discard(writer)
+                        writer.write(_encode([name.lower(), channel, len(subscribed)]))
+                    continue
+                try:
+                    handler:C = getattr(self, f"cmd_{name.lower()}")
+                    reply = await handler(*args[1:])
+                except AttributeError:
+                    reply = RedisError(f"ERR unknown command '{name}'")
+                except RedisError as exc:
+                    reply = exc
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task) # type: ignore
+            for channel in subscribed:
+                self.channels[channel].discard(writer)
+            writer.close()
+
+    # Connection
+
+    async def cmd_auth(self, *args:bytes) -> str:
+        if self.password is not None and args[-1].decode() != self.password:
+            raise RedisError("WRONGPASS invalid password")
+        return "OK"
+
+    async def cmd_ping(self, *_:bytes) -> str:
+        return "PONG"
+
+    async def cmd_select(self, *_:bytes) -> str:
+        return "OK"
+
+    async def cmd_client(self, *_:bytes) -> str:
+        return "OK"
+
+    # Keys
+
+    async def cmd_get(self, key:bytes) -> A:
+        return self._get(key)
+
+    async def cmd_set(self, key:bytes, value:bytes, *options:bytes) -> str:
+        self.data[key] = value
+        self.expires.pop(key, None)
+        flags = [option.upper() for option in options]
+        if b"EX" in flags:
+            self.expires[key] = time.monotonic() + int(options[flags.index(b"EX") + 1])
+        return "OK"
+
+    async def cmd_del(self, *keys:bytes) -> int:
+        deleted = 0
+        for key in keys:
+            self.expires.pop(key, None)
+            if self.data.pop(key, None) is not None:
+                deleted += 1
+        return deleted
+
+    async def cmd_expire(self, key:bytes, seconds:bytes) -> int:
+        if self._get(key) is None:
+            return 0
+        self.expires[key] = time.monotonic() + int(seconds)
+        return 1
+
+    async def cmd_scan(self, _cursor:bytes, *options:bytes) -> L[A]:
+        flags = [option.upper() for option in options]
+        pattern = options[flags.index(b"MATCH") + 1].decode() if b"MATCH" in flags else "*"
+        keys = [key for key in list(self.data) if self._get(key) is not None and fnmatch.fnmatchcase(key.decode(), pattern)]
+        return [b"0", keys]
+
+    # Hashes
+
+    async def cmd_hset(self, key:bytes, *pairs:bytes) -> int:
+        table = self.data.setdefault(key, {})
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in table
+            table[field] = value
+        return added
+
+    async def cmd_hget(self, key:bytes, field:bytes) -> A:
+        return self._get(key, {}).get(field)
+
+    async def cmd_hdel(self, key:bytes, *fields:bytes) -> int:
+        table = self._get(key, {})
+        return sum(table.pop(field, None) is not None for field in fields)
+
+    async def cmd_hgetall(self, key:bytes) -> L[bytes]:
+        return [item for pair in self._get(key, {}).items() for item in pair]
+
+    # Lists
+
+    async def cmd_lpush(self, key:bytes, *values:bytes) -> int:
+        items = self.data.setdefault(key, [])
+        for value in values:
+            items.insert(0, value)
+        async with self.pushed:
+            self.pushed.notify_all()
+        return len(items)
+
+    async def cmd_brpop(self, *args:bytes) -> A:
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.monotonic() + timeout if timeout else None
+        async with self.pushed:
+            while True:
+                for key in keys:
+                    items = self._get(key)
+                    if items:
+                        return [key, items.pop()]
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.pushed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+
+    # Bitmaps
+
+    async def cmd_setbit(self, key:bytes, offset:bytes, value:bytes) -> int:
+        bits = self.data.setdefault(key, bytearray())
+        index, bit = divmod(int(offset), 8)
+        if len(bits) <= index:
+            bits.extend(b"\0" * (index + 1 - len(bits)))
+        mask = 0x80 >> bit
+        previous = int(bool(bits[index] & mask))
+        bits[index] = bits[index] | mask if value == b"1" else bits[index] & ~mask
+        return previous
+
+    async def cmd_bitpos(self, key:bytes, bit:bytes) -> int:
+        bits = self._get(key, bytearray())
+        wanted = int(bit)
+        for index, byte in enumerate(bits):
+            for offset in range(8):
+                if bool(byte & (0x80 >> offset)) == bool(wanted):
+                    return index * 8 + offset
+        return len(bits) * 8 if wanted == 0 else -1
+
+    # Pub/Sub
+
+    async def cmd_publish(self, channel:bytes, message:bytes) -> int:
+        writers = list(self.channels.get(channel, ()))
+        for writer in writers:
+            writer.write(_encode([b"message", channel, message]))
+        return len(writers)
+
+    # Scripts, the known ones are run natively
+
+    async def cmd_script(self, subcommand:bytes, *args:bytes) -> A:
+        if subcommand.upper() != b"LOAD":
+            return "OK"
+        sha = hashlib.sha1(args[0]).hexdigest()
+        self.scripts[sha] = args[0]
+        return sha
+
+    async def cmd_evalsha(self, sha:bytes, numkeys:bytes, *args:bytes) -> A:
+        script = self.scripts.get(sha.decode())
+        if script is None:
+            raise RedisError("NOSCRIPT No matching script")
+        return await self._run(script, list(args[:int(numkeys)]), list(args[int(numkeys):]))
+
+    async def cmd_eval(self, script:bytes, numkeys:bytes, *args:bytes) -> A:
+        return await self._run(script, list(args[:int(numkeys)]), list(args[int(numkeys):]))
+
+    async def _run(self, script:bytes, keys:L[bytes], args:L[bytes]) -> A:
+        if b"BITPOS" in script:
+            position = await self.cmd_bitpos(keys[0], b"0")
+            if position < 0 or position >= int(args[0]):
+                return -1
+            await self.cmd_setbit(keys[0], str(position).encode(), b"1")
+            await self.cmd_hset(keys[1], str(position).encode(), args[1])
+            return position
+        if b"SETBIT" in script and b"HDEL" in script:
+            await self.cmd_setbit(keys[0], args[0], b"0")
+            return await self.cmd_hdel(keys[1], args[0])
+        raise RedisError("ERR script not supported by the benchmark server")
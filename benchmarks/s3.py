@@ -0,0 +1,127 @@
+"""
+S3 stand-in
+
+Path style S3 API over aiohttp, enough for single and multipart uploads,
+downloads with ranges, deletes and listings. Objects are kept in memory.
+"""
+
+import hashlib
+from uuid import uuid4
+from xml.sax.saxutils import escape
+from email.utils import formatdate
+from typing import Optional as O, Dict as D, Tuple as T, Any as A
+from aiohttp import web
+from benchmarks.stubs import Stub, Latency
+
+def _xml(body:str, status:int=200) -> web.Response:
+    return web.Response(
+        text=f'<?xml version="1.0" encoding="UTF-8"?>{body}', status=status, content_type="application/xml"
+    )
+
+def _error(code:str, status:int) -> web.Response:
+    return _xml(f"<Error><Code>{code}</Code><Message>{code}</Message></Error>", status)
+
+class S3Stub(Stub):
+    """
+
+    In-memory S3 bucket store
+
+    """
+    def __init__(self, latency:O[Latency]=None):
+        super().__init__(latency, client_max_size=64 * 1024 ** 2)
+        self.objects:D[T[str,str],D[str,A]] = {}
+        self.uploads:D[str,D[int,bytes]] = {}
+        self.received = 0
+        self.sent = 0
+        self.gets = 0
+        self.app.add_routes([
+            web.get("/{bucket}", self.list_objects),
+            web.get("/{bucket}/", self.list_objects),
+            web.put("/{bucket}/{key:.+}", self.put),
+            web.post("/{bucket}/{key:.+}", self.post),
+            web.get("/{bucket}/{key:.+}", self.get),
+            web.head("/{bucket}/{key:.+}", self.get),
+            web.delete("/{bucket}/{key:.+}", self.delete),
+        ])
+
+    @staticmethod
+    def _target(request:web.Request) -> T[str,str]:
+        return request.match_info["bucket"], request.match_info["key"]
+
+    def _store(self, request:web.Request, body:bytes) -> str:
+        etag = f'"{hashlib.md5(body).hexdigest()}"' # nosec
+        self.objects[self._target(request)] = {
+            "body": body,
+            "etag": etag,
+            "type": request.headers.get("Content-Type", "application/octet-stream"),
+            "modified": formatdate(usegmt=True)
+        }
+        return etag
+
+    async def put(self, request:web.Request) -> web.Response:
+        body = await request.read()
+        self.received += len(body)
+        if "uploadId" in request.query:
+            parts = self.uploads.get(request.query["uploadId"])
+            if parts is None:
+                return _error("NoSuchUpload", 404)
+            parts[int(request.query["partNumber"])] = body
+            return web.Response(headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'}) # nosec
+        return web.Response(headers={"ETag": self._store(request, body)})
+
+    async def post(self, request:web.Request) -> web.Response:
+        bucket, key = self._target(request)
+        if "uploads" in request.query:
+            upload_id = uuid4().hex
+            self.uploads[upload_id] = {}
+            return _xml(
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            )
+        parts = self.uploads.pop(request.query.get("uploadId", ""), None)
+        if parts is None:
+            return _error("NoSuchUpload", 404)
+        await request.read()
+        etag = self._store(request, b"".join(parts[number] for number in sorted(parts)))
+        return _xml(
+            f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{escape(key)}</Key>"
+            f"<ETag>{escape(etag)}</ETag></CompleteMultipartUploadResult>"
+        )
+
+    async def get(self, request:web.Request) -> web.StreamResponse:
+        stored = self.objects.get(self._target(request))
+        if stored is None:
+            return _error("NoSuchKey", 404)
+        body = stored["body"]
+        if request.method == "GET":
+            self.gets += 1
+        headers = {"ETag": stored["etag"], "Last-Modified": stored["modified"], "Accept-Ranges": "bytes", "Content-Type": stored["type"]}
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            start, stop, _ = request.http_range.indices(len(body))
+            if start >= len(body):
+                return _error("InvalidRange", 416)
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(body)}"
+            self.sent += stop - start
+            return web.Response(body=body[start:stop], status=206, headers=headers)
+        if request.method == "GET":
+            self.sent += len(body)
+        return web.Response(body=body if request.method == "GET" else None, headers={**headers, "Content-Length": str(len(body))})
+
+    async def delete(self, request:web.Request) -> web.Response:
+        if "uploadId" in request.query:
+            self.uploads.pop(request.query["uploadId"], None)
+        else:
+            self.objects.pop(self._target(request), None)
+        return web.Response(status=204)
+
+    async def list_objects(self, request:web.Request) -> web.Response:
+        bucket = request.match_info["bucket"]
+        prefix = request.query.get("prefix", "")
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key><Size>{len(stored['body'])}</Size><ETag>{escape(stored['etag'])}</ETag></Contents>"
+            for (bucket_, key), stored in sorted(self.objects.items()) if bucket_ == bucket and key.startswith(prefix)
+        )
+        return _xml(
+            f"<ListBucketResult><Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>"
+            f"<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"
+        )
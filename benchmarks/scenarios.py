@@ -0,0 +1,256 @@
+"""
+Benchmark scenarios
+
+Every scenario gets a fresh stack of stand-ins and application process and
+returns one summary per measured workload.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+from typing import Dict as D, List as L, Any as A, Callable as C, Awaitable as W
+from aiohttp import ClientSession, ClientTimeout, FormData, TCPConnector
+from benchmarks.harness import ROOT, Stack, Server, measure, free_port
+
+Scenario = C[[Stack, Server, ClientSession, D[str,A]], W[L[D[str,A]]]]
+
+SCENARIOS:D[str,Scenario] = {}
+ENVIRONS:D[str,D[str,A]] = {}
+
+def scenario(name:str, **environ:A) -> C[[Scenario], Scenario]:
+    """
+    Registers a scenario under a name, with settings of the application process
+    given as strings or as functions called when the scenario starts
+    """
+    def decorator(func:Scenario) -> Scenario:
+        SCENARIOS[name] = func
+        ENVIRONS[name] = environ
+        return func
+    return decorator
+
+async def _events(response:A) -> L[D[str,A]]:
+    """Parsed `data` payloads of a server-sent event stream, read to its end"""
+    events = []
+    async for line in response.content:
+        if line.startswith(b"data: "):
+            events.append(json.loads(line[6:]))
+    return events
+
+@scenario("uploads")
+async def uploads(_stack:Stack, server:Server, session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Concurrent multipart uploads of small, medium and multipart sized files
+    """
+    sizes = [16 * 1024, 1024 * 1024, 12 * 1024 * 1024]
+    payloads = {size: os.urandom(size) for size in sizes}
+
+    async def upload(index:int) -> None:
+        size = sizes[index % len(sizes)]
+        form = FormData()
+        form.add_field("file", payloads[size], filename=f"file-{index}.bin", content_type="application/octet-stream")
+        async with session.post(f"{server.url}/api/upload?key=bench-{index}&user=bench", data=form) as response:
+            if response.status != 200:
+                raise RuntimeError(f"{response.status}: {await response.text()}")
+            await response.read()
+
+    count = options.get("requests") or 24
+    result = await measure("uploads", upload, count, options.get("concurrency") or 6, server)
+    result["mb_per_s"] = sum(sizes[i % len(sizes)] for i in range(count)) / 2 ** 20 * result["rps"] / count
+    return [result]
+
+@scenario("downloads")
+async def downloads(stack:Stack, server:Server, session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Whole and ranged reads of a few hot uploads over `/api/upload/{ref}/content`
+    """
+    files = 4
+    payloads = [os.urandom(size) for size in (64 * 1024, 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024)]
+    refs = []
+    for index, payload in enumerate(payloads):
+        form = FormData()
+        form.add_field("file", payload, filename=f"hot-{index}.bin", content_type="application/octet-stream")
+        async with session.post(f"{server.url}/api/upload?key=hot-{index}&user=bench", data=form) as response:
+            if response.status != 200:
+                raise RuntimeError(f"{response.status}: {server.output()}")
+            refs.append((await response.json())["ref"])
+
+    async def read(index:int) -> None:
+        payload = payloads[index % files]
+        url = f"{server.url}/api/upload/{refs[index % files]}/content"
+        if index % 2:
+            start = index * 4096 % (len(payload) // 2)
+            headers = {"Range": f"bytes={start}-{start + 65535}"}
+            expected, status = payload[start:start + 65536], 206
+        else:
+            headers, expected, status = {}, payload, 200
+        async with session.get(url, headers=headers) as response:
+            body = await response.read()
+            if response.status != status or body != expected:
+                raise RuntimeError(f"{response.status}: {len(body)} bytes, expected {status} with {len(expected)}")
+
+    gets, sent = stack.s3.gets, stack.s3.sent
+    result = await measure("downloads", read, options.get("requests") or 400, options.get("concurrency") or 16, server)
+    result["s3_gets"] = stack.s3.gets - gets
+    result["s3_mb"] = (stack.s3.sent - sent) / 2 ** 20
+    return [result]
+
+@scenario("pull")
+async def pull_fanout(stack:Stack, server:Server, session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Many clients following the pull of the same images over `/api/docker/pull`
+    """
+    subscribers = options.get("concurrency") or 50
+    images = 4
+
+    async def follow(index:int) -> None:
+        async with session.get(f"{server.url}/api/docker/pull?image=bench/app{index % images}") as response:
+            events = await _events(response)
+        if not events or events[-1]["status"] != "complete":
+            raise RuntimeError(f"Pull did not complete: {events[-1] if events else None}")
+
+    result = await measure("pull", follow, options.get("requests") or subscribers * images, subscribers * images, server)
+    result["upstream_pulls"] = sum(sum(stub.pulls.values()) for stub in stack.docker)
+    return [result]
+
+@scenario("deploy")
+async def deploy(stack:Stack, server:Server, session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Deploy jobs from submission to completion, followed over their event stream
+    """
+    repos = 5
+
+    async def run(index:int) -> None:
+        url = f"{server.url}/api/github/deploy/bench/repo{index % repos}?port=8080"
+        async with session.post(url) as response:
+            job = (await response.json())["job"]
+        async with session.get(f"{server.url}/api/deploys/{job}/events") as response:
+            states = await _events(response)
+        if not states or states[-1]["status"] != "complete":
+            raise RuntimeError(f"Deploy failed: {states[-1].get('error') if states else 'no events'}")
+
+    result = await measure("deploy", run, options.get("requests") or 40, options.get("concurrency") or 10, server)
+    result["builds"] = sum(stub.builds for stub in stack.docker)
+    result["dns_batches"] = stack.cloudflare.batches
+    return [result]
+
+@scenario(
+    "wake", IDLE_TIMEOUT="1", IDLE_CHECK_INTERVAL="0.2",
+    IDLE_BEACON=lambda: f"127.0.0.1:{free_port()}", WAKE_UPSTREAM=lambda: f"127.0.0.1:{free_port()}"
+)
+async def wake(stack:Stack, server:Server, session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Deployments stopped after idling, then woken by concurrent requests sent to the wake
+    listener as the proxy would. One of them keeps sending activity beacons and must stay up
+    """
+    from kubectl.idle import IdleReaper, WAKE_HEADER # pylint: disable=import-outside-toplevel
+    deployments = 5
+    docker = stack.docker[0]
+    docker.boot = 0.2
+    names = []
+
+    async def deploy(index:int) -> None:
+        async with session.post(f"{server.url}/api/github/deploy/bench/idle{index}?port=8080") as response:
+            if response.status != 200:
+                raise RuntimeError(f"{response.status}: {server.output()}")
+            job = (await response.json())["job"]
+        async with session.get(f"{server.url}/api/deploys/{job}/events") as response:
+            states = await _events(response)
+        if not states or states[-1]["status"] != "complete":
+            raise RuntimeError(f"Deploy failed: {states[-1].get('error') if states else 'no events'}")
+        names.append(states[-1]["result"]["url"].split(".")[0])
+
+    # Deployed together, so none of them idles before the beacons start
+    await asyncio.gather(*[deploy(index) for index in range(deployments)])
+    host, port = server.environ["IDLE_BEACON"].rsplit(":", 1)
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, int(port)))
+    try:
+        deadline = time.monotonic() + 15
+        while docker.stops < deployments - 1 and time.monotonic() < deadline:
+            transport.sendto(f"<190>Oct 18 12:00:00 {IdleReaper.tag(names[0])}: GET / 200".encode())
+            await asyncio.sleep(0.1)
+    finally:
+        transport.close()
+    stopped = docker.stops
+    if stopped != deployments - 1:
+        raise RuntimeError(f"{stopped} of {deployments - 1} idle deployments stopped")
+    starts = docker.starts
+
+    async def request(index:int) -> None:
+        name = names[1 + index % (deployments - 1)]
+        async with session.get(f"http://{server.environ['WAKE_UPSTREAM']}/index.html", headers={WAKE_HEADER: name}) as response:
+            body = await response.text()
+        if response.status != 200 or body != name:
+            raise RuntimeError(f"{response.status}: {body}")
+
+    count = options.get("requests") or (deployments - 1) * 4
+    result = await measure("wake", request, count, options.get("concurrency") or count, server)
+    result["stopped"] = stopped
+    result["wakes"] = docker.starts - starts
+    return [result]
+
+@scenario("auth")
+async def auth(stack:Stack, server:Server, session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Token verification rate, half of the users send id tokens carrying their profile and
+    half send access tokens, which need a `/userinfo` call
+    """
+    users = 100
+    tokens = [stack.auth0.token(f"user-{n}", profile=n % 2 == 0) for n in range(users)]
+
+    async def authorize(index:int) -> None:
+        async with session.get(f"{server.url}/api/auth", params={"token": tokens[index % users]}) as response:
+            if response.status != 200:
+                raise RuntimeError(f"{response.status}: {await response.text()}")
+            await response.read()
+
+    result = await measure("auth", authorize, options.get("requests") or 2000, options.get("concurrency") or 32, server)
+    result["userinfo_calls"] = stack.auth0.userinfo_calls
+    return [result]
+
+@scenario("startup")
+async def startup(stack:Stack, server:Server, _session:ClientSession, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Import time of the application without any settings, and time from spawning a
+    configured worker to its first answer
+    """
+    count = options.get("requests") or 10
+    environ = {"PATH": os.environ.get("PATH", ""), "PYTHONPATH": ROOT}
+
+    async def load(_index:int) -> None:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", "import main", cwd=ROOT, env=environ,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode:
+            raise RuntimeError(stderr.decode().strip().splitlines()[-1])
+
+    async def ready(_index:int) -> None:
+        worker = Server(stack.environ())
+        try:
+            await worker.start()
+        finally:
+            await worker.stop()
+
+    return [
+        await measure("import", load, count, 1, server),
+        await measure("ready", ready, count, 1, server),
+    ]
+
+async def run(name:str, options:D[str,A]) -> L[D[str,A]]:
+    """
+    Runs a scenario against a fresh stack and application process
+    """
+    stack = Stack(latency=options.get("latency", 0.005), interval=options.get("interval", 0.01))
+    await stack.start()
+    environ = {key: value() if callable(value) else value for key, value in ENVIRONS[name].items()}
+    server = Server(stack.environ(**environ))
+    try:
+        await server.start()
+        async with ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=300)) as session:
+            return await SCENARIOS[name](stack, server, session, options)
+    finally:
+        await server.stop()
+        await stack.stop()
@@ -0,0 +1,34 @@
+"""
+Benchmarked application process
+
+Runs `main.app` against the stand-ins named in the environment: Fauna is
+evaluated in process, the GitHub, Cloudflare and Auth0 base urls are pointed
+at the local stubs, everything else is configured through the usual settings.
+"""
+
+import os
+from aiohttp import web
+from benchmarks.fauna import FaunaStandIn
+
+def run() -> None:
+    """
+    Serves the application on `BENCH_PORT` until interrupted
+    """
+    FaunaStandIn(float(os.environ.get("BENCH_FAUNA_LATENCY", "0"))).install()
+    import kubectl.github # pylint: disable=import-outside-toplevel
+    import kubectl.dns # pylint: disable=import-outside-toplevel
+    import kubectl.auth # pylint: disable=import-outside-toplevel
+    from kubectl.models import User # pylint: disable=import-outside-toplevel
+    import main # pylint: disable=import-outside-toplevel
+    kubectl.github.GITHUB_URL = os.environ["BENCH_GITHUB_URL"]
+    kubectl.dns.CLOUDFLARE_URL = os.environ["BENCH_CLOUDFLARE_URL"]
+    kubectl.auth.auth.url = os.environ["BENCH_AUTH0_URL"]
+
+    async def provision(_app:web.Application) -> None:
+        await User.provision()
+
+    main.app.on_startup.append(provision)
+    web.run_app(main.app, host="127.0.0.1", port=int(os.environ["BENCH_PORT"]), print=None, access_log=None)
+
+if __name__ == "__main__":
+    run()
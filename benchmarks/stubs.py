@@ -0,0 +1,444 @@
+"""
+Upstream stand-ins
+
+Local aiohttp servers answering the Docker Engine, GitHub, Cloudflare and
+Auth0 calls the services make, with a fixed delay before every response and
+between the messages of streamed responses.
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+from uuid import uuid4
+from datetime import datetime, timezone
+from typing import Optional as O, Dict as D, List as L, Set as S, Any as A
+import jwt
+from aiohttp import web
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+class Latency:
+    """
+
+    Delays applied by a stub: `delay` seconds before every response and
+    `interval` seconds between the messages of a streamed one
+
+    """
+    def __init__(self, delay:float=0.0, interval:float=0.0):
+        self.delay = delay
+        self.interval = interval
+
+    async def wait(self) -> None:
+        """Waits before a response"""
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+    async def tick(self) -> None:
+        """Waits between two streamed messages"""
+        await asyncio.sleep(self.interval)
+
+class Stub:
+    """
+
+    An aiohttp application served on a local port
+
+    """
+    def __init__(self, latency:O[Latency]=None, client_max_size:int=1024 ** 2):
+        self.latency = latency or Latency()
+        self.app = web.Application(middlewares=[self._middleware], client_max_size=client_max_size)
+        self.runner:O[web.AppRunner] = None
+        self.url = ""
+        self.requests = 0
+
+    @web.middleware
+    async def _middleware(self, request:web.Request, handler:A) -> web.StreamResponse:
+        self.requests += 1
+        await self.latency.wait()
+        return await handler(request)
+
+    async def start(self) -> str:
+        """
+        Starts serving on a free port, returns the base url
+        """
+        self.runner = web.AppRunner(self.app, handle_signals=False, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0, shutdown_timeout=0.5)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1] # type: ignore # pylint: disable=protected-access
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        """
+        Stops serving
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @staticmethod
+    async def stream(request:web.Request) -> web.StreamResponse:
+        """Prepared streamed response"""
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        return response
+
+class DockerStub(Stub):
+    """
+
+    Docker Engine API
+
+    Pulls stream `layers` layers of `steps` progress messages each, builds
+    stream `steps` build steps. Containers, images and their events live in
+    memory, the number of pulls and builds is counted per image. With `boot`
+    set, started containers answer on their published ports after `boot`
+    seconds, like an application that takes that long to listen.
+
+    """
+    def __init__(self, latency:O[Latency]=None, layers:int=4, steps:int=10, cpus:int=8, boot:O[float]=None):
+        super().__init__(latency)
+        self.layers = layers
+        self.steps = steps
+        self.cpus = cpus
+        self.boot = boot
+        self.images:D[str,D[str,A]] = {}
+        self.containers:D[str,D[str,A]] = {}
+        self.configs:D[str,D[str,A]] = {}
+        self.listeners:D[str,L[web.AppRunner]] = {}
+        self.pulls:D[str,int] = {}
+        self.builds = 0
+        self.starts = 0
+        self.stops = 0
+        self._events:S[asyncio.Queue] = set()
+        self.history:L[D[str,A]] = []
+        self.app.add_routes([
+            web.get("/info", self.info),
+            web.get("/containers/json", self.list_containers),
+            web.post("/containers/create", self.create_container),
+            web.get("/containers/{id}/json", self.inspect_container),
+            web.get("/containers/{id}/stats", self.container_stats),
+            web.post("/containers/{id}/start", self.start_container),
+            web.post("/containers/{id}/stop", self.stop_container),
+            web.get("/containers/{id}/logs", self.container_logs),
+            web.post("/images/create", self.pull),
+            web.get("/images/json", self.list_images),
+            web.get(r"/images/{name:.+}/json", self.inspect_image),
+            web.post("/build", self.build),
+            web.get("/events", self.events),
+        ])
+
+    def _publish(self, action:str, container:D[str,A]) -> None:
+        now = time.time()
+        event = {
+            "Type": "container", "Action": action, "Actor": {"ID": container["Id"], "Attributes": {}},
+            "time": int(now), "timeNano": int(now * 1e9)
+        }
+        self.history.append(event)
+        for queue in self._events:
+            queue.put_nowait(event)
+
+    async def info(self, _:web.Request) -> web.Response:
+        running = sum(1 for c in self.containers.values() if c["State"] == "running")
+        return web.json_response({
+            "NCPU": self.cpus, "MemTotal": self.cpus * 2 ** 31, "ContainersRunning": running,
+            "SystemTime": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        })
+
+    async def list_containers(self, request:web.Request) -> web.Response:
+        filters = json.loads(request.query.get("filters", "{}"))
+        ids = set(filters.get("id", []))
+        found = [c for c in self.containers.values() if not ids or c["Id"] in ids]
+        if "all" not in request.query:
+            found = [c for c in found if c["State"] == "running"]
+        return web.json_response(found)
+
+    async def create_container(self, request:web.Request) -> web.Response:
+        payload = await request.json()
+        id_ = hashlib.sha256(uuid4().bytes).hexdigest()
+        container = self.containers[id_] = {
+            "Id": id_,
+            "Names": [f"/{request.query.get('name', id_[:12])}"],
+            "Image": payload.get("Image"),
+            "State": "created",
+            "Status": "Created",
+            "Labels": payload.get("Labels") or {},
+            "Ports": [],
+            "Created": int(time.time())
+        }
+        self.configs[id_] = payload.get("HostConfig") or {}
+        self._publish("create", container)
+        return web.json_response({"Id": id_, "Warnings": []}, status=201)
+
+    def _container(self, request:web.Request) -> O[D[str,A]]:
+        ref = request.match_info["id"]
+        if ref in self.containers:
+            return self.containers[ref]
+        for container in self.containers.values():
+            if container["Id"].startswith(ref) or f"/{ref}" in container["Names"]:
+                return container
+        return None
+
+    async def inspect_container(self, request:web.Request) -> web.Response:
+        container = self._container(request)
+        if container is None:
+            return web.json_response({"message": "No such container"}, status=404)
+        return web.json_response({
+            **container, "Config": {"Tty": False, "Labels": container["Labels"]}, "HostConfig": self.configs.get(container["Id"], {})
+        })
+
+    async def container_stats(self, _:web.Request) -> web.Response:
+        return web.json_response({
+            "cpu_stats": {"cpu_usage": {"total_usage": 2000}, "system_cpu_usage": 200000},
+            "precpu_stats": {"cpu_usage": {"total_usage": 1000}, "system_cpu_usage": 100000},
+            "memory_stats": {"usage": 64 * 2 ** 20}
+        })
+
+    async def start_container(self, request:web.Request) -> web.Response:
+        container = self._container(request)
+        if container is None:
+            return web.json_response({"message": "No such container"}, status=404)
+        if container["State"] == "running":
+            return web.Response(status=304)
+        container["State"], container["Status"] = "running", "Up 1 second"
+        self.starts += 1
+        if self.boot is not None:
+            asyncio.create_task(self._listen(container))
+        self._publish("start", container)
+        return web.Response(status=204)
+
+    async def _listen(self, container:D[str,A]) -> None:
+        """Answers on the published ports of a container once it booted"""
+        await asyncio.sleep(self.boot or 0)
+        if container["State"] != "running":
+            return
+        name = container["Names"][0].lstrip("/")
+
+        async def answer(_:web.Request) -> web.Response:
+            return web.Response(text=name)
+
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", answer)
+        runners = self.listeners.setdefault(container["Id"], [])
+        for bindings in (self.configs.get(container["Id"], {}).get("PortBindings") or {}).values():
+            for binding in bindings:
+                runner = web.AppRunner(app, handle_signals=False, access_log=None)
+                await runner.setup()
+                await web.TCPSite(runner, "127.0.0.1", int(binding["HostPort"]), shutdown_timeout=0.1).start()
+                runners.append(runner)
+
+    async def stop_container(self, request:web.Request) -> web.Response:
+        container = self._container(request)
+        if container is None:
+            return web.json_response({"message": "No such container"}, status=404)
+        if container["State"] != "running":
+            return web.Response(status=304)
+        container["State"], container["Status"] = "exited", "Exited (0) 1 second ago"
+        self.stops += 1
+        for runner in self.listeners.pop(container["Id"], []):
+            await runner.cleanup()
+        self._publish("stop", container)
+        return web.Response(status=204)
+
+    async def stop(self) -> None:
+        for runners in self.listeners.values():
+            for runner in runners:
+                await runner.cleanup()
+        self.listeners.clear()
+        await super().stop()
+
+    async def container_logs(self, request:web.Request) -> web.StreamResponse:
+        container = self._container(request)
+        if container is None:
+            return web.json_response({"message": "No such container"}, status=404)
+        response = web.StreamResponse(headers={"Content-Type": "application/vnd.docker.multiplexed-stream"})
+        await response.prepare(request)
+        for index in range(self.steps):
+            line = f"{container['Id'][:12]} log line {index}\n".encode()
+            await response.write(bytes([1 + index % 2, 0, 0, 0]) + len(line).to_bytes(4, "big") + line)
+            await self.latency.tick()
+        return response
+
+    async def pull(self, request:web.Request) -> web.StreamResponse:
+        image = request.query["fromImage"]
+        self.pulls[image] = self.pulls.get(image, 0) + 1
+        response = await self.stream(request)
+        tag = image.rsplit(":", 1)[-1] if ":" in image.rsplit("/", 1)[-1] else "latest"
+        await response.write(json.dumps({"status": f"Pulling from {image.split(':')[0]}", "id": tag}).encode() + b"\n")
+        layers = [hashlib.sha256(f"{image}{n}".encode()).hexdigest()[:12] for n in range(self.layers)]
+        for layer in layers:
+            await response.write(json.dumps({"status": "Pulling fs layer", "progressDetail": {}, "id": layer}).encode() + b"\n")
+        total = 2 ** 20
+        for step in range(1, self.steps + 1):
+            for layer in layers:
+                message = {"status": "Downloading", "progressDetail": {"current": total * step // self.steps, "total": total}, "id": layer}
+                await response.write(json.dumps(message).encode() + b"\n")
+            await self.latency.tick()
+        for layer in layers:
+            await response.write(json.dumps({"status": "Pull complete", "progressDetail": {}, "id": layer}).encode() + b"\n")
+        self.images.setdefault(image, {"Id": f"sha256:{hashlib.sha256(image.encode()).hexdigest()}", "Labels": {}})
+        await response.write(json.dumps({"status": f"Status: Downloaded newer image for {image}"}).encode() + b"\n")
+        return response
+
+    async def list_images(self, request:web.Request) -> web.Response:
+        filters = json.loads(request.query.get("filters", "{}"))
+        labels = [label.split("=", 1) for label in filters.get("label", [])]
+        found = [
+            image for image in self.images.values()
+            if all(image["Labels"].get(name) == value for name, value in labels)
+        ]
+        return web.json_response(found)
+
+    async def inspect_image(self, request:web.Request) -> web.Response:
+        name = request.match_info["name"]
+        for key, image in self.images.items():
+            if name in (key, image["Id"]):
+                return web.json_response(image)
+        return web.json_response({"message": f"No such image: {name}"}, status=404)
+
+    async def build(self, request:web.Request) -> web.StreamResponse:
+        self.builds += 1
+        labels = json.loads(request.query.get("labels", "{}"))
+        image = f"sha256:{hashlib.sha256(uuid4().bytes).hexdigest()}"
+        response = await self.stream(request)
+        for step in range(1, self.steps + 1):
+            await response.write(json.dumps({"stream": f"Step {step}/{self.steps} : RUN true\n"}).encode() + b"\n")
+            await self.latency.tick()
+        self.images[image] = {"Id": image, "Labels": labels}
+        await response.write(json.dumps({"aux": {"ID": image}}).encode() + b"\n")
+        await response.write(json.dumps({"stream": f"Successfully built {image[7:19]}\n"}).encode() + b"\n")
+        return response
+
+    async def events(self, request:web.Request) -> web.StreamResponse:
+        queue:asyncio.Queue = asyncio.Queue()
+        if "since" in request.query:
+            since = float(request.query["since"]) * 1e9
+            for event in self.history:
+                if event["timeNano"] >= since:
+                    queue.put_nowait(event)
+        self._events.add(queue)
+        response = await self.stream(request)
+        try:
+            while True:
+                await response.write(json.dumps(await queue.get()).encode() + b"\n")
+        finally:
+            self._events.discard(queue)
+
+class GitHubStub(Stub):
+    """
+
+    GitHub REST API, commits come with an `ETag` and revalidate as `304`
+
+    """
+    def __init__(self, latency:O[Latency]=None):
+        super().__init__(latency)
+        self.not_modified = 0
+        self.app.add_routes([
+            web.get("/repos/{owner}/{repo}/commits", self.commits),
+            web.get("/repos/{owner}/{repo}/contents/Dockerfile", self.dockerfile),
+        ])
+
+    @staticmethod
+    def sha(owner:str, repo:str) -> str:
+        """Head commit of a repository"""
+        return hashlib.sha1(f"{owner}/{repo}".encode()).hexdigest()
+
+    def _headers(self, etag:str) -> D[str,str]:
+        return {"ETag": etag, "X-RateLimit-Limit": "5000", "X-RateLimit-Remaining": str(5000 - self.requests % 5000), "X-RateLimit-Used": str(self.requests % 5000)}
+
+    async def commits(self, request:web.Request) -> web.Response:
+        sha = self.sha(request.match_info["owner"], request.match_info["repo"])
+        etag = f'"{sha}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers=self._headers(etag))
+        return web.json_response([{"sha": sha}], headers=self._headers(etag))
+
+    async def dockerfile(self, request:web.Request) -> web.Response:
+        sha = hashlib.sha1(f"{request.match_info['owner']}/{request.match_info['repo']}/Dockerfile".encode()).hexdigest()
+        return web.json_response({"name": "Dockerfile", "sha": sha}, headers=self._headers(f'"{sha}"'))
+
+class CloudflareStub(Stub):
+    """
+
+    Cloudflare zone and DNS record API, including the batch endpoint
+
+    """
+    def __init__(self, latency:O[Latency]=None, zone_name:str="bench.test"):
+        super().__init__(latency)
+        self.zone_name = zone_name
+        self.records:D[str,D[str,A]] = {}
+        self.batches = 0
+        self.app.add_routes([
+            web.get("/zones/{zone}", self.zone),
+            web.get("/zones/{zone}/dns_records", self.list_records),
+            web.post("/zones/{zone}/dns_records/batch", self.batch),
+        ])
+
+    @staticmethod
+    def _ok(result:A, **extra:A) -> web.Response:
+        return web.json_response({"success": True, "errors": [], "messages": [], "result": result, **extra})
+
+    async def zone(self, request:web.Request) -> web.Response:
+        return self._ok({"id": request.match_info["zone"], "name": self.zone_name})
+
+    async def list_records(self, request:web.Request) -> web.Response:
+        per_page = int(request.query.get("per_page", 100))
+        page = int(request.query.get("page", 1))
+        records = list(self.records.values())
+        pages = max(1, -(-len(records) // per_page))
+        return self._ok(records[(page - 1) * per_page:page * per_page], result_info={"page": page, "total_pages": pages})
+
+    async def batch(self, request:web.Request) -> web.Response:
+        self.batches += 1
+        payload = await request.json()
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        result:D[str,L[D[str,A]]] = {"deletes": [], "patches": [], "posts": []}
+        by_id = {record["id"]: record for record in self.records.values()}
+        for change in payload.get("deletes", []):
+            record = by_id[change["id"]]
+            del self.records[record["name"]]
+            result["deletes"].append(record)
+        for change in payload.get("patches", []):
+            record = by_id[change["id"]]
+            record.update(change, modified_on=now)
+            result["patches"].append(record)
+        for change in payload.get("posts", []):
+            record = self.records[change["name"]] = {**change, "id": uuid4().hex, "created_on": now, "modified_on": now}
+            result["posts"].append(record)
+        return self._ok(result)
+
+class Auth0Stub(Stub):
+    """
+
+    Auth0 tenant, publishes the JWKS of a local key pair and mints tokens signed by it
+
+    """
+    def __init__(self, domain:str, latency:O[Latency]=None):
+        super().__init__(latency)
+        self.domain = domain
+        self.kid = uuid4().hex
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.userinfo_calls = 0
+        self.app.add_routes([
+            web.get("/.well-known/jwks.json", self.jwks),
+            web.get("/userinfo", self.userinfo),
+        ])
+
+    def token(self, sub:str, profile:bool=True, ttl:int=3600) -> str:
+        """
+        Signed token of a user, an access token without profile claims unless `profile`
+        """
+        claims:D[str,A] = {"sub": sub, "iss": f"https://{self.domain}/", "iat": int(time.time()), "exp": int(time.time()) + ttl}
+        if profile:
+            claims.update(name=f"User {sub}", email=f"{sub}@bench.test", nickname=sub)
+        return jwt.encode(claims, self._key, algorithm="RS256", headers={"kid": self.kid})
+
+    async def jwks(self, _:web.Request) -> web.Response:
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self._key.public_key()))
+        return web.json_response({"keys": [{**jwk, "kid": self.kid, "use": "sig", "alg": "RS256"}]})
+
+    async def userinfo(self, request:web.Request) -> web.Response:
+        self.userinfo_calls += 1
+        token = request.headers.get("Authorization", "").replace("Bearer ", "")
+        sub = jwt.decode(token, options={"verify_signature": False})["sub"]
+        return web.json_response({"sub": sub, "name": f"User {sub}", "email": f"{sub}@bench.test", "nickname": sub})
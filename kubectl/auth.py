@@ -0,0 +1,262 @@
+"""
+Token Verification
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional as O, Dict as D, Tuple as T, Any as A
+from kubectl.config import env
+from kubectl.client import client
+from kubectl.decorators import redis
+from kubectl.models import User
+
+PROFILE_FIELDS = [name for name in User.__fields__ if name not in ("ref", "ts")]
+# Seconds the profile of an opaque access token is kept, those carry no expiry
+OPAQUE_TOKEN_TTL = 60
+
+class AuthError(Exception):
+    """
+    Raised when a token can not be verified
+    """
+
+class Authenticator:
+    """
+
+    Verifies Auth0 tokens locally against the tenant JWKS
+
+    Signing keys are fetched once and refreshed periodically, or early when a
+    token names an unknown key. Verified profiles and their stored users are
+    kept per token until the token expires, and users are written to Fauna only
+    when their profile changed since the last login. Opaque access tokens are
+    checked against `/userinfo`. PyJWT is imported with the first token.
+
+    """
+    def __init__(self,
+        domain:O[str]=env.AUTH0_DOMAIN,
+        audience:O[str]=env.AUTH0_AUDIENCE,
+        interval:float=env.JWKS_REFRESH_INTERVAL,
+        min_refresh:float=env.JWKS_MIN_REFRESH,
+        maxsize:int=env.AUTH_CACHE_SIZE,
+        url:O[str]=None
+    ):
+        self.domain = domain
+        self._url = url
+        self.audience = audience
+        self.interval = interval
+        self.min_refresh = min_refresh
+        self.maxsize = maxsize
+        self._keys:D[str,A] = {}
+        self._refreshed = 0.0
+        self._refreshing:O[asyncio.Future] = None
+        self._profiles:"OrderedDict[str,T[float,D[str,A],O[User]]]" = OrderedDict()
+        self._task:O[asyncio.Task] = None
+        self.stats:D[str,int] = {"hits": 0, "misses": 0, "refreshes": 0, "writes": 0, "skipped_writes": 0}
+
+    @property
+    def url(self) -> str:
+        """Base url of the tenant"""
+        if self._url is None:
+            env.require("auth")
+            self._url = f"https://{self.domain}"
+        return self._url
+
+    @url.setter
+    def url(self, value:str) -> None:
+        self._url = value
+
+    @property
+    def issuer(self) -> str:
+        """Expected `iss` claim"""
+        return f"https://{self.domain}/"
+
+    async def _fetch_keys(self) -> None:
+        import jwt # pylint: disable=import-outside-toplevel
+        jwks = await client.fetch(f"{self.url}/.well-known/jwks.json")
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+            except (jwt.PyJWTError, KeyError) as exc:
+                logging.warning("Skipping JWKS key %s: %s", jwk.get("kid"), exc)
+        self._keys = keys
+        self._refreshed = time.monotonic()
+        self.stats["refreshes"] += 1
+
+    async def refresh(self) -> None:
+        """
+        Reloads the signing keys, concurrent callers share a single fetch
+        """
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._fetch_keys())
+        try:
+            await asyncio.shield(self._refreshing)
+        finally:
+            self._refreshing = None
+
+    async def key(self, kid:str) -> A:
+        """
+        Signing key by id, refreshing the keys at most every `JWKS_MIN_REFRESH` seconds when unknown
+        """
+        if kid not in self._keys and time.monotonic() - self._refreshed >= self.min_refresh:
+            await self.refresh()
+        try:
+            return self._keys[kid]
+        except KeyError as exc:
+            raise AuthError(f"Unknown signing key {kid}") from exc
+
+    async def verify(self, token:str) -> D[str,A]:
+        """
+        Verified claims of a token
+        """
+        import jwt # pylint: disable=import-outside-toplevel
+        try:
+            header = jwt.get_unverified_header(token)
+            key = await self.key(header.get("kid", ""))
+            return jwt.decode(
+                token,
+                key,
+                algorithms=["RS256"],
+                audience=self.audience,
+                issuer=self.issuer,
+                options={"verify_aud": self.audience is not None}
+            )
+        except jwt.PyJWTError as exc:
+            raise AuthError(str(exc)) from exc
+
+    @staticmethod
+    def _is_jwt(token:str) -> bool:
+        import jwt # pylint: disable=import-outside-toplevel
+        try:
+            jwt.get_unverified_header(token)
+        except jwt.DecodeError:
+            return False
+        return True
+
+    async def _userinfo(self, token:str) -> D[str,A]:
+        async with client.request(f"{self.url}/userinfo", headers={"Authorization": f"Bearer {token}"}) as response:
+            if response.status != 200:
+                raise AuthError(f"Token rejected by {self.domain}: {response.status} {response.reason}")
+            return await response.json()
+
+    @staticmethod
+    def _token_key(token:str) -> str:
+        return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+    def _cached(self, key:str) -> O[T[float,D[str,A],O[User]]]:
+        cached = self._profiles.get(key)
+        if cached is None or cached[0] <= time.time():
+            return None
+        self._profiles.move_to_end(key)
+        return cached
+
+    async def profile(self, token:str) -> D[str,A]:
+        """
+        Profile of the token owner, from the cache until the token expires. Access tokens
+        carry no profile claims, those are completed once per token from `/userinfo`,
+        which also verifies opaque access tokens
+        """
+        key = self._token_key(token)
+        cached = self._cached(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached[1]
+        self.stats["misses"] += 1
+        if self._is_jwt(token):
+            claims = await self.verify(token)
+            if "name" not in claims:
+                claims = {**claims, **await self._userinfo(token)}
+            expires = claims.get("exp", time.time())
+        else:
+            claims = await self._userinfo(token)
+            expires = time.time() + OPAQUE_TOKEN_TTL
+        profile = {name: claims.get(name) for name in PROFILE_FIELDS}
+        self._profiles[key] = (expires, profile, None)
+        while len(self._profiles) > self.maxsize:
+            self._profiles.popitem(last=False)
+        return profile
+
+    async def _stored(self, key:str) -> D[str,str]:
+        """Profile hash and user stored by any node, empty when Redis is unavailable"""
+        if not redis.configured:
+            return {}
+        try:
+            return await redis.hgetall(key)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Reading the stored user failed: %s", exc)
+            return {}
+
+    async def _store(self, key:str, digest:str, user:User) -> None:
+        if not redis.configured:
+            return
+        try:
+            await redis.hset(key, mapping={"hash": digest, "user": user.json()})
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Storing the user hash failed: %s", exc)
+
+    async def upsert(self, profile:D[str,A]) -> User:
+        """
+        Stores the user, writing to Fauna only when the profile differs from the stored one
+        """
+        digest = hashlib.blake2b(json.dumps(profile, sort_keys=True).encode(), digest_size=16).hexdigest()
+        key = f"kubectl:users:{profile['sub']}"
+        stored = await self._stored(key)
+        if stored.get("hash") == digest:
+            self.stats["skipped_writes"] += 1
+            return User(**json.loads(stored["user"]))
+        existing = await User.find_many("sub", profile["sub"])
+        if existing:
+            user = await User.update(existing[0].ref, **profile)
+        else:
+            user = await User(**profile).save()
+        self.stats["writes"] += 1
+        if isinstance(user, User):
+            await self._store(key, digest, user)
+        return user
+
+    async def authorize(self, token:str) -> User:
+        """
+        Verifies a token and returns its stored user. The profile of a token never changes,
+        so once its user is stored later calls are answered from memory alone
+        """
+        profile = await self.profile(token)
+        key = self._token_key(token)
+        cached = self._cached(key)
+        if cached is not None and cached[2] is not None:
+            return cached[2]
+        user = await self.upsert(profile)
+        cached = self._cached(key)
+        if cached is not None and isinstance(user, User):
+            self._profiles[key] = (cached[0], cached[1], user)
+        return user
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as exc: # pylint: disable=broad-except
+                logging.warning("JWKS refresh failed: %s", exc)
+            await asyncio.sleep(self.interval)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts the periodic key refresh, meant to run on application startup
+        """
+        if self._url is None and not env.configured("auth"):
+            logging.warning("Token verification disabled, set %s", ", ".join(env.missing("auth")))
+            return
+        self._task = asyncio.create_task(self._refresh_forever())
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the periodic key refresh, meant to run on application shutdown
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+auth = Authenticator()
@@ -2,35 +2,218 @@
 HTTP Client
 """
 
-from typing import Optional as O, Dict as D, Any as A, AsyncGenerator as AG
-from aiohttp import ClientSession
+import json
+import time
+import codecs
+from types import SimpleNamespace
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Optional as O, Dict as D, List as L, Set as S, Any as A, AsyncGenerator as AG, AsyncIterator as AI
+from aiohttp import ClientSession, ClientResponse, ClientTimeout, TCPConnector, UnixConnector, TraceConfig
+from kubectl.config import env, DOCKER_HOSTS
+from kubectl.metrics import registry, traceparent
+
+REQUEST_SECONDS = registry.histogram(
+    "kubectl_http_request_duration_seconds", "Upstream time to response headers", ("host", "method", "status")
+)
+RECEIVED_BYTES = registry.counter("kubectl_http_received_bytes_total", "Upstream response body bytes", ("host",))
+SENT_BYTES = registry.counter("kubectl_http_sent_bytes_total", "Upstream request body bytes", ("host",))
+
+class NDJSONDecoder:
+    """
+
+    Incremental decoder for newline delimited JSON streams
+
+    Chunks are split on raw newline bytes, which never occur inside a multibyte
+    UTF-8 sequence, so characters and messages split across chunks are kept in
+    the buffer until their line is complete. Several objects on a single line
+    are decoded as well.
+
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._decoder = json.JSONDecoder()
+
+    def _decode(self, line:bytes) -> L[A]:
+        text = line.decode("utf-8").strip()
+        messages = []
+        pos = 0
+        while pos < len(text):
+            message, pos = self._decoder.raw_decode(text, pos)
+            messages.append(message)
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+        return messages
+
+    def feed(self, chunk:bytes) -> L[A]:
+        """
+        Buffers a chunk and returns every message completed by it
+        """
+        self._buffer += chunk
+        end = self._buffer.rfind(b"\n")
+        if end == -1:
+            return []
+        lines = self._buffer[:end].split(b"\n")
+        del self._buffer[:end + 1]
+        return [message for line in lines for message in self._decode(line)]
+
+    def close(self) -> L[A]:
+        """
+        Returns the messages left in the buffer once the stream is over
+        """
+        messages = self._decode(self._buffer)
+        self._buffer.clear()
+        return messages
 
 class APIClient:
     """
-    
+
     Generic HTTP Client
-    
+
+    Keeps one long lived session for the Docker engines and another one shared
+    by every other upstream (GitHub, Cloudflare, Auth0), each one with its own
+    keep-alive pool, so connections are reused across calls. The trace context
+    of a deploy is only sent to the sessions listed in `traced`, internal
+    upstreams by default, third parties never see a `traceparent` header.
+
     """
-    async def fetch(self,
+    def __init__(self, docker_urls:L[str]=DOCKER_HOSTS, docker_socket:O[str]=None, traced:O[S[str]]=None):
+        self.docker_urls = tuple(docker_urls)
+        self.docker_socket = docker_socket
+        self.traced = traced if traced is not None else {"docker"}
+        self._sessions:D[str,ClientSession] = {}
+        self._stats:D[str,D[str,int]] = defaultdict(lambda: {"requests": 0, "connections": 0, "reused": 0})
+
+    def _trace_config(self) -> TraceConfig:
+        """
+        Counts requests, new connections and reused connections per host and
+        records latency, status and body bytes
+        """
+        async def on_request_start(_, ctx:SimpleNamespace, params):
+            ctx.host = params.url.host
+            ctx.started = time.perf_counter()
+            self._stats[ctx.host]["requests"] += 1
+
+        async def on_request_end(_, ctx:SimpleNamespace, params):
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - ctx.started, host=ctx.host, method=params.method, status=params.response.status
+            )
+
+        async def on_request_exception(_, ctx:SimpleNamespace, params):
+            REQUEST_SECONDS.observe(time.perf_counter() - ctx.started, host=ctx.host, method=params.method, status="error")
+
+        async def on_request_chunk_sent(_, ctx:SimpleNamespace, params):
+            SENT_BYTES.inc(len(params.chunk), host=ctx.host)
+
+        async def on_response_chunk_received(_, ctx:SimpleNamespace, params):
+            RECEIVED_BYTES.inc(len(params.chunk), host=ctx.host)
+
+        async def on_connection_create_end(_, ctx:SimpleNamespace, __):
+            self._stats[ctx.host]["connections"] += 1
+
+        async def on_connection_reuseconn(_, ctx:SimpleNamespace, __):
+            self._stats[ctx.host]["reused"] += 1
+
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        if registry.enabled:
+            trace_config.on_request_end.append(on_request_end)
+            trace_config.on_request_exception.append(on_request_exception)
+            trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+            trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def _create_session(self, name:str) -> ClientSession:
+        """
+        Creates the pooled session for the given upstream group
+        """
+        if name == "docker":
+            if self.docker_socket:
+                connector = UnixConnector(path=self.docker_socket, limit=env.DOCKER_POOL_LIMIT)
+            else:
+                connector = TCPConnector(limit=env.DOCKER_POOL_LIMIT, keepalive_timeout=env.HTTP_KEEPALIVE_TIMEOUT)
+            # Pulls, builds and log tails may stream for minutes
+            timeout = ClientTimeout(total=None, sock_connect=env.HTTP_CONNECT_TIMEOUT)
+        else:
+            connector = TCPConnector(
+                limit=env.HTTP_POOL_LIMIT,
+                limit_per_host=env.HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=env.HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=env.HTTP_KEEPALIVE_TIMEOUT
+            )
+            timeout = ClientTimeout(total=env.HTTP_TIMEOUT, sock_connect=env.HTTP_CONNECT_TIMEOUT)
+        return ClientSession(connector=connector, timeout=timeout, trace_configs=[self._trace_config()])
+
+    def _group(self, url:str) -> str:
+        return "docker" if url.startswith(self.docker_urls) else "default"
+
+    def session(self, url:str) -> ClientSession:
+        """
+        Returns the long lived session that serves the given URL, opening it on first use
+        """
+        name = self._group(url)
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._sessions[name] = self._create_session(name)
+        return session
+
+    async def startup(self, *_:A) -> None:
+        """
+        Opens the pooled sessions, meant to run on application startup
+        """
+        self.session(self.docker_urls[0])
+        self.session("")
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Closes the pooled sessions, meant to run on application shutdown
+        """
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def stats(self) -> D[str,D[str,int]]:
+        """
+        Connection reuse statistics per upstream host
+        """
+        return {host: dict(counters) for host, counters in self._stats.items()}
+
+    @asynccontextmanager
+    async def request(self,
         url:str,
         method:str="GET",
         headers:O[D[str,str]]=None,
         data:O[D[str,A]]=None
-    ) -> A:
+    ) -> AI[ClientResponse]:
         """
-        Generic function to retrieve data from an URL in json format
+        Request core shared by every response format
         """
         if method in ["GET","DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    return await response.json()
+            kwargs = {}
         elif method in ["POST","PUT","PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers, json=data) as response:
-                    return await response.json()
+            kwargs = {"json": data}
         else:
             raise ValueError("Invalid method")
-   
+        parent = traceparent() if self._group(url) in self.traced else None
+        if parent is not None:
+            headers = {**(headers or {}), "traceparent": parent}
+        async with self.session(url).request(method, url, headers=headers, **kwargs) as response:
+            yield response
+
+    async def fetch(self,
+        url:str,
+        method:str="GET",
+        headers:O[D[str,str]]=None,
+        data:O[D[str,A]]=None
+    ) -> A:
+        """
+        Generic function to retrieve data from an URL in json format
+        """
+        async with self.request(url, method, headers, data) as response:
+            return await response.json()
+
     async def text(self,
         url:str,
         method:str="GET",
@@ -40,18 +223,10 @@ class APIClient:
         """
         Generic function to retrieve data from an URL in text format
         """
-        if method in ["GET","DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    return await response.text()
-        elif method in ["POST","PUT","PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers, json=data) as response:
-                    return await response.text()
-        else:
-            raise ValueError("Invalid method")
-    
-    
+        async with self.request(url, method, headers, data) as response:
+            return await response.text()
+
+
     async def blob(self,
         url:str,
         method:str="GET",
@@ -61,19 +236,11 @@ class APIClient:
         """
         Generic function to retrieve data from an URL in binary format
         """
-        if method in ["GET","DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    return await response.read()
-        elif method in ["POST","PUT","PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers, json=data) as response:
-                    return await response.read()
-        else:
-            raise ValueError("Invalid method")
+        async with self.request(url, method, headers, data) as response:
+            return await response.read()
 
     async def stream(self,
-        url:str,  
+        url:str,
         method:str="GET",
         headers:O[D[str,str]]=None,
         data:O[D[str,A]]=None
@@ -81,15 +248,40 @@ class APIClient:
         """
         Generic function to retrieve data from an URL in streaming format
         """
-        if method in ["GET","DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    async for chunk in response.content.iter_chunked(1024):
-                        yield chunk.decode("utf-8")
-        elif method in ["POST","PUT","PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers, json=data) as response:
-                    async for chunk in response.content.iter_chunked(1024):
-                        yield chunk.decode("utf-8")
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        async with self.request(url, method, headers, data) as response:
+            async for chunk in response.content.iter_chunked(1024):
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+            text = decoder.decode(b"", final=True)
+            if text:
+                yield text
+
+    async def ndjson(self,
+        url:str,
+        method:str="GET",
+        headers:O[D[str,str]]=None,
+        data:O[D[str,A]]=None
+    ) -> AG[D[str,A], None]:
+        """
+        Generic function to retrieve whole messages from a newline delimited JSON stream,
+        error responses are yielded as a single Docker style error message
+        """
+        async with self.request(url, method, headers, data) as response:
+            if response.status >= 400:
+                body = await response.text()
+                try:
+                    error = json.loads(body).get("message", body)
+                except (ValueError, AttributeError):
+                    error = body
+                yield {"error": error, "errorDetail": {"code": response.status, "message": error}}
+                return
+            decoder = NDJSONDecoder()
+            async for chunk in response.content.iter_any():
+                for message in decoder.feed(chunk):
+                    yield message
+            for message in decoder.close():
+                yield message
 
-client = APIClient()
+client = APIClient(docker_socket=env.DOCKER_SOCKET)
@@ -1,8 +1,24 @@
 """
 Configuration
 """
+from typing import Optional as O, Dict as D, List as L, Tuple as T
 from pydantic import BaseConfig, BaseSettings, Field
 
+class ConfigError(Exception):
+    """
+    Raised when a subsystem is used without the settings it needs
+    """
+
+# Settings each subsystem needs, checked when the subsystem is first used so a
+# missing one only disables its own subsystem
+REQUIRED:D[str,T[str,...]] = {
+    "fauna": ("FAUNA_SECRET",),
+    "redis": ("REDIS_HOST", "REDIS_PORT"),
+    "storage": ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_S3_BUCKET"),
+    "auth": ("AUTH0_DOMAIN",),
+    "dns": ("CF_API_KEY", "CF_EMAIL", "CF_ZONE_ID", "IP_ADDR"),
+}
+
 class Env(BaseSettings): # pylint: disable=too-few-public-methods
     """
     Environment variables
@@ -15,32 +31,109 @@ class Env(BaseSettings): # pylint: disable=too-few-public-methods
         env_file_encoding = "utf-8"
         case_sensitive = True
 
-    FAUNA_SECRET: str = Field(..., env="FAUNA_SECRET")
-    API_KEY: str = Field(..., env="API_KEY")
-    GITHUB_TOKEN: str = Field(..., env="GITHUB_TOKEN")
-    AUTH0_DOMAIN: str = Field(..., env="AUTH0_DOMAIN")
-    REDIS_PASSWORD: str = Field(..., env="REDIS_PASSWORD")
-    REDIS_HOST: str = Field(..., env="REDIS_HOST")
-    REDIS_PORT: int = Field(..., env="REDIS_PORT")
-    REDIS_USER: str = Field(..., env="REDIS_USER")
-    AWS_ACCESS_KEY_ID: str = Field(..., env="AWS_ACCESS_KEY_ID")
-    AWS_SECRET_ACCESS_KEY: str = Field(..., env="AWS_SECRET_ACCESS_KEY")
-    AWS_S3_BUCKET: str = Field(..., env="AWS_S3_BUCKET")
-    AWS_S3_ENDPOINT: str = Field(..., env="AWS_S3_ENDPOINT")
-    CF_API_KEY: str = Field(..., env="CF_API_KEY")
-    CF_EMAIL: str = Field(..., env="CF_EMAIL")
-    CF_ZONE_ID: str = Field(..., env="CF_ZONE_ID")
-    CF_ACCOUNT_ID: str = Field(..., env="CF_ACCOUNT_ID")
-    IP_ADDR: str = Field(..., env="IP_ADDR")
+    FAUNA_SECRET: O[str] = Field(None, env="FAUNA_SECRET")
+    API_KEY: O[str] = Field(None, env="API_KEY")
+    GITHUB_TOKEN: O[str] = Field(None, env="GITHUB_TOKEN")
+    AUTH0_DOMAIN: O[str] = Field(None, env="AUTH0_DOMAIN")
+    REDIS_PASSWORD: O[str] = Field(None, env="REDIS_PASSWORD")
+    REDIS_HOST: O[str] = Field(None, env="REDIS_HOST")
+    REDIS_PORT: O[int] = Field(None, env="REDIS_PORT")
+    REDIS_USER: O[str] = Field(None, env="REDIS_USER")
+    AWS_ACCESS_KEY_ID: O[str] = Field(None, env="AWS_ACCESS_KEY_ID")
+    AWS_SECRET_ACCESS_KEY: O[str] = Field(None, env="AWS_SECRET_ACCESS_KEY")
+    AWS_S3_BUCKET: O[str] = Field(None, env="AWS_S3_BUCKET")
+    AWS_S3_ENDPOINT: O[str] = Field(None, env="AWS_S3_ENDPOINT")
+    CF_API_KEY: O[str] = Field(None, env="CF_API_KEY")
+    CF_EMAIL: O[str] = Field(None, env="CF_EMAIL")
+    CF_ZONE_ID: O[str] = Field(None, env="CF_ZONE_ID")
+    CF_ACCOUNT_ID: O[str] = Field(None, env="CF_ACCOUNT_ID")
+    IP_ADDR: O[str] = Field(None, env="IP_ADDR")
+    HTTP_POOL_LIMIT: int = Field(100, env="HTTP_POOL_LIMIT")
+    HTTP_POOL_LIMIT_PER_HOST: int = Field(20, env="HTTP_POOL_LIMIT_PER_HOST")
+    HTTP_DNS_CACHE_TTL: int = Field(300, env="HTTP_DNS_CACHE_TTL")
+    HTTP_KEEPALIVE_TIMEOUT: float = Field(30, env="HTTP_KEEPALIVE_TIMEOUT")
+    HTTP_TIMEOUT: float = Field(60, env="HTTP_TIMEOUT")
+    HTTP_CONNECT_TIMEOUT: float = Field(10, env="HTTP_CONNECT_TIMEOUT")
+    DOCKER_POOL_LIMIT: int = Field(50, env="DOCKER_POOL_LIMIT")
+    DOCKER_SOCKET: O[str] = Field(None, env="DOCKER_SOCKET")
+    DOCKER_HOSTS: str = Field("http://localhost:9898", env="DOCKER_HOSTS")
+    DOCKER_SAMPLE_INTERVAL: float = Field(15, env="DOCKER_SAMPLE_INTERVAL")
+    DOCKER_LOCALITY_BONUS: float = Field(0.25, env="DOCKER_LOCALITY_BONUS")
+    CONTAINER_WATCH_BUFFER: int = Field(64, env="CONTAINER_WATCH_BUFFER", gt=0)
+    LOG_BUFFER: int = Field(256, env="LOG_BUFFER", gt=0)
+    LOG_TAIL: int = Field(100, env="LOG_TAIL", ge=0)
+    LOG_MAX_CONTAINERS: int = Field(20, env="LOG_MAX_CONTAINERS", gt=0)
+    DOCKER_PULL_SSE_INTERVAL: float = Field(0.25, env="DOCKER_PULL_SSE_INTERVAL")
+    DOCKER_PULL_SUBSCRIBER_BUFFER: int = Field(8, env="DOCKER_PULL_SUBSCRIBER_BUFFER", gt=0)
+    UPLOAD_PART_SIZE: int = Field(8 * 1024 * 1024, env="UPLOAD_PART_SIZE", ge=5 * 1024 * 1024)
+    UPLOAD_CONCURRENCY: int = Field(4, env="UPLOAD_CONCURRENCY", gt=0)
+    NGINX_BIN: str = Field("nginx", env="NGINX_BIN")
+    NGINX_CONF_DIRS: str = Field("/etc/nginx/conf.d,/etc/nginx/sites-enabled,/etc/nginx/sites-available", env="NGINX_CONF_DIRS")
+    NGINX_RELOAD_DEBOUNCE: float = Field(0.5, env="NGINX_RELOAD_DEBOUNCE")
+    TEMPLATES_DIR: str = Field("templates", env="TEMPLATES_DIR")
+    PORT_RANGE_START: int = Field(20000, env="PORT_RANGE_START", gt=0)
+    PORT_RANGE_END: int = Field(29999, env="PORT_RANGE_END", lt=65536)
+    PORT_LEASE_GRACE: float = Field(300, env="PORT_LEASE_GRACE")
+    PORT_RECLAIM_INTERVAL: float = Field(60, env="PORT_RECLAIM_INTERVAL")
+    JOB_WORKERS: int = Field(4, env="JOB_WORKERS", gt=0)
+    JOB_TTL: int = Field(7 * 24 * 3600, env="JOB_TTL")
+    S3_MAX_POOL_CONNECTIONS: int = Field(50, env="S3_MAX_POOL_CONNECTIONS", gt=0)
+    PRESIGN_EXPIRES: int = Field(7 * 24 * 3600, env="PRESIGN_EXPIRES", gt=0, le=7 * 24 * 3600)
+    PRESIGN_CACHE_TTL: int = Field(24 * 3600, env="PRESIGN_CACHE_TTL", gt=0)
+    DOWNLOAD_CHUNK_SIZE: int = Field(256 * 1024, env="DOWNLOAD_CHUNK_SIZE", gt=0)
+    CONTENT_CACHE_DIR: str = Field(".cache/content", env="CONTENT_CACHE_DIR")
+    CONTENT_CACHE_SIZE: int = Field(1024 ** 3, env="CONTENT_CACHE_SIZE", ge=0)
+    CONTENT_CACHE_MAX_OBJECT: int = Field(64 * 1024 ** 2, env="CONTENT_CACHE_MAX_OBJECT", gt=0)
+    CONTENT_CACHE_MIN_HITS: int = Field(2, env="CONTENT_CACHE_MIN_HITS", gt=0)
+    CF_RATE_LIMIT: float = Field(4, env="CF_RATE_LIMIT", gt=0)
+    CF_BURST: int = Field(10, env="CF_BURST", gt=0)
+    CF_RETRIES: int = Field(5, env="CF_RETRIES", ge=0)
+    DNS_BATCH_WINDOW: float = Field(0.2, env="DNS_BATCH_WINDOW")
+    DNS_BATCH_SIZE: int = Field(100, env="DNS_BATCH_SIZE", gt=0)
+    DNS_REFRESH_INTERVAL: float = Field(900, env="DNS_REFRESH_INTERVAL")
+    DNS_PRUNE_GRACE: float = Field(1800, env="DNS_PRUNE_GRACE")
+    DNS_RECORD_COMMENT: str = Field("kubectl", env="DNS_RECORD_COMMENT")
+    AUTH0_AUDIENCE: O[str] = Field(None, env="AUTH0_AUDIENCE")
+    JWKS_REFRESH_INTERVAL: float = Field(3600, env="JWKS_REFRESH_INTERVAL")
+    JWKS_MIN_REFRESH: float = Field(60, env="JWKS_MIN_REFRESH")
+    AUTH_CACHE_SIZE: int = Field(4096, env="AUTH_CACHE_SIZE", gt=0)
+    METRICS_ENABLED: bool = Field(True, env="METRICS_ENABLED")
+    TRACING_ENABLED: bool = Field(False, env="TRACING_ENABLED")
+    TRACE_KEEP: int = Field(256, env="TRACE_KEEP", gt=0)
+    SSH_KEY_POOL_SIZE: int = Field(8, env="SSH_KEY_POOL_SIZE", ge=0)
+    SSH_KEY_WORKERS: int = Field(2, env="SSH_KEY_WORKERS", gt=0)
+    IDLE_TIMEOUT: float = Field(0, env="IDLE_TIMEOUT", ge=0)
+    IDLE_CHECK_INTERVAL: float = Field(60, env="IDLE_CHECK_INTERVAL", gt=0)
+    IDLE_BEACON: str = Field("127.0.0.1:5140", env="IDLE_BEACON")
+    WAKE_UPSTREAM: str = Field("127.0.0.1:5141", env="WAKE_UPSTREAM")
+    WAKE_TIMEOUT: float = Field(60, env="WAKE_TIMEOUT", gt=0)
      
     def __init__(self, **data): # pylint: disable=useless-super-delegation
         super().__init__(**data)
 
+    def missing(self, subsystem:str) -> L[str]:
+        """Settings of a subsystem that are not set"""
+        return [name for name in REQUIRED[subsystem] if getattr(self, name) in (None, "")]
+
+    def configured(self, subsystem:str) -> bool:
+        """Whether every setting of a subsystem is set"""
+        return not self.missing(subsystem)
+
+    def require(self, subsystem:str) -> None:
+        """
+        Raises `ConfigError` naming the missing settings of a subsystem, if any
+        """
+        missing = self.missing(subsystem)
+        if missing:
+            raise ConfigError(f"{subsystem} is not configured, set {', '.join(missing)}")
+
 env = Env()
 
 # API Endpoints
 
-DOCKER_URL = "http://localhost:9898"
+DOCKER_HOSTS = [url.strip().rstrip("/") for url in env.DOCKER_HOSTS.split(",") if url.strip()]
+
+DOCKER_URL = DOCKER_HOSTS[0]
 
 GITHUB_URL = "https://api.github.com"   
 
@@ -48,14 +141,20 @@ CLOUDFLARE_URL = "https://api.cloudflare.com/client/v4"
 
 # API Headers
 
+# Public repositories are readable without a token, at a lower rate limit
 GITHUB_HEADERS = {
     "Accept": "application/vnd.github.v3+json",
-    "Authorization": f"token {env.GITHUB_TOKEN}",
+    **({"Authorization": f"token {env.GITHUB_TOKEN}"} if env.GITHUB_TOKEN else {}),
     "Content-Type": "application/json"
 }
 
-CLOUDFLARE_HEADERS = {
-    "X-Auth-Email": env.CF_EMAIL,
-    "X-Auth-Key": env.CF_API_KEY,
-    "Content-Type": "application/json"
-}
+def cloudflare_headers() -> D[str,str]:
+    """
+    Cloudflare API headers, raises `ConfigError` when the credentials are not set
+    """
+    env.require("dns")
+    return {
+        "X-Auth-Email": env.CF_EMAIL,
+        "X-Auth-Key": env.CF_API_KEY,
+        "Content-Type": "application/json"
+    }
@@ -0,0 +1,266 @@
+"""
+Upload Content
+"""
+
+import os
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional as O, Dict as D, List as L, Tuple as T, Any as A
+from aiohttp import web
+from kubectl.config import env
+from kubectl.storage import storage
+from kubectl.decorators import cache
+from kubectl.models import Upload
+
+# Objects whose reads are counted towards admission, least recent dropped first
+TRACKED_OBJECTS = 4096
+# Seconds an evicted file stays on disk, file responses open it after the handler returned
+EVICTION_GRACE = 30.0
+
+@cache(ttl=3600)
+async def describe_upload(ref:str) -> O[D[str,A]]:
+    """
+    Key, type, size and modification time of an upload, None when it does not exist.
+    Upload documents never change, so they are cached until deleted
+    """
+    upload = await Upload.find(ref)
+    if not isinstance(upload, Upload):
+        return None
+    return {"key": upload.key, "type": upload.type, "size": upload.size, "lastModified": upload.lastModified}
+
+def _byte_range(request:web.Request, size:int) -> O[T[int,int]]:
+    """
+    First and last byte of the single range asked for, None for the whole object.
+    Raises `web.HTTPRequestRangeNotSatisfiable` for ranges outside the object
+    """
+    try:
+        requested = request.http_range
+    except ValueError as exc:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{size}"}) from exc
+    if requested.start is None and requested.stop is None:
+        return None
+    start, stop, _ = requested.indices(size)
+    if start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{size}"})
+    return start, stop - 1
+
+class ContentCache:
+    """
+
+    Size bounded local disk cache of hot upload objects
+
+    Objects are streamed from S3 in `chunk_size` chunks until they were asked for
+    `min_hits` times, then a single background download stores them on disk and
+    later reads are answered with sendfile, ranges included. The least recently
+    served objects are evicted once the cache grows past `capacity` bytes, objects
+    larger than `max_object` are never stored.
+
+    """
+    def __init__(self,
+        directory:str=env.CONTENT_CACHE_DIR,
+        capacity:int=env.CONTENT_CACHE_SIZE,
+        max_object:int=env.CONTENT_CACHE_MAX_OBJECT,
+        min_hits:int=env.CONTENT_CACHE_MIN_HITS,
+        chunk_size:int=env.DOWNLOAD_CHUNK_SIZE
+    ):
+        self.directory = directory
+        self.capacity = capacity
+        self.max_object = max_object
+        self.min_hits = min_hits
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._entries:"OrderedDict[str,int]" = OrderedDict()
+        self._hits:"OrderedDict[str,int]" = OrderedDict()
+        self._fills:D[str,asyncio.Task] = {}
+        self.stats:D[str,int] = {"hits": 0, "misses": 0, "fills": 0, "evictions": 0, "errors": 0}
+
+    @staticmethod
+    def name(upload:D[str,A]) -> str:
+        """Cache file name of an upload, a new upload under the same key gets a new file"""
+        return hashlib.blake2b(f"{upload['key']}:{upload['lastModified']}".encode(), digest_size=16).hexdigest()
+
+    def path(self, name:str) -> str:
+        """Cache file of an entry"""
+        return os.path.join(self.directory, name)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether objects are stored on disk at all"""
+        return self.capacity > 0
+
+    def _scan(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self.size += size
+        for name in self._evict():
+            self._unlink(name)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Indexes the objects kept by a previous run, meant to run on application startup
+        """
+        if self.enabled:
+            await asyncio.get_running_loop().run_in_executor(None, self._scan)
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the pending downloads, meant to run on application shutdown
+        """
+        for task in self._fills.values():
+            task.cancel()
+        await asyncio.gather(*self._fills.values(), return_exceptions=True)
+        self._fills.clear()
+
+    def lookup(self, name:str) -> O[str]:
+        """
+        Cache file of an entry if it is stored, marking it as recently used
+        """
+        if name not in self._entries:
+            return None
+        self._entries.move_to_end(name)
+        return self.path(name)
+
+    def _evict(self) -> L[str]:
+        evicted = []
+        while self.size > self.capacity and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.stats["evictions"] += 1
+            evicted.append(name)
+        return evicted
+
+    def _unlink(self, name:str) -> None:
+        if name in self._entries:
+            return # stored again since
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def _remove_later(self, names:L[str]) -> None:
+        loop = asyncio.get_running_loop()
+        for name in names:
+            loop.call_later(EVICTION_GRACE, self._unlink, name)
+
+    def discard(self, upload:D[str,A]) -> None:
+        """
+        Drops the stored copy of an upload
+        """
+        name = self.name(upload)
+        self._hits.pop(name, None)
+        fill = self._fills.get(name)
+        if fill is not None:
+            fill.cancel()
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self.size -= size
+            self._remove_later([name])
+
+    def _admit(self, name:str, upload:D[str,A]) -> None:
+        """
+        Counts a read served from S3 and starts storing the object once it is hot
+        """
+        if not self.enabled or upload["size"] > self.max_object or name in self._fills:
+            return
+        hits = self._hits.pop(name, 0) + 1
+        if hits < self.min_hits:
+            self._hits[name] = hits
+            while len(self._hits) > TRACKED_OBJECTS:
+                self._hits.popitem(last=False)
+            return
+        task = self._fills[name] = asyncio.create_task(self._fill(name, upload["key"]))
+        task.add_done_callback(lambda _: self._fills.pop(name, None))
+
+    @staticmethod
+    def _remove_tmp(path:str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def _fill(self, name:str, key:str) -> None:
+        loop = asyncio.get_running_loop()
+        tmp = self.path(f"{name}.tmp")
+        size = 0
+        stored = False
+        try:
+            await loop.run_in_executor(None, lambda: os.makedirs(self.directory, exist_ok=True))
+            response = await storage.get(key)
+            try:
+                file_ = await loop.run_in_executor(None, open, tmp, "wb")
+                try:
+                    chunk = await response["Body"].read(self.chunk_size)
+                    while chunk:
+                        size += len(chunk)
+                        await loop.run_in_executor(None, file_.write, chunk)
+                        chunk = await response["Body"].read(self.chunk_size)
+                finally:
+                    await loop.run_in_executor(None, file_.close)
+            finally:
+                response["Body"].close()
+            await loop.run_in_executor(None, os.replace, tmp, self.path(name))
+            stored = True
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Caching %s failed: %s", key, exc)
+            self.stats["errors"] += 1
+            return
+        finally:
+            # Also runs when the fill is cancelled, which no except clause above catches
+            if not stored:
+                await loop.run_in_executor(None, self._remove_tmp, tmp)
+        self._entries[name] = size
+        self.size += size
+        self.stats["fills"] += 1
+        self._remove_later(self._evict())
+
+    async def _stream(self, request:web.Request, upload:D[str,A], byte_range:O[T[int,int]]) -> web.StreamResponse:
+        headers = {"Accept-Ranges": "bytes", "Content-Type": upload["type"]}
+        if request.method == "HEAD":
+            return web.Response(headers={**headers, "Content-Length": str(upload["size"])})
+        range_ = f"bytes={byte_range[0]}-{byte_range[1]}" if byte_range else None
+        response = await storage.get(upload["key"], range_)
+        body = response["Body"]
+        try:
+            if response.get("ContentRange"):
+                headers["Content-Range"] = response["ContentRange"]
+            if response.get("ETag"):
+                headers["ETag"] = response["ETag"]
+            stream = web.StreamResponse(status=206 if range_ else 200, headers=headers)
+            stream.content_length = response["ContentLength"]
+            await stream.prepare(request)
+            chunk = await body.read(self.chunk_size)
+            while chunk:
+                await stream.write(chunk)
+                chunk = await body.read(self.chunk_size)
+            await stream.write_eof()
+            return stream
+        finally:
+            body.close()
+
+    async def serve(self, request:web.Request, upload:D[str,A]) -> web.StreamResponse:
+        """
+        Answers a download of an upload, from disk when stored and from S3 otherwise
+        """
+        byte_range = _byte_range(request, upload["size"])
+        name = self.name(upload)
+        path = self.lookup(name)
+        if path is not None:
+            self.stats["hits"] += 1
+            return web.FileResponse(path, chunk_size=self.chunk_size, headers={"Content-Type": upload["type"]})
+        self.stats["misses"] += 1
+        self._admit(name, upload)
+        return await self._stream(request, upload, byte_range)
+
+content = ContentCache()
@@ -4,30 +4,240 @@ Non-handler functions decorators
 
 """
 import json
-import base64
-import aioredis
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+from functools import wraps
+from collections import OrderedDict
+from typing import Optional as O, Dict as D, Tuple as T, Any as A
 from kubectl.config import env
+from kubectl.services import service
 
-redis = aioredis.from_url(
+@service("redis", "redis")
+def redis():
+    """Redis client decoding replies as text"""
+    import aioredis # pylint: disable=import-outside-toplevel
+    return aioredis.from_url(
         F"redis://{env.REDIS_HOST}:{env.REDIS_PORT}",
         password=env.REDIS_PASSWORD,
         encoding="utf-8",
         decode_responses=True,db=0)
 
-def cache(ttl:int=3600):
+@service("redis_bytes", "redis")
+def redis_bytes():
+    """Binary client for cached values, which may be compressed"""
+    import aioredis # pylint: disable=import-outside-toplevel
+    return aioredis.from_url(
+        F"redis://{env.REDIS_HOST}:{env.REDIS_PORT}",
+        password=env.REDIS_PASSWORD,
+        decode_responses=False,db=0)
+
+caches:D[str,"Cache"] = {}
+
+def _default(obj:A) -> A:
+    if hasattr(obj, "dict"):
+        return obj.dict()
+    return str(obj)
+
+class Cache:
     """
-    
-    Stores the results of a given function within a ttl frame on redis
-    
+
+    Two tier cache of a single function
+
+    An in-process LRU with TTL sits in front of Redis, concurrent misses of the
+    same key share one computation and values are stored as JSON, optionally
+    zlib compressed in Redis. Both tiers keep the JSON, so every caller gets
+    its own decoded copy, the same from either tier. When Redis fails or is
+    not configured, values are computed and kept in process only.
+
     """
-    def decorator(func):    
-        async def wrapper(*args, **kwargs)->str:
-            key = base64.b64encode(f"{func.__name__}{args}{kwargs}".encode("utf-8")).decode("utf-8")
-            cached = await redis.get(key)
-            if cached:
-                return json.loads(cached)
-            result = await func(*args, **kwargs)
-            await redis.set(key,json.dumps(result),ex=ttl)
-            return result
+    def __init__(self, name:str, ttl:int, maxsize:int, local_ttl:float, compress:bool):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl
+        self.compress = compress
+        self._local:"OrderedDict[str,T[float,bytes]]" = OrderedDict()
+        self._inflight:D[str,asyncio.Future] = {}
+        self.counters = {"local_hits": 0, "remote_hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+        self.latency = {"local_hits": 0.0, "remote_hits": 0.0, "misses": 0.0}
+
+    def key(self, args:tuple, kwargs:dict) -> str:
+        """
+        Fixed length key of a call
+        """
+        payload = json.dumps([args, kwargs], sort_keys=True, default=_default, separators=(",", ":"))
+        return f"cache:{self.name}:{hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()}"
+
+    def pack(self, data:bytes) -> bytes:
+        """
+        Redis representation of a JSON encoded value
+        """
+        if self.compress:
+            return b"z" + zlib.compress(data)
+        return b"j" + data
+
+    @staticmethod
+    def unpack(stored:bytes) -> bytes:
+        """
+        JSON encoded value of a Redis representation made by `pack`
+        """
+        if stored[:1] == b"z":
+            return zlib.decompress(stored[1:])
+        return stored[1:]
+
+    def dumps(self, value:A) -> bytes:
+        """
+        Serializes a value for Redis
+        """
+        return self.pack(json.dumps(value, default=_default).encode("utf-8"))
+
+    @classmethod
+    def loads(cls, stored:bytes) -> A:
+        """
+        Deserializes a value stored by `dumps`
+        """
+        return json.loads(cls.unpack(stored))
+
+    def _get_local(self, key:str) -> O[bytes]:
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return entry[1]
+
+    def _set_local(self, key:str, data:bytes) -> None:
+        self._local[key] = (time.monotonic() + self.local_ttl, data)
+        self._local.move_to_end(key)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+    def _record(self, outcome:str, started:float) -> None:
+        self.counters[outcome] += 1
+        self.latency[outcome] += time.perf_counter() - started
+
+    async def _remote(self, command:str, *args:A, **kwargs:A) -> A:
+        """
+        Runs a command on the Redis tier, None when Redis is not configured or the command failed
+        """
+        if not redis_bytes.configured:
+            return None
+        try:
+            return await getattr(redis_bytes, command)(*args, **kwargs)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Cache %s failed for %s: %s", command, self.name, exc)
+            self.counters["errors"] += 1
+            return None
+
+    async def _load(self, key:str, func, args:tuple, kwargs:dict) -> bytes:
+        """
+        JSON encoded result of the call, from Redis or computed and stored in both tiers
+        """
+        started = time.perf_counter()
+        cached = await self._remote("get", key)
+        if cached:
+            data = self.unpack(cached)
+            self._set_local(key, data)
+            self._record("remote_hits", started)
+            return data
+        data = json.dumps(await func(*args, **kwargs), default=_default).encode("utf-8")
+        await self._remote("set", key, self.pack(data), ex=self.ttl)
+        self._set_local(key, data)
+        self._record("misses", started)
+        return data
+
+    async def get(self, func, args:tuple, kwargs:dict) -> A:
+        """
+        Returns the cached result of the call as decoded JSON, computing it once on a miss
+        """
+        started = time.perf_counter()
+        key = self.key(args, kwargs)
+        data = self._get_local(key)
+        if data is not None:
+            self._record("local_hits", started)
+            return json.loads(data)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+        else:
+            # The load runs on its own, a cancelled caller does not fail the others waiting for it
+            task = self._inflight[key] = asyncio.ensure_future(self._load(key, func, args, kwargs))
+            task.add_done_callback(lambda done: self._loaded(key, done))
+        return json.loads(await asyncio.shield(task))
+
+    def _loaded(self, key:str, task:asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception() # retrieved by the callers, if any are left
+
+    async def invalidate(self, args:tuple, kwargs:dict) -> None:
+        """
+        Drops the cached result of a single call. Other processes keep serving
+        their local copy for at most `local_ttl` seconds
+        """
+        key = self.key(args, kwargs)
+        self._local.pop(key, None)
+        await self._remote("delete", key)
+
+    async def clear(self) -> None:
+        """
+        Drops every cached result of the function
+        """
+        self._local.clear()
+        if not redis_bytes.configured:
+            return
+        try:
+            keys = [key async for key in redis_bytes.scan_iter(match=f"cache:{self.name}:*")]
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Cache scan failed for %s: %s", self.name, exc)
+            self.counters["errors"] += 1
+            return
+        if keys:
+            await self._remote("delete", *keys)
+
+    def stats(self) -> D[str,A]:
+        """
+        Hit, miss and latency counters
+        """
+        return {**self.counters, "latency": dict(self.latency), "size": len(self._local)}
+
+def cache(ttl:int=3600, maxsize:int=1024, local_ttl:O[float]=None, compress:bool=False):
+    """
+
+    Stores the results of a given function within a ttl frame on redis, with an
+    in-process copy kept for `local_ttl` seconds (at most 60 by default).
+    Results come back as decoded JSON, models as dicts and tuples as lists, and
+    an invalidation reaches the local copies of other processes only once they
+    expire, `local_ttl` bounds how stale those can be.
+
+    The wrapper exposes `invalidate(*args, **kwargs)`, `clear()` and `stats()`.
+
+    """
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+        layer = caches[name] = Cache(name, ttl, maxsize, local_ttl if local_ttl is not None else min(ttl, 60), compress)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await layer.get(func, args, kwargs)
+
+        async def invalidate(*args, **kwargs):
+            await layer.invalidate(args, kwargs)
+
+        wrapper.invalidate = invalidate # type: ignore
+        wrapper.clear = layer.clear # type: ignore
+        wrapper.stats = layer.stats # type: ignore
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def cache_stats() -> D[str,D[str,A]]:
+    """
+    Counters of every cached function
+    """
+    return {name: layer.stats() for name, layer in caches.items()}
@@ -0,0 +1,366 @@
+"""
+Cloudflare DNS Records
+"""
+
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional as O, Dict as D, List as L, Set as S, Tuple as T, Any as A
+from aiohttp import ClientError
+from kubectl.config import env, cloudflare_headers, CLOUDFLARE_URL
+from kubectl.client import client
+from kubectl.state import containers, DEPLOYMENT_LABEL
+
+class DNSError(Exception):
+    """
+    Raised when Cloudflare rejects a call or keeps rate limiting it
+    """
+
+class TokenBucket:
+    """
+
+    Token bucket rate limiter
+
+    Holds up to `burst` tokens refilled at `rate` tokens per second, a `429`
+    pauses every caller until the server says calls are welcome again.
+
+    """
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock:O[asyncio.Lock] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """
+        Waits for a token
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds:float) -> None:
+        """
+        Holds every caller back for the given time and empties the bucket
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+def _timestamp(value:O[str]) -> float:
+    if not value:
+        return 0.0
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+
+class DNSManager:
+    """
+
+    A records of the deployments
+
+    The zone records are loaded once, page by page, and kept up to date with
+    the result of every write, so creating a record that already exists or
+    removing one that does not costs no API call. Changes made within
+    `DNS_BATCH_WINDOW` seconds are sent together to the batch endpoint, every
+    call goes through a token bucket and is retried with backoff when rate
+    limited. Records of removed deployments are deleted as their containers
+    go away, and periodically for any that were missed.
+
+    Cloudflare has no listing of the records changed since a given time, so
+    every `DNS_REFRESH_INTERVAL` seconds the zone is reloaded in full to pick
+    up changes made outside this process. Between reloads the cache is only
+    updated by the writes made here.
+
+    """
+    def __init__(self,
+        zone:str=env.CF_ZONE_ID,
+        content:str=env.IP_ADDR,
+        rate:float=env.CF_RATE_LIMIT,
+        burst:int=env.CF_BURST,
+        retries:int=env.CF_RETRIES,
+        window:float=env.DNS_BATCH_WINDOW,
+        batch_size:int=env.DNS_BATCH_SIZE,
+        interval:float=env.DNS_REFRESH_INTERVAL,
+        grace:float=env.DNS_PRUNE_GRACE,
+        comment:str=env.DNS_RECORD_COMMENT
+    ):
+        self.zone = zone
+        self.content = content
+        self.retries = retries
+        self.window = window
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace = grace
+        self.comment = comment
+        self.bucket = TokenBucket(rate, burst)
+        self.zone_name:O[str] = None
+        self.records:D[str,D[str,A]] = {}
+        self._loading:O[asyncio.Future] = None
+        self._pending:D[str,T[O[D[str,A]],L[asyncio.Future]]] = {}
+        self._timer:O[asyncio.Task] = None
+        self._lock:O[asyncio.Lock] = None
+        self._tasks:L[asyncio.Task] = []
+        self.stats:D[str,int] = {"calls": 0, "retries": 0, "batches": 0, "skipped": 0, "created": 0, "updated": 0, "deleted": 0}
+
+    async def _call(self, method:str, path:str, data:O[D[str,A]]=None) -> D[str,A]:
+        """
+        Cloudflare API call through the rate limiter, retried on `429`, `5xx` and network errors
+        """
+        headers = cloudflare_headers()
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            self.stats["calls"] += 1
+            delay:O[float] = None
+            try:
+                async with client.request(f"{CLOUDFLARE_URL}{path}", method, headers, data) as response:
+                    if response.status == 429 or response.status >= 500:
+                        delay = float(response.headers.get("Retry-After") or 2 ** attempt)
+                        if response.status == 429:
+                            self.bucket.pause(delay)
+                    else:
+                        payload = await response.json(content_type=None)
+            except (ClientError, asyncio.TimeoutError) as exc:
+                logging.warning("Cloudflare %s %s failed: %s", method, path, exc)
+                delay = 2.0 ** attempt
+            if delay is None:
+                if not payload.get("success", False):
+                    raise DNSError("; ".join(error.get("message", "") for error in payload.get("errors", [])) or "Cloudflare call failed")
+                return payload
+            self.stats["retries"] += 1
+            await asyncio.sleep(min(delay, 30.0) * random.uniform(1.0, 1.25))
+        raise DNSError(f"Cloudflare {method} {path} failed after {self.retries + 1} attempts")
+
+    async def load(self) -> None:
+        """
+        Replaces the cached records with the A records of the zone
+        """
+        zone = await self._call("GET", f"/zones/{self.zone}")
+        self.zone_name = zone["result"]["name"]
+        records:D[str,D[str,A]] = {}
+        page = 1
+        while True:
+            payload = await self._call("GET", f"/zones/{self.zone}/dns_records?type=A&per_page=1000&page={page}")
+            for record in payload["result"]:
+                records[record["name"]] = record
+            if page >= (payload.get("result_info") or {}).get("total_pages", 1):
+                break
+            page += 1
+        self.records = records
+
+    async def ready(self) -> None:
+        """
+        Loads the records on first use, concurrent callers share a single load
+        """
+        if self.zone_name is not None:
+            return
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self.load())
+        try:
+            await asyncio.shield(self._loading)
+        finally:
+            self._loading = None
+
+    def fqdn(self, name:str) -> str:
+        """
+        Fully qualified record name, names outside the zone are taken as relative to it
+        """
+        name = name.rstrip(".").lower()
+        if self.zone_name and name != self.zone_name and not name.endswith(f".{self.zone_name}"):
+            name = f"{name}.{self.zone_name}"
+        return name
+
+    @staticmethod
+    def _same(record:D[str,A], desired:D[str,A]) -> bool:
+        return all(record.get(field) == desired[field] for field in ("content", "proxied", "ttl", "comment"))
+
+    def _enqueue(self, fqdn:str, desired:O[D[str,A]]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        _, futures = self._pending.get(fqdn, (None, []))
+        # Only the last change of a name within a batch is sent
+        self._pending[fqdn] = (desired, futures + [future])
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return future
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Sends the pending changes, `DNS_BATCH_SIZE` per batch call
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            items = list(pending.items())
+            for start in range(0, len(items), self.batch_size):
+                await self._apply(items[start:start + self.batch_size])
+
+    async def _apply(self, items:L[T[str,T[O[D[str,A]],L[asyncio.Future]]]]) -> None:
+        batch:D[str,L[D[str,A]]] = {"deletes": [], "patches": [], "posts": []}
+        names:D[str,L[str]] = {"deletes": [], "patches": [], "posts": []}
+        results:D[str,O[D[str,A]]] = {}
+        for fqdn, (desired, _) in items:
+            current = self.records.get(fqdn)
+            if desired is None:
+                operation = "deletes" if current is not None else None
+            elif current is None:
+                operation = "posts"
+            else:
+                operation = None if self._same(current, desired) else "patches"
+            if operation is None:
+                results[fqdn] = current if desired is not None else None
+                self.stats["skipped"] += 1
+                continue
+            if operation == "deletes":
+                batch[operation].append({"id": current["id"]})
+            elif operation == "patches":
+                batch[operation].append({"id": current["id"], **desired})
+            else:
+                batch[operation].append(desired)
+            names[operation].append(fqdn)
+        try:
+            if any(batch.values()):
+                payload = await self._call(
+                    "POST", f"/zones/{self.zone}/dns_records/batch", {op: ops for op, ops in batch.items() if ops}
+                )
+                self.stats["batches"] += 1
+                for operation, stat in (("deletes", "deleted"), ("patches", "updated"), ("posts", "created")):
+                    for fqdn, record in zip(names[operation], payload["result"].get(operation) or []):
+                        if operation == "deletes":
+                            self.records.pop(fqdn, None)
+                        else:
+                            self.records[fqdn] = record
+                        results[fqdn] = record
+                        self.stats[stat] += 1
+        except Exception as exc: # pylint: disable=broad-except
+            for _, (_, futures) in items:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(exc)
+            return
+        for fqdn, (_, futures) in items:
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(fqdn))
+
+    async def ensure(self, name:str, content:O[str]=None, proxied:bool=True) -> D[str,A]:
+        """
+        Creates or updates the A record of a name, without any call when it is already in place
+        """
+        await self.ready()
+        fqdn = self.fqdn(name)
+        desired = {
+            "type": "A",
+            "name": fqdn,
+            "content": content or self.content,
+            "ttl": 1,
+            "proxied": proxied,
+            "comment": self.comment
+        }
+        current = self.records.get(fqdn)
+        if current is not None and fqdn not in self._pending and self._same(current, desired):
+            self.stats["skipped"] += 1
+            return current
+        return await self._enqueue(fqdn, desired)
+
+    async def remove(self, name:str) -> O[D[str,A]]:
+        """
+        Deletes the A record of a name, without any call when there is none
+        """
+        await self.ready()
+        fqdn = self.fqdn(name)
+        if fqdn not in self.records and fqdn not in self._pending:
+            return None
+        return await self._enqueue(fqdn, None)
+
+    async def prune(self, active:S[str]) -> int:
+        """
+        Deletes the records created by this service whose name is not active and
+        that were not modified within `DNS_PRUNE_GRACE` seconds, returns how many
+        """
+        await self.ready()
+        active = {self.fqdn(name) for name in active}
+        cutoff = time.time() - self.grace
+        stale = [
+            fqdn for fqdn, record in self.records.items()
+            if record.get("comment") == self.comment and fqdn not in active and _timestamp(record.get("modified_on")) < cutoff
+        ]
+        await asyncio.gather(*[self.remove(fqdn) for fqdn in stale])
+        return len(stale)
+
+    async def _follow_containers(self) -> None:
+        async for change in containers.watch():
+            if change["action"] != "destroy":
+                continue
+            name = change["container"]["Labels"].get(DEPLOYMENT_LABEL)
+            if name:
+                try:
+                    await self.remove(name)
+                except Exception as exc: # pylint: disable=broad-except
+                    logging.warning("DNS record of %s not removed: %s", name, exc)
+
+    async def _refresh_forever(self) -> None:
+        """
+        Periodic full reload of the zone, followed by the pruning of removed deployments
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self._lock is None:
+                    self._lock = asyncio.Lock()
+                # A listing taken while a batch is sent would drop the records it writes
+                async with self._lock:
+                    await self.load()
+                # Only a complete view of the hosts tells removed deployments apart
+                if containers.synced:
+                    active = {c["Labels"][DEPLOYMENT_LABEL] for c in containers.list()}
+                    pruned = await self.prune(active)
+                    if pruned:
+                        logging.info("Pruned %s DNS records", pruned)
+            except Exception as exc: # pylint: disable=broad-except
+                logging.warning("DNS refresh failed: %s", exc)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts the cleanup of removed deployments, meant to run on application startup
+        """
+        if not env.configured("dns"):
+            logging.warning("DNS management disabled, set %s", ", ".join(env.missing("dns")))
+            return
+        self._tasks = [
+            asyncio.create_task(self._follow_containers()),
+            asyncio.create_task(self._refresh_forever())
+        ]
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Sends the pending changes and stops the cleanup, meant to run on application shutdown
+        """
+        for task in self._tasks + ([self._timer] if self._timer else []):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *([self._timer] if self._timer else []), return_exceptions=True)
+        self._tasks, self._timer = [], None
+        await self.flush()
+
+dns = DNSManager()
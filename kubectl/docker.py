@@ -0,0 +1,375 @@
+"""
+Docker pull and build progress tracking
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from urllib.parse import quote
+from typing import Optional as O, Dict as D, Set as S, Tuple as T, Any as A, AsyncGenerator as AG, Callable as C, Awaitable as W
+from kubectl.config import env, DOCKER_HOSTS
+from kubectl.client import client
+from kubectl.decorators import redis
+from kubectl.scheduler import scheduler
+
+class PullProgress:
+    """
+
+    Aggregated state of a `docker pull`
+
+    Merges the per-layer progress messages of `/images/create` into a single
+    state and detects completion or failure from the message structure.
+
+    """
+    def __init__(self, image:str):
+        self.image = image
+        self.status = "pulling"
+        self.message:O[str] = None
+        self.error:O[str] = None
+        self.layers:D[str,D[str,A]] = {}
+
+    @property
+    def done(self) -> bool:
+        """Whether the pull finished, successfully or not"""
+        return self.status in ("complete", "error")
+
+    def update(self, message:D[str,A]) -> None:
+        """
+        Merges a daemon progress message into the state
+        """
+        if "error" in message or "errorDetail" in message:
+            self.status = "error"
+            self.error = message.get("error") or message["errorDetail"].get("message")
+            return
+        status = message.get("status", "")
+        if "id" in message and "progressDetail" in message:
+            layer = self.layers.setdefault(message["id"], {"status": None, "current": 0, "total": 0})
+            layer["status"] = status
+            detail = message["progressDetail"] or {}
+            if "total" in detail:
+                layer["total"] = detail["total"]
+            if "current" in detail:
+                layer["current"] = detail["current"]
+            if status in ("Pull complete", "Already exists"):
+                layer["current"] = layer["total"]
+            return
+        self.message = status
+        if status.startswith("Status: "):
+            self.status = "complete"
+
+    def finish(self) -> None:
+        """
+        Marks the pull as complete once the daemon closed the stream without errors
+        """
+        if not self.done:
+            self.status = "complete"
+
+    def dict(self) -> D[str,A]:
+        """
+        Serializable snapshot of the state
+        """
+        return {
+            "image": self.image,
+            "status": self.status,
+            "message": self.message,
+            "error": self.error,
+            "current": sum(layer["current"] for layer in self.layers.values()),
+            "total": sum(layer["total"] for layer in self.layers.values()),
+            "layers": self.layers
+        }
+
+class Pull:
+    """
+
+    A single upstream `docker pull` shared by every subscriber of the same image
+
+    Snapshots are cumulative, so when a subscriber queue is full the oldest
+    snapshot is dropped instead of waiting for the subscriber to catch up.
+    Messages arriving within `DOCKER_PULL_SSE_INTERVAL` of the last snapshot
+    are published together once the interval ends, even if the stream pauses.
+
+    """
+    def __init__(self, image:str, host:str, buffer:int):
+        self.progress = PullProgress(image)
+        self.host = host
+        self.buffer = buffer
+        self.subscribers:S[asyncio.Queue] = set()
+        self.snapshot:O[T[bool,str]] = None
+        self._published_at = 0.0
+        self._flush:O[asyncio.TimerHandle] = None
+
+    def attach(self) -> asyncio.Queue:
+        """
+        Registers a subscriber queue seeded with the current state
+        """
+        queue:asyncio.Queue = asyncio.Queue(maxsize=self.buffer)
+        if self.snapshot is not None:
+            queue.put_nowait(self.snapshot)
+        self.subscribers.add(queue)
+        return queue
+
+    def detach(self, queue:asyncio.Queue) -> None:
+        """
+        Unregisters a subscriber queue
+        """
+        self.subscribers.discard(queue)
+
+    def publish(self) -> None:
+        """
+        Sends the current state to every subscriber without blocking
+        """
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        self._published_at = time.monotonic()
+        self.snapshot = (self.progress.done, json.dumps(self.progress.dict()))
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(self.snapshot)
+
+    async def run(self) -> None:
+        """
+        Consumes the daemon stream, publishing at most once every `DOCKER_PULL_SSE_INTERVAL` seconds
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            async for message in client.ndjson(f"{self.host}/images/create?fromImage={self.progress.image}", "POST"):
+                self.progress.update(message)
+                if self.progress.done:
+                    break
+                wait = self._published_at + env.DOCKER_PULL_SSE_INTERVAL - time.monotonic()
+                if wait <= 0:
+                    self.publish()
+                elif self._flush is None:
+                    self._flush = loop.call_later(wait, self.publish)
+        except Exception as exc: # pylint: disable=broad-except
+            self.progress.update({"error": str(exc)})
+        self.progress.finish()
+        self.publish()
+
+class PullRegistry:
+    """
+
+    In-flight pulls by image
+
+    The first request for an image starts the upstream pull, later requests
+    subscribe to the same progress stream until it finishes.
+
+    """
+    def __init__(self, buffer:int=env.DOCKER_PULL_SUBSCRIBER_BUFFER):
+        self.buffer = buffer
+        self._pulls:D[str,Pull] = {}
+        self._tasks:S[asyncio.Task] = set()
+
+    @staticmethod
+    def normalize(image:str) -> str:
+        """
+        Adds the implicit `latest` tag so `nginx` and `nginx:latest` share a pull
+        """
+        if "@" not in image and ":" not in image.rsplit("/", 1)[-1]:
+            return f"{image}:latest"
+        return image
+
+    def _start(self, image:str, host:str) -> Pull:
+        pull = self._pulls[image] = Pull(image, host, self.buffer)
+
+        async def run():
+            try:
+                await pull.run()
+            finally:
+                self._pulls.pop(image, None)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return pull
+
+    async def subscribe(self, image:str, host:O[str]=None) -> AG[str, None]:
+        """
+        Yields serialized progress snapshots of the given image pull until it finishes,
+        a new pull runs on the given host or the least loaded one
+        """
+        image = self.normalize(image)
+        pull = self._pulls.get(image)
+        if pull is None:
+            host = host or await scheduler.place(image)
+            # Another subscriber may have started the pull while the host was placed
+            pull = self._pulls.get(image) or self._start(image, host)
+        queue = pull.attach()
+        try:
+            while True:
+                done, snapshot = await queue.get()
+                yield snapshot
+                if done:
+                    break
+        finally:
+            pull.detach(queue)
+
+    def __len__(self) -> int:
+        return len(self._pulls)
+
+class BuildError(Exception):
+    """
+    Raised when the daemon reports a build failure
+    """
+
+class BuildProgress:
+    """
+
+    State of a `docker build` parsed from the daemon message stream
+
+    The image id comes from the `aux` message, which both the classic builder
+    and BuildKit emit, with the classic `Successfully built` line as fallback.
+
+    """
+    def __init__(self):
+        self.status = "building"
+        self.image:O[str] = None
+        self.message:O[str] = None
+        self.error:O[str] = None
+
+    @property
+    def done(self) -> bool:
+        """Whether the build finished, successfully or not"""
+        return self.status in ("complete", "error")
+
+    def update(self, message:D[str,A]) -> None:
+        """
+        Merges a daemon build message into the state
+        """
+        if "error" in message or "errorDetail" in message:
+            self.status = "error"
+            self.error = message.get("error") or message["errorDetail"].get("message")
+            return
+        aux = message.get("aux")
+        if isinstance(aux, dict) and "ID" in aux:
+            self.image = aux["ID"]
+            return
+        line = (message.get("stream") or message.get("status") or "").strip()
+        if line:
+            self.message = line
+            if line.startswith("Successfully built ") and self.image is None:
+                self.image = line[len("Successfully built "):]
+
+    def finish(self) -> None:
+        """
+        Marks the build as finished once the daemon closed the stream
+        """
+        if self.done:
+            return
+        if self.image is None:
+            self.status = "error"
+            self.error = "Build finished without an image id"
+        else:
+            self.status = "complete"
+
+    def dict(self) -> D[str,A]:
+        """
+        Serializable snapshot of the state
+        """
+        return {"status": self.status, "image": self.image, "message": self.message, "error": self.error}
+
+class BuildCache:
+    """
+
+    Built images by (owner, repo, sha, Dockerfile digest) and Docker host
+
+    Images are labelled with their build key when built. Lookups go through an
+    in-process index, then Redis, then the image list of every daemon filtered
+    by label, and concurrent requests for the same key share one in-flight build
+    placed by the scheduler, which favours the hosts that already have it.
+    Redis is only a shared index, when it is unavailable lookups fall back to
+    the daemons.
+
+    """
+    label = "kubectl.build.key"
+
+    def __init__(self, namespace:str="kubectl:builds"):
+        self.namespace = namespace
+        self._index:D[str,str] = {}
+        self._inflight:D[str,asyncio.Future] = {}
+
+    @staticmethod
+    def key(owner:str, repo:str, sha:str, digest:str) -> str:
+        """
+        Build key of a given commit and Dockerfile
+        """
+        return hashlib.sha256(f"{owner}/{repo}@{sha}:{digest}".encode("utf-8")).hexdigest()
+
+    async def _remote(self, command:str, *args:A) -> A:
+        """
+        Runs a command on the shared index, None when Redis is not configured or the command failed
+        """
+        if not redis.configured:
+            return None
+        try:
+            return await getattr(redis, command)(self.namespace, *args)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Build index %s failed: %s", command, exc)
+            return None
+
+    async def lookup(self, key:str, host:str) -> O[str]:
+        """
+        Finds the image built for the given key on a host, if any
+        """
+        field = f"{host}|{key}"
+        image = self._index.get(field) or await self._remote("hget", field)
+        if image and await scheduler.has_image(host, image):
+            self._index[field] = image
+            return image
+        filters = quote(json.dumps({"label": [f"{self.label}={key}"]}))
+        images = await client.fetch(f"{host}/images/json?filters={filters}")
+        if isinstance(images, list) and images:
+            await self.store(key, host, images[0]["Id"])
+            return images[0]["Id"]
+        self._index.pop(field, None)
+        await self._remote("hdel", field)
+        return None
+
+    async def locate(self, key:str) -> D[str,str]:
+        """
+        Images built for the given key by host
+        """
+        found = await asyncio.gather(*[self.lookup(key, host) for host in DOCKER_HOSTS], return_exceptions=True)
+        return {host: image for host, image in zip(DOCKER_HOSTS, found) if isinstance(image, str)}
+
+    async def store(self, key:str, host:str, image:str) -> None:
+        """
+        Indexes a built image under its key and host
+        """
+        self._index[f"{host}|{key}"] = image
+        await self._remote("hset", f"{host}|{key}", image)
+
+    async def get_or_build(self, key:str, build:C[[str],W[str]]) -> T[str,str]:
+        """
+        Returns the cached image for the key and its host, or runs `build` on the
+        placed host once for every concurrent caller
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            located = await self.locate(key)
+            host = await scheduler.place(prefer=set(located))
+            image = located.get(host)
+            if image is None:
+                image = await build(host)
+                await self.store(key, host, image)
+            future.set_result((image, host))
+            return image, host
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception() # retrieved here so waiter-less failures are not logged
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+pulls = PullRegistry()
+builds = BuildCache()
@@ -0,0 +1,76 @@
+"""
+GitHub API
+"""
+
+from collections import OrderedDict
+from typing import Optional as O, Dict as D, Tuple as T, Any as A
+from kubectl.config import GITHUB_HEADERS, GITHUB_URL
+from kubectl.client import client
+
+class GitHub:
+    """
+
+    Conditional, cached GitHub metadata
+
+    Stores the `ETag`/`Last-Modified` validators of every response and sends
+    them back on the next request to the same URL, so unchanged resources come
+    back as `304 Not Modified`, which does not count against the rate limit.
+
+    """
+    def __init__(self, maxsize:int=1024):
+        self.maxsize = maxsize
+        self._cache:"OrderedDict[str,T[D[str,str],A]]" = OrderedDict()
+        self.rate_limit:D[str,int] = {}
+
+    def _read_rate_limit(self, headers) -> None:
+        for name in ("limit", "remaining", "reset", "used"):
+            value = headers.get(f"X-RateLimit-{name.capitalize()}")
+            if value is not None:
+                self.rate_limit[name] = int(value)
+
+    async def get(self, path:str) -> A:
+        """
+        Conditional GET of a GitHub API path, returns the JSON payload
+        """
+        url = f"{GITHUB_URL}{path}"
+        headers = dict(GITHUB_HEADERS)
+        cached = self._cache.get(url)
+        if cached is not None:
+            headers.update(cached[0])
+        async with client.request(url, headers=headers) as response:
+            self._read_rate_limit(response.headers)
+            if response.status == 304 and cached is not None:
+                self._cache.move_to_end(url)
+                return cached[1]
+            payload = await response.json()
+            validators = {}
+            if "ETag" in response.headers:
+                validators["If-None-Match"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["If-Modified-Since"] = response.headers["Last-Modified"]
+            if response.status == 200 and validators:
+                self._cache[url] = (validators, payload)
+                self._cache.move_to_end(url)
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+            return payload
+
+    async def head_commit(self, owner:str, repo:str, ref:O[str]=None) -> str:
+        """
+        SHA of the head commit of the given ref, the default branch by default
+        """
+        path = f"/repos/{owner}/{repo}/commits?per_page=1"
+        if ref:
+            path += f"&sha={ref}"
+        payload = await self.get(path)
+        if not isinstance(payload, list) or not payload:
+            raise ValueError(f"No commits found for {owner}/{repo}")
+        return payload[0]["sha"]
+
+    def quota(self) -> D[str,int]:
+        """
+        Rate limit state as reported by the last response
+        """
+        return dict(self.rate_limit)
+
+github = GitHub()
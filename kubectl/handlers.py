@@ -1,100 +1,384 @@
 """Non decorated API Request Handlers"""
 import json
-import botocore
-from aiofauna import Request, Response, json_response, ClientSession
+import time
+import asyncio
+from typing import Optional as O, Dict as D, List as L, Tuple as T, Any as A, AsyncGenerator as AG
+from aiofauna import Request, Response, json_response
+from aiohttp import BodyPartReader, WSMsgType
+from aiohttp.web import WebSocketResponse, StreamResponse
+from aiohttp.hdrs import CONTENT_TYPE
 from aiohttp_sse import sse_response
-from aiohttp.web_request import FileField
-from aioboto3 import Session
-from kubectl.config import env, CLOUDFLARE_HEADERS, CLOUDFLARE_URL, DOCKER_URL, GITHUB_HEADERS, GITHUB_URL # pylint: disable=unused-import, line-too-long
+from kubectl.config import env, CLOUDFLARE_URL, DOCKER_URL, GITHUB_HEADERS, GITHUB_URL # pylint: disable=unused-import, line-too-long
 from kubectl.models import Upload
 from kubectl.client import client
+from kubectl.storage import storage, presigned_url
+from kubectl.content import content, describe_upload
+from kubectl.github import github
+from kubectl.jobs import deploys, Job
+from kubectl.nginx import proxy
+from kubectl.ports import ports
+from kubectl.docker import pulls, builds, BuildProgress, BuildError
+from kubectl.scheduler import scheduler
+from kubectl.state import containers, DEPLOYMENT_LABEL
+from kubectl.logs import merge_logs
+from kubectl.dns import dns
+from kubectl.idle import reaper
+from kubectl.metrics import registry, span, subscribers
 
-session = Session()
+UPLOAD_BYTES = registry.counter("kubectl_upload_bytes_total", "Bytes streamed to object storage")
+UPLOAD_SECONDS = registry.histogram("kubectl_upload_duration_seconds", "Duration of uploads to object storage", ("status",))
 
 # Latest Commit SHA
 async def get_latest_commit_sha(owner: str, repo: str) -> str:
     """
     Gets the SHA of the latest commit in the repository.
     """
-    url = f"https://api.github.com/repos/{owner}/{repo}/commits"
-    payload = await client.fetch(url, headers=GITHUB_HEADERS)   
-    return payload[0]["sha"] 
+    with span("commit_sha"):
+        return await github.head_commit(owner, repo)
 
 # Upload Component
+async def read_part(part:BodyPartReader, size:int) -> bytes:
+    """
+    Reads up to `size` bytes from a multipart body part
+    """
+    chunks = []
+    read = 0
+    while read < size:
+        chunk = await part.read_chunk(min(size - read, 1024 * 1024))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        read += len(chunk)
+    return b"".join(chunks)
+
+async def stream_upload(s3client, part:BodyPartReader, key:str, content_type:str) -> int:
+    """
+    Streams a multipart body part to S3 keeping at most `UPLOAD_CONCURRENCY` parts
+    of `UPLOAD_PART_SIZE` bytes in memory, returns the number of bytes uploaded.
+    """
+    body = await read_part(part, env.UPLOAD_PART_SIZE)
+    if len(body) < env.UPLOAD_PART_SIZE:
+        if body:
+            await s3client.put_object(Bucket=env.AWS_S3_BUCKET, Key=key, Body=body, ContentType=content_type, ACL="public-read")
+        return len(body)
+    multipart = await s3client.create_multipart_upload(Bucket=env.AWS_S3_BUCKET, Key=key, ContentType=content_type, ACL="public-read")
+    upload_id = multipart["UploadId"]
+    semaphore = asyncio.Semaphore(env.UPLOAD_CONCURRENCY)
+    await semaphore.acquire() # slot held by the part already read
+    etags:D[int,str] = {}
+    tasks:L[asyncio.Task] = []
+
+    async def upload_part(number:int, body:bytes):
+        try:
+            response = await s3client.upload_part(Bucket=env.AWS_S3_BUCKET, Key=key, PartNumber=number, UploadId=upload_id, Body=body)
+            etags[number] = response["ETag"]
+        finally:
+            semaphore.release()
+
+    size = 0
+    try:
+        number = 1
+        while body:
+            size += len(body)
+            tasks.append(asyncio.create_task(upload_part(number, body)))
+            number += 1
+            body = b""
+            await semaphore.acquire()
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception():
+                    raise task.exception() # type: ignore
+            body = await read_part(part, env.UPLOAD_PART_SIZE)
+            if not body:
+                semaphore.release()
+        await asyncio.gather(*tasks)
+        await s3client.complete_multipart_upload(
+            Bucket=env.AWS_S3_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": [{"ETag": etags[n], "PartNumber": n} for n in sorted(etags)]}
+        )
+        return size
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await s3client.abort_multipart_upload(Bucket=env.AWS_S3_BUCKET, Key=key, UploadId=upload_id)
+        raise
+
 async def upload_handler(request:Request)->Response:
     """
     Upload Endpoint
     """
-    data = await request.post()
     params = dict(request.query)
     key = params.get("key")
-    size = params.get("size")
     user = params.get("user")
-    if key and size and user:
-        size = int(size)
-        file = data["file"]
-        if isinstance(file, FileField):
-            async with session.client(service_name="s3", 
-            aws_access_key_id=env.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=env.AWS_SECRET_ACCESS_KEY,
-            endpoint_url=env.AWS_S3_ENDPOINT,
-            config=botocore.config.Config(signature_version="s3v4")) as s3client: # type: ignore
-                key_ = f"{key}/{file.filename}" # type: ignore
-                await s3client.put_object(Bucket=env.AWS_S3_BUCKET, Key=key_, Body=file.file.read(), ContentType=file.content_type, ACL="public-read")
-                url = await s3client.generate_presigned_url("get_object", Params={"Bucket": env.AWS_S3_BUCKET, "Key": key_}, ExpiresIn=3600*7*24)
-                upload = await Upload(user=user,key=key_, name=file.filename, size=size, type=file.content_type, url=url).save()
-                return json_response(upload.dict())
+    if key and user:
+        reader = await request.multipart()
+        part = await reader.next()
+        while part is not None and part.name != "file":
+            part = await reader.next()
+        if isinstance(part, BodyPartReader) and part.filename:
+            content_type = part.headers.get(CONTENT_TYPE, "application/octet-stream")
+            s3client = await storage.client()
+            key_ = f"{key}/{part.filename}"
+            started = time.perf_counter()
+            try:
+                size = await stream_upload(s3client, part, key_, content_type)
+            except Exception:
+                UPLOAD_SECONDS.observe(time.perf_counter() - started, status="error")
+                raise
+            UPLOAD_SECONDS.observe(time.perf_counter() - started, status="ok")
+            UPLOAD_BYTES.inc(size)
+            if size == 0:
+                return json_response({"message": "Empty file", "status": "error"}, status=400)
+            upload = await Upload(user=user,key=key_, name=part.filename, size=size, type=content_type).save()
+            return json_response({**upload.dict(), "url": await presigned_url(key_)})
     return json_response({"message": "Invalid request", "status": "error"}, status=400)
 
+# Upload Content
+async def upload_content(request:Request)->StreamResponse:
+    """
+    Upload Download, a single byte range or the whole object, from the local content cache or S3
+    """
+    upload = await describe_upload(request.match_info["ref"])
+    if upload is None:
+        return json_response({"message": "Upload not found", "status": "error"}, status=404)
+    return await content.serve(request, upload)
+
 # Docker Pull
+@subscribers("pull")
 async def docker_pull(request:Request)->Response:
     """
-    Docker Pull
+    Docker Pull, concurrent pulls of the same image share one upstream stream
     """
     params = dict(request.query)
-    image = params.get("image")   
+    image = params.get("image")
+    if not image:
+        return json_response({"message": "Invalid request", "status": "error"}, status=400)
     async with sse_response(request) as resp:
-        async for event in client.stream(f"{DOCKER_URL}/images/create?fromImage={image}", "POST"):
-            await resp.send(event)
-            if "Pull complete" in event:
-                await resp.send(event)
-                break
+        async for snapshot in pulls.subscribe(image, params.get("host")):
+            await resp.send(snapshot)
         return resp
 
+# Dockerfile digest
+async def get_dockerfile_digest(owner: str, repo: str, sha: str) -> str:
+    """
+    Gets the git blob SHA of the repository Dockerfile at the given commit.
+    """
+    payload = await github.get(f"/repos/{owner}/{repo}/contents/Dockerfile?ref={sha}")
+    return payload.get("sha", "") if isinstance(payload, dict) else ""
+
 # Docker Build from GitHub Tarball
-async def docker_build_from_github_tarball(owner: str, repo: str):
+async def docker_build_stream(owner: str, repo: str, sha: O[str] = None, labels: O[D[str,str]] = None, host: str = DOCKER_URL) -> AG[D[str,A], None]:
     """
-    Builds a Docker image from the latest code for the given GitHub repository.
+    Streams the daemon build messages for the given commit of a GitHub repository, the latest one by default.
     """
-    sha = await get_latest_commit_sha(owner, repo)
+    sha = sha or await get_latest_commit_sha(owner, repo)
     tarball_url = f"https://api.github.com/repos/{owner}/{repo}/tarball/{sha}"
     local_path = f"{owner}-{repo}-{sha[:7]}"
     build_args = json.dumps({"LOCAL_PATH": local_path})
-    async with ClientSession() as http_session:
-        async with http_session.post(
-            f"{DOCKER_URL}/build?remote={tarball_url}&dockerfile={local_path}/Dockerfile&buildargs={build_args}"
-        ) as response:
-            streamed_data = await response.text()
-            id_ = streamed_data.split("Successfully built ")[1].split("\\n")[0]
-            return id_
-
-# Cloudflare create record    
+    url = f"{host}/build?remote={tarball_url}&dockerfile={local_path}/Dockerfile&buildargs={build_args}"
+    if labels:
+        url += f"&labels={json.dumps(labels)}"
+    async for message in client.ndjson(url, "POST"):
+        yield message
+
+async def docker_build_from_github_tarball(owner: str, repo: str) -> T[str,str]:
+    """
+    Builds a Docker image from the latest code for the given GitHub repository,
+    reusing the image already built for the same commit and Dockerfile.
+    Returns the image id and the Docker host that holds it.
+    """
+    sha = await get_latest_commit_sha(owner, repo)
+    digest = await get_dockerfile_digest(owner, repo, sha)
+    key = builds.key(owner, repo, sha, digest)
+
+    async def build(host: str) -> str:
+        progress = BuildProgress()
+        labels = {builds.label: key, "kubectl.owner": owner, "kubectl.repo": repo, "kubectl.sha": sha}
+        async for message in docker_build_stream(owner, repo, sha, labels, host):
+            progress.update(message)
+            if progress.done:
+                break
+        progress.finish()
+        if progress.error:
+            raise BuildError(progress.error)
+        return progress.image # type: ignore
+
+    return await builds.get_or_build(key, build)
+
+# Docker Build Logs
+@subscribers("build")
+async def docker_build(request:Request)->Response:
+    """
+    Docker Build, streams the daemon build log followed by the build result
+    """
+    params = dict(request.query)
+    owner = params.get("owner")
+    repo = params.get("repo")
+    if not owner or not repo:
+        return json_response({"message": "Invalid request", "status": "error"}, status=400)
+    build = BuildProgress()
+    host = params.get("host") or await scheduler.place()
+    async with sse_response(request) as resp:
+        async for message in docker_build_stream(owner, repo, params.get("sha"), host=host):
+            build.update(message)
+            await resp.send(json.dumps(message), event="log")
+            if build.done:
+                break
+        build.finish()
+        await resp.send(json.dumps(build.dict()), event="result")
+        return resp
+
+# Cloudflare create record
 async def create_dns_record(name: str):
     """
-    Creates a DNS record for the given name on Cloudflare.
+    Creates the DNS record of the given name on Cloudflare, unless it is already in place.
     """
-    payload =  {"type": "A", "name": name, "content": env.IP_ADDR, "ttl": 1, "proxied": True}   
-    return await client.fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/dns_records",
-        "POST",
-        headers=CLOUDFLARE_HEADERS,
-        data=payload,
-    )
+    return await dns.ensure(name)
 
 # Docker Start Container
 async def docker_start(container: str):
     """
-    Starts a Docker container.
+    Starts a Docker container on the host it lives on.
+    """
+    host = await scheduler.locate(container)
+    return await client.text(f"{host}/containers/{container}/start", "POST")
+
+# Deploy Pipeline
+@deploys.handler
+async def deploy_pipeline(job: Job) -> D[str,A]:
+    """
+    Builds, runs, resolves and proxies a GitHub repository, the image build and
+    the DNS record are independent so they run concurrently.
+    """
+    owner, repo, name = job.params["owner"], job.params["repo"], job.params["name"]
+    port, env_vars = job.params["port"], job.params["env_vars"]
+    results = await asyncio.gather(
+        deploys.stage(job, "build", docker_build_from_github_tarball(owner, repo)),
+        deploys.stage(job, "dns", create_dns_record(name)),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    (image, host), record = results
+    host_port = await ports.reserve(name)
+    payload = {
+        "Image": image,
+        "Env": env_vars.split(","),
+        "Labels": {DEPLOYMENT_LABEL: name, "kubectl.owner": owner, "kubectl.repo": repo, **reaper.labels()},
+        "ExposedPorts": {f"{str(port)}/tcp": {"HostPort": str(host_port)}},
+        "HostConfig": {"PortBindings": {f"{str(port)}/tcp": [{"HostPort": str(host_port)}]}},
+    }
+    try:
+        container = await deploys.stage(job, "create", client.fetch(
+            f"{host}/containers/create?name={name}",
+            "POST",
+            headers={"Content-Type": "application/json"},
+            data=payload,
+        ))
+        if "Id" not in container:
+            raise ValueError(container.get("message", "Container could not be created"))
+        _id = container["Id"]
+        await scheduler.assign(_id, host)
+        await ports.bind(host_port, _id)
+        await deploys.stage(job, "start", docker_start(_id))
+    except Exception:
+        await ports.release(host_port)
+        raise
+    await deploys.stage(job, "proxy", proxy.apply(name, port=host_port, host=scheduler.address(host), **reaper.proxy_context(name)))
+    reaper.touch(name)
+    data = containers.get(_id) or await deploys.stage(job, "inspect", client.fetch(f"{host}/containers/{_id}/json"))
+    return {
+        "url": f"{name}.smartpro.solutions",
+        "port": str(host_port),
+        "host": host,
+        "container": data,
+        "dns": record,
+    }
+
+# Deploy Progress
+@subscribers("deploy")
+async def deploy_events(request:Request)->Response:
+    """
+    Deploy job progress, streams the job state on every stage change until it finishes
     """
-    return await client.text(f"{DOCKER_URL}/containers/{container}/start", "POST")
+    job_id = request.match_info["job"]
+    if await deploys.get(job_id) is None:
+        return json_response({"message": "Job not found", "status": "error"}, status=404)
+    async with sse_response(request) as resp:
+        async for state in deploys.events(job_id):
+            await resp.send(state)
+        return resp
+
+# Deployments Watch
+@subscribers("deployments")
+async def deployment_events(request:Request)->Response:
+    """
+    Deployments watch, streams the current deployments and then every change,
+    served from the container state store
+    """
+    async with sse_response(request) as resp:
+        await resp.send(json.dumps(containers.list()), event="snapshot")
+        async for change in containers.watch():
+            if change["action"] == "resync":
+                await resp.send(json.dumps(containers.list()), event="snapshot")
+            elif DEPLOYMENT_LABEL in change["container"]["Labels"]:
+                await resp.send(json.dumps(change), event="change")
+        return resp
 
+# Container Logs
+@subscribers("logs")
+async def container_logs_stream(request:Request)->Response:
+    """
+    Container logs of one or more containers, streamed over SSE or, when the
+    client asks for an upgrade, over a WebSocket. Containers are given as the
+    `ref` path segment or as repeated `container` query parameters, the `since`,
+    `tail`, `follow` and `timestamps` parameters map to the daemon ones.
+    """
+    refs = [request.match_info["ref"]] if "ref" in request.match_info else request.query.getall("container", [])
+    tail = request.query.get("tail", str(env.LOG_TAIL))
+    if not refs or len(refs) > env.LOG_MAX_CONTAINERS or not (tail == "all" or tail.isdigit()):
+        return json_response({"message": "Invalid request", "status": "error"}, status=400)
+    sources = {}
+    for ref in refs:
+        container = containers.get(ref)
+        if container is not None:
+            sources[ref] = (container["Host"], container["Id"])
+        else:
+            sources[ref] = (await scheduler.locate(ref), ref)
+    options = {
+        "since": request.query.get("since"),
+        "tail": tail if tail == "all" else int(tail),
+        "follow": request.query.get("follow", "true").lower() in ("1", "true", "yes"),
+        "timestamps": request.query.get("timestamps", "false").lower() in ("1", "true", "yes")
+    }
+    lines = merge_logs(sources, **options)
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        ws = WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def receive() -> None:
+            async for message in ws:
+                if message.type in (WSMsgType.CLOSE, WSMsgType.ERROR):
+                    break
+
+        # Reading the socket is what notices the client going away
+        reader = asyncio.create_task(receive())
+        try:
+            async for name, stream, line in lines:
+                if reader.done():
+                    break
+                await ws.send_json({"container": name, "stream": stream, "line": line})
+        finally:
+            await lines.aclose()
+            reader.cancel()
+            await ws.close()
+        return ws
+    async with sse_response(request) as resp:
+        try:
+            async for name, stream, line in lines:
+                await resp.send(json.dumps({"container": name, "line": line}), event=stream)
+        finally:
+            await lines.aclose()
+        return resp
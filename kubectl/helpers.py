@@ -3,52 +3,180 @@
 Helpers for kubectl
 
 """
+import time
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional as O, Dict as D, Tuple as T, Any as A
 from pydantic import BaseModel, Field # pylint: disable=no-name-in-module
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend
+from kubectl.config import env
+
+ALGORITHMS = ("rsa", "ed25519")
 
 
 class SSHKeyPair(BaseModel): # pylint: disable=too-few-public-methods
     """
     
-    An RSA SSH key pair
+    An SSH key pair
     
     """
     private_key: str = Field(..., description="Private key in PEM format")
     public_key: str = Field(..., description="Public key in OpenSSH format")
+    algorithm: str = Field("rsa", description="Key algorithm, rsa or ed25519")
 
 
-def generate_ssh_key_pair() -> SSHKeyPair:
+def _generate_pems(algorithm:str="rsa") -> T[str,str]:
     """
-    
-    Generate a SSH key pair    
-    
+    Generates and serializes a key pair, a plain module function so it can run in a worker process
     """
-    def generate_rsa_key_pair():
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
+    from cryptography.hazmat.backends import default_backend
+    if algorithm == "rsa":
         private_key = rsa.generate_private_key(
             public_exponent=65537,
             key_size=2048,
             backend=default_backend()
         )
-        public_key = private_key.public_key()
+    elif algorithm == "ed25519":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Unsupported key algorithm: {algorithm}")
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.OpenSSH,
+        format=serialization.PublicFormat.OpenSSH
+    )
+    return (private_pem.decode('utf-8'), public_pem.decode('utf-8'))
 
-        return (private_key, public_key)
 
-    def serialize_ssh_key_pair(private_key, public_key):
-        private_pem = private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        public_pem = public_key.public_bytes(
-            encoding=serialization.Encoding.OpenSSH,
-            format=serialization.PublicFormat.OpenSSH
-        )
+def generate_ssh_key_pair(algorithm:str="rsa") -> SSHKeyPair:
+    """
+    
+    Generate a SSH key pair, blocking, use `ssh_keys.get` from the event loop
+    
+    """
+    private_pem, public_pem = _generate_pems(algorithm)
+    return SSHKeyPair(private_key=private_pem, public_key=public_pem, algorithm=algorithm)
+
+
+class SSHKeyService:
+    """
+
+    SSH key pairs generated off the event loop
+
+    Generation runs in a process pool and a bounded pool of ready key pairs per
+    algorithm is refilled in the background, so callers usually get a key
+    without waiting for any generation at all. The process pool and the refill
+    of an algorithm start with its first request, workers that never hand out
+    keys generate none.
+
+    """
+    def __init__(self, size:int=env.SSH_KEY_POOL_SIZE, workers:int=env.SSH_KEY_WORKERS):
+        self.size = size
+        self.workers = workers
+        self._executor:O[ProcessPoolExecutor] = None
+        self._pools:D[str,asyncio.Queue] = {}
+        self._tasks:D[str,asyncio.Task] = {}
+        self._stats:D[str,D[str,A]] = {
+            algorithm: {"hits": 0, "misses": 0, "generated": 0, "latency_last": None, "latency_max": 0.0, "latency_total": 0.0}
+            for algorithm in ALGORITHMS
+        }
+
+    def _pool(self, algorithm:str) -> asyncio.Queue:
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unsupported key algorithm: {algorithm}")
+        pool = self._pools.get(algorithm)
+        if pool is None:
+            pool = self._pools[algorithm] = asyncio.Queue(maxsize=self.size)
+        return pool
+
+    async def generate(self, algorithm:str="rsa") -> SSHKeyPair:
+        """
+        Generates a fresh key pair in the process pool
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        started = time.perf_counter()
+        try:
+            private_pem, public_pem = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _generate_pems, algorithm
+            )
+        except BrokenProcessPool:
+            self._executor = None # replaced on the next generation
+            raise
+        latency = time.perf_counter() - started
+        stats = self._stats[algorithm]
+        stats["generated"] += 1
+        stats["latency_last"] = latency
+        stats["latency_max"] = max(stats["latency_max"], latency)
+        stats["latency_total"] += latency
+        return SSHKeyPair(private_key=private_pem, public_key=public_pem, algorithm=algorithm)
+
+    async def _refill(self, algorithm:str) -> None:
+        pool = self._pool(algorithm)
+        delay = 1.0
+        while True:
+            try:
+                key_pair = await self.generate(algorithm)
+            except Exception as exc: # pylint: disable=broad-except
+                logging.warning("Generating %s SSH keys failed, retrying in %.0fs: %s", algorithm, delay, exc)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+                continue
+            delay = 1.0
+            # Blocks once the pool is full, resuming as soon as a key is taken
+            await pool.put(key_pair)
+
+    async def get(self, algorithm:str="rsa") -> SSHKeyPair:
+        """
+        Returns a pre-generated key pair, generating one only when the pool is empty
+        """
+        pool = self._pool(algorithm)
+        if self.size and algorithm not in self._tasks:
+            self._tasks[algorithm] = asyncio.create_task(self._refill(algorithm))
+        try:
+            key_pair = pool.get_nowait()
+            self._stats[algorithm]["hits"] += 1
+            return key_pair
+        except asyncio.QueueEmpty:
+            self._stats[algorithm]["misses"] += 1
+            return await self.generate(algorithm)
 
-        return (private_pem.decode('utf-8'), public_pem.decode('utf-8'))
+    def stats(self) -> D[str,D[str,A]]:
+        """
+        Pool depth, hit rate and generation latency per algorithm
+        """
+        return {
+            algorithm: {
+                "depth": self._pools[algorithm].qsize() if algorithm in self._pools else 0,
+                "capacity": self.size,
+                "hits": stats["hits"],
+                "misses": stats["misses"],
+                "generated": stats["generated"],
+                "latency_last": stats["latency_last"],
+                "latency_max": stats["latency_max"],
+                "latency_avg": stats["latency_total"] / stats["generated"] if stats["generated"] else None
+            }
+            for algorithm, stats in self._stats.items()
+        }
 
-    private_key, public_key = generate_rsa_key_pair()
-    private_pem, public_pem = serialize_ssh_key_pair(private_key, public_key)
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the refills and the process pool, meant to run on application shutdown
+        """
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
-    return SSHKeyPair(private_key=private_pem, public_key=public_pem)
+ssh_keys = SSHKeyService()
@@ -0,0 +1,338 @@
+"""
+Idle Deployments
+"""
+
+import re
+import time
+import errno
+import socket
+import asyncio
+import hashlib
+import logging
+from typing import Optional as O, Dict as D, Tuple as T, Any as A
+from aiohttp import web, ClientConnectionError, hdrs
+from kubectl.config import env
+from kubectl.client import client
+from kubectl.state import containers, DEPLOYMENT_LABEL
+from kubectl.scheduler import scheduler
+from kubectl.metrics import registry
+
+# Header naming the deployment on the requests the proxy sends to the wake listener
+WAKE_HEADER = "X-Kubectl-Wake"
+# Label of the containers whose proxy has a wake path, only those are ever stopped
+IDLE_LABEL = "kubectl.idle"
+# Tag of an nginx syslog message, after its priority and timestamp
+SYSLOG_TAG = re.compile(rb"^<\d+>\w{3} [ \d]\d \d\d:\d\d:\d\d (?:\S+ )?(\w+): ")
+# Headers not forwarded, lowercased, compared with the lowercased names
+HOP_HEADERS = {header.lower() for header in (
+    hdrs.CONNECTION, hdrs.KEEP_ALIVE, hdrs.PROXY_AUTHENTICATE, hdrs.PROXY_AUTHORIZATION,
+    hdrs.TE, hdrs.TRAILER, hdrs.TRANSFER_ENCODING, hdrs.UPGRADE, hdrs.CONTENT_LENGTH, WAKE_HEADER
+)}
+# The client decompresses upstream bodies, so their encoding is not forwarded either
+RESPONSE_HOP_HEADERS = HOP_HEADERS | {hdrs.CONTENT_ENCODING.lower()}
+
+WAKE_SECONDS = registry.histogram(
+    "kubectl_wake_duration_seconds", "Time from the first request to a stopped deployment until its port accepts connections", ("status",)
+)
+SLEEP_SECONDS = registry.histogram(
+    "kubectl_sleep_duration_seconds", "Time deployments stayed stopped before a request woke them",
+    buckets=(60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0, 43200.0, 86400.0, 604800.0)
+)
+IDLE_STOPS = registry.counter("kubectl_idle_stops_total", "Deployments stopped after idling past IDLE_TIMEOUT")
+
+class WakeError(Exception):
+    """
+    Raised when a stopped deployment can not be started or does not come up in time
+    """
+
+class Beacon(asyncio.DatagramProtocol):
+    """
+    Receives the access log lines nginx sends over syslog, one datagram per request
+    """
+    def __init__(self, reaper:"IdleReaper"):
+        self.reaper = reaper
+
+    def datagram_received(self, data:bytes, addr:A) -> None:
+        match = SYSLOG_TAG.match(data)
+        if match is not None:
+            self.reaper.seen(match.group(1).decode())
+
+class IdleReaper:
+    """
+
+    Stops deployments nobody used for `IDLE_TIMEOUT` seconds and starts them again on demand
+
+    Activity comes from the proxy: the server block of every deployment logs its
+    requests over syslog to the `IDLE_BEACON` address, tagged per deployment.
+    Stopped containers keep their port lease and DNS record, only the process
+    goes away. Their upstream has a wake listener of this service as backup
+    server, so the first request that finds the port closed is held there while
+    the container starts and forwarded once its port accepts connections. The
+    listener is bound to `WAKE_UPSTREAM` apart from the API, for the proxy only.
+
+    With several workers, the first one to bind `IDLE_BEACON` runs the listeners
+    and the idle check, the others forward the activity they record to it.
+
+    """
+    def __init__(self,
+        timeout:float=env.IDLE_TIMEOUT,
+        interval:float=env.IDLE_CHECK_INTERVAL,
+        beacon:str=env.IDLE_BEACON,
+        upstream:str=env.WAKE_UPSTREAM,
+        wake_timeout:float=env.WAKE_TIMEOUT
+    ):
+        self.timeout = timeout
+        self.interval = interval
+        self.beacon = beacon
+        self.upstream = upstream
+        self.wake_timeout = wake_timeout
+        self._activity:D[str,float] = {}
+        self._stopped:D[str,float] = {}
+        self._targets:D[str,T[str,str,str,int]] = {}
+        self._waking:D[str,asyncio.Future] = {}
+        self._transport:O[asyncio.DatagramTransport] = None
+        self._runner:O[web.AppRunner] = None
+        self._task:O[asyncio.Task] = None
+        self.stats:D[str,int] = {"beacons": 0, "stops": 0, "wakes": 0, "failures": 0}
+
+    @property
+    def enabled(self) -> bool:
+        """Whether idle deployments are stopped at all"""
+        return self.timeout > 0
+
+    @staticmethod
+    def tag(name:str) -> str:
+        """Syslog tag and upstream suffix of a deployment, nginx allows 32 word characters"""
+        return f"k{hashlib.blake2b(name.encode(), digest_size=8).hexdigest()}"
+
+    def labels(self) -> D[str,str]:
+        """Container labels of a deployment made now"""
+        return {IDLE_LABEL: "wake"} if self.enabled else {}
+
+    def proxy_context(self, name:str) -> D[str,str]:
+        """Server block settings of a deployment made now, routing closed ports to the wake path"""
+        if not self.enabled:
+            return {}
+        return {"tag": self.tag(name), "wake": self.upstream, "beacon": self.beacon}
+
+    def seen(self, tag:str) -> None:
+        """
+        Records a request to the deployment of a tag
+        """
+        self._activity[tag] = time.monotonic()
+        self.stats["beacons"] += 1
+
+    def touch(self, name:str) -> None:
+        """
+        Records a request to a deployment
+        """
+        tag = self.tag(name)
+        self._activity[tag] = time.monotonic()
+        if self.enabled and self._transport is None:
+            self._forward(tag)
+
+    def _forward(self, tag:str) -> None:
+        """
+        Sends activity to the worker listening on `IDLE_BEACON` as the proxy would
+        """
+        host, port = self.beacon.rsplit(":", 1)
+        message = f"<190>{time.strftime('%b %d %H:%M:%S')} {tag}: touch".encode()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            try:
+                sock.sendto(message, (host, int(port)))
+            except OSError as exc:
+                logging.warning("Activity of %s not forwarded to %s: %s", tag, self.beacon, exc)
+
+    def idle(self, name:str) -> float:
+        """
+        Seconds since the last request to a deployment, counted from now for one never seen
+        """
+        now = time.monotonic()
+        return now - self._activity.setdefault(self.tag(name), now)
+
+    async def stop(self, container:D[str,A]) -> None:
+        """
+        Stops the container of an idle deployment, keeping it with its port and DNS record
+        """
+        name = container["Labels"][DEPLOYMENT_LABEL]
+        async with client.request(f"{container['Host']}/containers/{container['Id']}/stop?t=10", "POST") as response:
+            if response.status >= 400:
+                raise WakeError(f"Deployment {name} did not stop: {await response.text()}")
+        self._stopped[name] = time.monotonic()
+        self.stats["stops"] += 1
+        IDLE_STOPS.inc()
+        logging.info("Stopped %s after %.0fs idle", name, self.idle(name))
+
+    async def reap(self) -> int:
+        """
+        Stops every running deployment idle for longer than `IDLE_TIMEOUT`, returns how many
+        """
+        idle = [
+            c for c in containers.list()
+            if c["State"] == "running" and c["Labels"].get(IDLE_LABEL) == "wake"
+            and c["Labels"][DEPLOYMENT_LABEL] not in self._waking
+            and self.idle(c["Labels"][DEPLOYMENT_LABEL]) > self.timeout
+        ]
+        results = await asyncio.gather(*[self.stop(c) for c in idle], return_exceptions=True)
+        for container, result in zip(idle, results):
+            if isinstance(result, Exception):
+                logging.warning("Stopping %s failed: %s", container["Labels"][DEPLOYMENT_LABEL], result)
+        return sum(1 for result in results if not isinstance(result, Exception))
+
+    async def _reap_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+            except Exception as exc: # pylint: disable=broad-except
+                logging.warning("Idle check failed: %s", exc)
+
+    async def target(self, name:str) -> T[str,str,str,int]:
+        """
+        Docker host, container id, address and published port of a deployment
+        """
+        found = self._targets.get(name)
+        if found is not None:
+            return found
+        container = containers.get(name)
+        if container is None or container["Labels"].get(DEPLOYMENT_LABEL) != name:
+            raise WakeError(f"Deployment {name} not found")
+        data = await client.fetch(f"{container['Host']}/containers/{container['Id']}/json")
+        bindings = [b for bs in ((data.get("HostConfig") or {}).get("PortBindings") or {}).values() for b in bs or []]
+        if not bindings:
+            raise WakeError(f"Deployment {name} publishes no port")
+        found = self._targets[name] = (
+            container["Host"], container["Id"], scheduler.address(container["Host"]), int(bindings[0]["HostPort"])
+        )
+        return found
+
+    async def _accepting(self, address:str, port:int, deadline:float) -> None:
+        delay = 0.02
+        while True:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout=1.0)
+                writer.close()
+                return
+            except (OSError, asyncio.TimeoutError):
+                if time.monotonic() + delay > deadline:
+                    raise WakeError(f"{address}:{port} did not accept connections within {self.wake_timeout}s") from None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+    async def _start(self, name:str) -> T[str,int]:
+        started = time.perf_counter()
+        try:
+            host, id_, address, port = await self.target(name)
+            async with client.request(f"{host}/containers/{id_}/start", "POST") as response:
+                if response.status >= 400:
+                    raise WakeError(f"Deployment {name} did not start: {await response.text()}")
+            await self._accepting(address, port, time.monotonic() + self.wake_timeout)
+        except Exception:
+            self._targets.pop(name, None)
+            self.stats["failures"] += 1
+            WAKE_SECONDS.observe(time.perf_counter() - started, status="error")
+            raise
+        WAKE_SECONDS.observe(time.perf_counter() - started, status="ok")
+        stopped = self._stopped.pop(name, None)
+        if stopped is not None:
+            SLEEP_SECONDS.observe(time.monotonic() - stopped)
+        self.stats["wakes"] += 1
+        self.touch(name)
+        return address, port
+
+    async def wake(self, name:str) -> T[str,int]:
+        """
+        Starts a deployment and waits for its port, concurrent callers share one start.
+        Returns the address and port to reach it
+        """
+        future = self._waking.get(name)
+        if future is None:
+            future = self._waking[name] = asyncio.ensure_future(self._start(name))
+            future.add_done_callback(lambda _: self._waking.pop(name, None))
+        return await asyncio.shield(future)
+
+    async def serve(self, request:web.Request, name:str) -> web.StreamResponse:
+        """
+        Wakes a deployment and forwards the request that found it stopped.
+        WebSocket upgrades are answered with a retry once the deployment is up
+        """
+        try:
+            address, port = await self.wake(name)
+        except WakeError as exc:
+            return web.json_response({"message": str(exc), "status": "error"}, status=502)
+        if request.headers.get(hdrs.UPGRADE, "").lower() == "websocket":
+            return web.json_response({"message": "Deployment started, reconnect", "status": "error"}, status=503, headers={"Retry-After": "1"})
+        url = f"http://{address}:{port}{request.rel_url}"
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS}
+        body = await request.read()
+        deadline = time.monotonic() + self.wake_timeout
+        response:O[web.StreamResponse] = None
+        while True:
+            try:
+                async with client.session(url).request(
+                    request.method, url, headers=headers, data=body or None, allow_redirects=False
+                ) as upstream:
+                    response = web.StreamResponse(
+                        status=upstream.status,
+                        headers={k: v for k, v in upstream.headers.items() if k.lower() not in RESPONSE_HOP_HEADERS}
+                    )
+                    await response.prepare(request)
+                    async for chunk in upstream.content.iter_chunked(env.DOWNLOAD_CHUNK_SIZE):
+                        await response.write(chunk)
+                    await response.write_eof()
+                    return response
+            except ClientConnectionError:
+                # A published port can accept connections before the application listens,
+                # the request is sent again until it gets an answer
+                if response is not None or time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def _wake_request(self, request:web.Request) -> web.StreamResponse:
+        name = request.headers.get(WAKE_HEADER)
+        if not name:
+            return web.json_response({"message": "Not a wake request", "status": "error"}, status=400)
+        return await self.serve(request, name)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts listening for activity and wake requests and the periodic idle check, meant to run on application startup.
+        Only the first worker does, the address is then in use for the others
+        """
+        if not self.enabled:
+            return
+        host, port = self.beacon.rsplit(":", 1)
+        try:
+            self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: Beacon(self), local_addr=(host, int(port))
+            )
+        except OSError as exc:
+            if exc.errno != errno.EADDRINUSE:
+                raise
+            logging.info("Idle deployments handled by the worker listening on %s", self.beacon)
+            return
+        wake = web.Application()
+        wake.router.add_route("*", "/{path:.*}", self._wake_request)
+        self._runner = web.AppRunner(wake, access_log=None)
+        await self._runner.setup()
+        host, port = self.upstream.rsplit(":", 1)
+        await web.TCPSite(self._runner, host, int(port)).start()
+        self._task = asyncio.create_task(self._reap_forever())
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the idle check and the activity and wake listeners, meant to run on application shutdown
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+reaper = IdleReaper()
@@ -0,0 +1,217 @@
+"""
+Background Jobs
+"""
+
+import json
+import time
+import asyncio
+import logging
+from uuid import uuid4
+from typing import Optional as O, Dict as D, List as L, Any as A, AsyncGenerator as AG, Awaitable as W, Callable as C
+from pydantic import BaseModel, Field # pylint: disable=no-name-in-module
+from kubectl.config import env
+from kubectl.decorators import redis
+from kubectl.metrics import registry, span, start_trace
+
+JOB_SECONDS = registry.histogram("kubectl_job_duration_seconds", "Duration of background jobs", ("queue", "status"))
+
+class Stage(BaseModel): # pylint: disable=too-few-public-methods
+    """
+
+    A single step of a job
+
+    """
+    status: str = Field("running", description="running, complete or error")
+    started: float = Field(default_factory=time.time, description="Start timestamp")
+    finished: O[float] = Field(None, description="End timestamp")
+    error: O[str] = Field(None, description="Error message")
+
+class Job(BaseModel): # pylint: disable=too-few-public-methods
+    """
+
+    A queued unit of work and its progress
+
+    """
+    id: str = Field(default_factory=lambda: str(uuid4()), description="Job id")
+    params: D[str,A] = Field({}, description="Job parameters")
+    status: str = Field("queued", description="queued, running, complete or error")
+    stages: D[str,Stage] = Field({}, description="Stage progress by name")
+    result: O[D[str,A]] = Field(None, description="Job result")
+    error: O[str] = Field(None, description="Error message")
+    created: float = Field(default_factory=time.time, description="Creation timestamp")
+    updated: float = Field(default_factory=time.time, description="Last update timestamp")
+
+    @property
+    def done(self) -> bool:
+        """Whether the job finished, successfully or not"""
+        return self.status in ("complete", "error")
+
+class JobQueue:
+    """
+
+    Redis backed job queue processed by a pool of async workers
+
+    Job ids are pushed to a Redis list and job state is stored as JSON next to
+    it, every state change is also published on a per-job channel so progress
+    can be followed from any API node.
+
+    """
+    def __init__(self, name:str, workers:int=env.JOB_WORKERS, ttl:int=env.JOB_TTL):
+        self.name = name
+        self.workers = workers
+        self.ttl = ttl
+        self._handler:O[C[[Job],W[D[str,A]]]] = None
+        self._tasks:L[asyncio.Task] = []
+
+    @property
+    def queue_key(self) -> str:
+        """Redis list holding pending job ids"""
+        return f"kubectl:jobs:{self.name}:queue"
+
+    def job_key(self, id_:str) -> str:
+        """Redis key holding the job state"""
+        return f"kubectl:jobs:{self.name}:{id_}"
+
+    def channel(self, id_:str) -> str:
+        """Redis channel where job state changes are published"""
+        return f"kubectl:jobs:{self.name}:{id_}:events"
+
+    def handler(self, func:C[[Job],W[D[str,A]]]) -> C[[Job],W[D[str,A]]]:
+        """
+        Registers the coroutine that processes the jobs of this queue
+        """
+        self._handler = func
+        return func
+
+    async def save(self, job:Job) -> None:
+        """
+        Stores the job state and publishes it
+        """
+        job.updated = time.time()
+        data = job.json()
+        await redis.set(self.job_key(job.id), data, ex=self.ttl)
+        await redis.publish(self.channel(job.id), data)
+
+    async def get(self, id_:str) -> O[Job]:
+        """
+        Loads a job by id
+        """
+        data = await redis.get(self.job_key(id_))
+        return Job.parse_raw(data) if data else None
+
+    async def submit(self, params:D[str,A]) -> Job:
+        """
+        Queues a job and returns it right away
+        """
+        job = Job(params=params)
+        await self.save(job)
+        await redis.lpush(self.queue_key, job.id)
+        return job
+
+    async def stage(self, job:Job, name:str, awaitable:W[A]) -> A:
+        """
+        Runs a step of the job recording its status and timing
+        """
+        stage = job.stages[name] = Stage()
+        await self.save(job)
+        try:
+            with span(name):
+                result = await awaitable
+            stage.status = "complete"
+            return result
+        except Exception as exc:
+            stage.status = "error"
+            stage.error = str(exc)
+            raise
+        finally:
+            stage.finished = time.time()
+            await self.save(job)
+
+    async def events(self, id_:str) -> AG[str, None]:
+        """
+        Yields the serialized job state, first the current one and then every change until it finishes
+        """
+        pubsub = redis.pubsub()
+        await pubsub.subscribe(self.channel(id_))
+        try:
+            job = await self.get(id_)
+            if job is None:
+                return
+            yield job.json()
+            while not job.done:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                job = Job.parse_raw(message["data"])
+                yield message["data"]
+        finally:
+            await pubsub.unsubscribe(self.channel(id_))
+            await pubsub.close()
+
+    async def _process(self, job:Job) -> None:
+        if self._handler is None:
+            raise RuntimeError(f"No handler registered for the {self.name} queue")
+        job.status = "running"
+        await self.save(job)
+        start_trace(job.id)
+        started = time.perf_counter()
+        try:
+            job.result = await self._handler(job)
+            job.status = "complete"
+        except Exception as exc: # pylint: disable=broad-except
+            logging.exception("Job %s failed", job.id)
+            job.status = "error"
+            job.error = str(exc)
+        JOB_SECONDS.observe(time.perf_counter() - started, queue=self.name, status=job.status)
+        await self.save(job)
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                item = await redis.brpop(self.queue_key, timeout=5)
+            except Exception as exc: # pylint: disable=broad-except
+                logging.warning("Job queue %s unavailable: %s", self.name, exc)
+                await asyncio.sleep(1)
+                continue
+            if item is None:
+                continue
+            job:O[Job] = None
+            try:
+                job = await self.get(item[1])
+                if job is not None:
+                    await self._process(job)
+            except Exception as exc: # pylint: disable=broad-except
+                logging.exception("Job %s of the %s queue could not be processed", item[1], self.name)
+                if job is not None and not job.done:
+                    await self._abort(job, exc)
+
+    async def _abort(self, job:Job, exc:Exception) -> None:
+        """
+        Marks a job the worker could not process as failed, if its state can still be stored
+        """
+        job.status = "error"
+        job.error = str(exc)
+        try:
+            await self.save(job)
+        except Exception as error: # pylint: disable=broad-except
+            logging.warning("Job %s could not be marked as failed: %s", job.id, error)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts the worker pool, meant to run on application startup
+        """
+        if not env.configured("redis"):
+            logging.warning("Job queue %s disabled, set %s", self.name, ", ".join(env.missing("redis")))
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the worker pool, meant to run on application shutdown
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+deploys = JobQueue("deploys")
@@ -0,0 +1,188 @@
+"""
+Container Logs
+"""
+
+import codecs
+import asyncio
+from urllib.parse import urlencode
+from typing import Optional as O, Dict as D, List as L, Tuple as T, Union as U, Any as A, AsyncGenerator as AG
+from kubectl.config import env
+from kubectl.client import client
+
+STREAMS = {0: "stdin", 1: "stdout", 2: "stderr"}
+
+class LogError(Exception):
+    """
+    Raised when the daemon refuses to stream the logs of a container
+    """
+
+class LogFrameDecoder:
+    """
+
+    Incremental decoder for the multiplexed stdout/stderr stream of `/logs`
+
+    Every frame is an 8 byte header, holding the stream type and the big endian
+    payload size, followed by the payload. Complete frames are returned as
+    `memoryview` slices of the chunk they arrived in, only a frame split across
+    chunks is copied into a buffer until its last byte arrives.
+
+    """
+    HEADER = 8
+
+    def __init__(self):
+        self._pending = bytearray()
+
+    @staticmethod
+    def _size(header:U[bytes,bytearray,memoryview]) -> int:
+        return int.from_bytes(header[4:8], "big")
+
+    def _complete(self, view:memoryview) -> T[O[T[int,memoryview]],int]:
+        """
+        Extends the pending frame from the start of the chunk, returns it once whole
+        and the number of bytes taken from the chunk
+        """
+        taken = 0
+        if len(self._pending) < self.HEADER:
+            taken = min(self.HEADER - len(self._pending), len(view))
+            self._pending += view[:taken]
+            if len(self._pending) < self.HEADER:
+                return None, taken
+        missing = self.HEADER + self._size(self._pending) - len(self._pending)
+        step = min(missing, len(view) - taken)
+        self._pending += view[taken:taken + step]
+        taken += step
+        if step < missing:
+            return None, taken
+        # The returned view keeps the finished buffer alive, so start a new one
+        frame, self._pending = self._pending, bytearray()
+        return (frame[0], memoryview(frame)[self.HEADER:]), taken
+
+    def feed(self, chunk:bytes) -> L[T[int,memoryview]]:
+        """
+        Returns every `(stream, payload)` frame completed by the chunk
+        """
+        frames:L[T[int,memoryview]] = []
+        view = memoryview(chunk)
+        pos = 0
+        if self._pending:
+            frame, pos = self._complete(view)
+            if frame is None:
+                return frames
+            frames.append(frame)
+        end = len(view)
+        while end - pos >= self.HEADER:
+            size = self._size(view[pos:pos + self.HEADER])
+            if end - pos - self.HEADER < size:
+                break
+            frames.append((view[pos], view[pos + self.HEADER:pos + self.HEADER + size]))
+            pos += self.HEADER + size
+        if pos < end:
+            self._pending = bytearray(view[pos:])
+        return frames
+
+class LogLines:
+    """
+
+    Splits frame payloads into text lines, one UTF-8 decoder and partial line per stream
+
+    """
+    def __init__(self):
+        self._decoders:D[int,codecs.IncrementalDecoder] = {}
+        self._partial:D[int,str] = {}
+
+    def feed(self, stream:int, payload:U[bytes,memoryview]) -> L[T[str,str]]:
+        """
+        Returns every `(stream, line)` completed by the payload
+        """
+        decoder = self._decoders.get(stream)
+        if decoder is None:
+            decoder = self._decoders[stream] = codecs.getincrementaldecoder("utf-8")("replace")
+        text = self._partial.pop(stream, "") + decoder.decode(payload)
+        lines = text.split("\n")
+        if lines[-1]:
+            self._partial[stream] = lines[-1]
+        name = STREAMS.get(stream, "stdout")
+        return [(name, line.rstrip("\r")) for line in lines[:-1]]
+
+    def close(self) -> L[T[str,str]]:
+        """
+        Returns the unterminated last line of every stream
+        """
+        lines = []
+        for stream, decoder in self._decoders.items():
+            text = self._partial.pop(stream, "") + decoder.decode(b"", final=True)
+            if text:
+                lines.append((STREAMS.get(stream, "stdout"), text))
+        return lines
+
+async def container_logs(
+    host:str,
+    container:str,
+    since:O[str]=None,
+    tail:U[int,str]=env.LOG_TAIL,
+    follow:bool=True,
+    timestamps:bool=False
+) -> AG[T[str,str], None]:
+    """
+    Yields the `(stream, line)` log lines of a container, following it when asked.
+    Lines are read from the daemon only as fast as they are consumed, so a slow
+    consumer holds the socket back instead of buffering the logs in memory.
+    """
+    info = await client.fetch(f"{host}/containers/{container}/json")
+    if "Id" not in info:
+        raise LogError(info.get("message", f"No such container: {container}"))
+    tty = bool(info.get("Config", {}).get("Tty"))
+    query = {"stdout": 1, "stderr": 1, "follow": int(follow), "timestamps": int(timestamps), "tail": tail}
+    if since:
+        query["since"] = since
+    async with client.request(f"{host}/containers/{info['Id']}/logs?{urlencode(query)}") as response:
+        if response.status >= 400:
+            raise LogError((await response.text()).strip())
+        decoder = LogFrameDecoder()
+        lines = LogLines()
+        async for chunk in response.content.iter_any():
+            # TTY containers have a single raw stream, without frame headers
+            frames = [(1, memoryview(chunk))] if tty else decoder.feed(chunk)
+            for stream, payload in frames:
+                for line in lines.feed(stream, payload):
+                    yield line
+        for line in lines.close():
+            yield line
+
+async def merge_logs(
+    sources:D[str,T[str,str]],
+    buffer:int=env.LOG_BUFFER,
+    **options:A
+) -> AG[T[str,str,str], None]:
+    """
+    Yields the `(name, stream, line)` log lines of several containers, given as
+    `{name: (host, container)}`, as they arrive. Every container feeds a shared
+    bounded queue, a full queue stops the reads of every container until the
+    consumer catches up. Failures are yielded on the `error` stream.
+    """
+    queue:asyncio.Queue = asyncio.Queue(maxsize=buffer)
+    done = object()
+
+    async def pump(name:str, host:str, container:str) -> None:
+        try:
+            async for stream, line in container_logs(host, container, **options):
+                await queue.put((name, stream, line))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc: # pylint: disable=broad-except
+            await queue.put((name, "error", str(exc)))
+        await queue.put(done)
+
+    tasks = [asyncio.create_task(pump(name, host, container)) for name, (host, container) in sources.items()]
+    try:
+        running = len(tasks)
+        while running:
+            item = await queue.get()
+            if item is done:
+                running -= 1
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
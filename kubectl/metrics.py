@@ -0,0 +1,294 @@
+"""
+Metrics and Tracing
+"""
+
+import time
+from uuid import uuid4
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional as O, Dict as D, List as L, Tuple as T, Any as A, Callable as C, Iterator as I, Awaitable as W
+from kubectl.config import env
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+Sample = T[D[str,str],float]
+
+def _escape(value:str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(labels:D[str,str]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in labels.items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value:float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    """
+
+    A named family of samples, one per combination of label values
+
+    Every update checks the registry switch first, so a disabled registry
+    costs a single attribute lookup per call.
+
+    """
+    kind = "untyped"
+
+    def __init__(self, registry:"Registry", name:str, documentation:str, labelnames:T[str,...]=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values:D[T[str,...],A] = {}
+
+    def _key(self, labels:D[str,A]) -> T[str,...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> I[T[str,D[str,str],float]]:
+        """
+        Yields `(suffix, labels, value)` for every sample of the family
+        """
+        for key, value in self._values.items():
+            yield "", dict(zip(self.labelnames, key)), value
+
+class Counter(Metric):
+    """
+    Monotonic counter
+    """
+    kind = "counter"
+
+    def inc(self, amount:float=1, **labels:A) -> None:
+        """
+        Adds to the counter of the given labels
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    Value that goes up and down
+    """
+    kind = "gauge"
+
+    def set(self, value:float, **labels:A) -> None:
+        """
+        Sets the gauge of the given labels
+        """
+        if self.registry.enabled:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount:float=1, **labels:A) -> None:
+        """
+        Adds to the gauge of the given labels
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount:float=1, **labels:A) -> None:
+        """
+        Subtracts from the gauge of the given labels
+        """
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    """
+    Distribution of observed values over fixed buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, registry:"Registry", name:str, documentation:str, labelnames:T[str,...]=(), buckets:T[float,...]=BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value:float, **labels:A) -> None:
+        """
+        Records a value for the given labels
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> I[T[str,D[str,str],float]]:
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield "_bucket", {**labels, "le": _number(bound)}, cumulative
+            yield "_bucket", {**labels, "le": "+Inf"}, count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+class Registry:
+    """
+
+    Process wide metric families plus collectors evaluated at scrape time
+
+    Collectors read counters that modules keep anyway (pool stats, cache
+    counters), so those cost nothing until `/metrics` is requested.
+
+    """
+    def __init__(self, enabled:bool=env.METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics:D[str,Metric] = {}
+        self.collectors:L[C[[],L[T[str,str,str,L[Sample]]]]] = []
+
+    def _register(self, cls:type, name:str, documentation:str, labelnames:T[str,...], **kwargs:A) -> A:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(self, name, documentation, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name:str, documentation:str, labelnames:T[str,...]=()) -> Counter:
+        """Counter family, created on first use"""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name:str, documentation:str, labelnames:T[str,...]=()) -> Gauge:
+        """Gauge family, created on first use"""
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name:str, documentation:str, labelnames:T[str,...]=(), buckets:T[float,...]=BUCKETS) -> Histogram:
+        """Histogram family, created on first use"""
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def collector(self, func:C[[],L[T[str,str,str,L[Sample]]]]) -> C[[],L[T[str,str,str,L[Sample]]]]:
+        """
+        Registers a function returning `(name, kind, help, [(labels, value)])` families at scrape time
+        """
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        """
+        Every family in the Prometheus text exposition format
+        """
+        lines:L[str] = []
+        families = [(m.name, m.kind, m.documentation, [(s, l, v) for s, l, v in m.samples()]) for m in self.metrics.values()]
+        for collect in self.collectors:
+            families += [(name, kind, doc, [("", l, v) for l, v in samples]) for name, kind, doc, samples in collect()]
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {_escape(documentation)}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{suffix}{_labels(labels)} {_number(value)}" for suffix, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "kubectl_stage_duration_seconds", "Duration of pipeline stages", ("stage", "status")
+)
+SSE_SUBSCRIBERS = registry.gauge(
+    "kubectl_sse_subscribers", "Open server-sent event and WebSocket streams", ("stream",)
+)
+
+class Trace:
+    """
+
+    Spans of a single unit of work, linked by a W3C compatible trace id
+
+    """
+    def __init__(self, trace_id:O[str]=None):
+        self.id = (trace_id or uuid4().hex).replace("-", "")[:32]
+        self.started = time.time()
+        self.spans:L[D[str,A]] = []
+
+    def dict(self) -> D[str,A]:
+        """
+        Serializable trace
+        """
+        return {"id": self.id, "started": self.started, "spans": self.spans}
+
+_trace:ContextVar[O[Trace]] = ContextVar("kubectl_trace", default=None)
+_span:ContextVar[O[str]] = ContextVar("kubectl_span", default=None)
+traces:"OrderedDict[str,Trace]" = OrderedDict()
+
+def start_trace(trace_id:O[str]=None) -> O[Trace]:
+    """
+    Starts a trace in the current context when tracing is enabled, stages run
+    from this context and the tasks it creates are recorded in it
+    """
+    if not env.TRACING_ENABLED:
+        return None
+    trace = Trace(trace_id)
+    _trace.set(trace)
+    _span.set(None)
+    traces[trace.id] = trace
+    while len(traces) > env.TRACE_KEEP:
+        traces.popitem(last=False)
+    return trace
+
+def get_trace(trace_id:str) -> O[Trace]:
+    """
+    Recent trace by id
+    """
+    return traces.get(trace_id.replace("-", "")[:32])
+
+def traceparent() -> O[str]:
+    """
+    `traceparent` header value of the current span, None outside of a trace
+    """
+    trace = _trace.get()
+    if trace is None:
+        return None
+    return f"00-{trace.id}-{_span.get() or '0' * 15 + '1'}-01"
+
+@contextmanager
+def span(name:str) -> I[None]:
+    """
+    Times a stage into `kubectl_stage_duration_seconds` and, inside a trace,
+    records it as a span whose parent is the enclosing one
+    """
+    if not registry.enabled and _trace.get() is None:
+        yield
+        return
+    started = time.perf_counter()
+    trace = _trace.get()
+    span_id = uuid4().hex[:16]
+    token = _span.set(span_id) if trace is not None else None
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, stage=name, status=status)
+        if trace is not None:
+            _span.reset(token)
+            trace.spans.append({
+                "id": span_id,
+                "parent": _span.get(),
+                "name": name,
+                "status": status,
+                "start": time.time() - duration,
+                "duration": duration
+            })
+
+def subscribers(stream:str) -> C[[C[...,W[A]]],C[...,W[A]]]:
+    """
+    Counts the open event streams of a request handler in `kubectl_sse_subscribers`
+    """
+    def decorator(handler:C[...,W[A]]) -> C[...,W[A]]:
+        @wraps(handler)
+        async def wrapper(*args:A, **kwargs:A) -> A:
+            SSE_SUBSCRIBERS.inc(stream=stream)
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                SSE_SUBSCRIBERS.dec(stream=stream)
+        return wrapper
+    return decorator
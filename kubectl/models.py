@@ -3,12 +3,41 @@
 AioFauna Models
 
 """
-from typing import Optional as O
+import json
+import base64
+import binascii
+import asyncio
+import logging
+from typing import Optional as O, Dict as D, List as L, Any as A
 from datetime  import datetime
 from aiofauna import FaunaModel as Q, Field
-from aioboto3 import Session
+from aiofauna import query as q
+from kubectl.config import env
+from kubectl.decorators import redis
+from kubectl.storage import presigned_url
 
-session = Session()
+UPLOAD_LISTING_FIELDS = ["lastModified", "ref", "name", "key", "size", "type"]
+UPLOAD_PAGE_TTL = 300
+
+def _encode_cursor(after:L[A]) -> str:
+    """Opaque pagination cursor from a Fauna `after` tuple"""
+    values = [{"ref": v["@ref"]["id"]} if isinstance(v, dict) and "@ref" in v else v for v in after]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+class CursorError(ValueError):
+    """
+    Raised for a pagination cursor that was not made by `_encode_cursor`
+    """
+
+def _decode_cursor(cursor:str) -> L[A]:
+    """Fauna `after` tuple from an opaque pagination cursor, raises `CursorError` when malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list):
+            raise CursorError("Invalid cursor")
+        return [q.ref(q.collection("upload"), str(v["ref"])) if isinstance(v, dict) else v for v in values]
+    except (ValueError, binascii.Error, KeyError, TypeError) as exc:
+        raise CursorError("Invalid cursor") from exc
 
 class Upload(Q):
     """
@@ -23,7 +52,134 @@ class Upload(Q):
     type: str = Field(..., description="File type", index=True)
     lastModified: float = Field(default_factory=lambda: datetime.now().timestamp(), description="Last modified", index=True)
     url: O[str] = Field(None, description="File url")
-        
+
+    @classmethod
+    async def provision(cls) -> bool:
+        """
+        Creates the collection and field indexes plus the listing indexes, which are
+        sorted newest first and cover the summary fields so list views skip the documents
+        """
+        if not env.configured("fauna"):
+            logging.warning("Fauna provisioning skipped, set %s", ", ".join(env.missing("fauna")))
+            return False
+        provisioned = await super().provision()
+        _q = cls.q()
+        values = [{"field": ["data", "lastModified"], "reverse": True}, {"field": ["ref"]}]
+        values += [{"field": ["data", field]} for field in UPLOAD_LISTING_FIELDS[2:]]
+        for name, terms in (("upload_listing", ["user"]), ("upload_listing_type", ["user", "type"])):
+            if not await _q(q.exists(q.index(name))):
+                await _q(q.create_index({
+                    "name": name,
+                    "source": q.collection("upload"),
+                    "terms": [{"field": ["data", term]} for term in terms],
+                    "values": values
+                }))
+        return provisioned
+
+    @staticmethod
+    def pages_key(user:str) -> str:
+        """Redis hash caching the first listing pages of a user"""
+        return f"kubectl:uploads:{user}:pages"
+
+    @classmethod
+    async def invalidate(cls, user:str) -> None:
+        """
+        Drops the cached first listing pages of a user
+        """
+        if not redis.configured:
+            return
+        try:
+            await redis.delete(cls.pages_key(user))
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Dropping the cached uploads of %s failed: %s", user, exc)
+
+    @classmethod
+    async def _cached_page(cls, user:str, field:str) -> O[D[str,A]]:
+        """Cached first listing page, None when it is not cached or Redis is unavailable"""
+        if not redis.configured:
+            return None
+        try:
+            cached = await redis.hget(cls.pages_key(user), field)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Reading the cached uploads of %s failed: %s", user, exc)
+            return None
+        return json.loads(cached) if cached else None
+
+    @classmethod
+    async def _cache_page(cls, user:str, field:str, page:D[str,A]) -> None:
+        """Caches a first listing page when Redis is available"""
+        if not redis.configured:
+            return
+        key = cls.pages_key(user)
+        try:
+            await redis.hset(key, field, json.dumps(page))
+            await redis.expire(key, UPLOAD_PAGE_TTL)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Caching the uploads of %s failed: %s", user, exc)
+
+    @classmethod
+    async def page(
+        cls,
+        user:str,
+        type_:O[str]=None,
+        size:int=50,
+        after:O[str]=None,
+        summary:bool=False
+    ) -> D[str,A]:
+        """
+        Uploads of a user newest first, `size` at a time, optionally of a single type.
+        Summaries are read from the listing index alone and carry no presigned url,
+        the first page of every variant is cached until the user uploads or deletes.
+        Full documents carry a presigned url, regenerated once the cached one ages.
+        """
+        field = f"{type_ or ''}|{size}|{int(summary)}"
+        if after is None:
+            cached = await cls._cached_page(user, field)
+            if cached is not None:
+                return cached
+        if type_:
+            match = q.match(q.index("upload_listing_type"), user, type_)
+        else:
+            match = q.match(q.index("upload_listing"), user)
+        listing = q.paginate(match, size=size, after=_decode_cursor(after) if after else None)
+        if summary:
+            result = await cls.q()(listing)
+            data = [{
+                **dict(zip(UPLOAD_LISTING_FIELDS, row)),
+                "ref": row[1]["@ref"]["id"],
+                "user": user
+            } for row in result["data"]]
+        else:
+            result = await cls.q()(q.map_(q.lambda_("row", q.get(q.select(1, q.var("row")))), listing))
+            data = [
+                cls(**{**d["data"], "ref": d["ref"]["@ref"]["id"], "ts": d["ts"] / 1000}).dict()
+                for d in result["data"]
+            ]
+            urls = await asyncio.gather(*[presigned_url(d["key"]) for d in data])
+            for d, url in zip(data, urls):
+                d["url"] = url
+        page = {"data": data, "after": _encode_cursor(result["after"]) if result.get("after") else None}
+        if after is None:
+            await cls._cache_page(user, field, page)
+        return page
+
+    async def save(self) -> Q:
+        """Saves the document, dropping the cached listings of its user"""
+        saved = await super().save()
+        await self.invalidate(self.user)
+        return saved
+
+    @classmethod
+    async def delete(cls, ref:str, user:O[str]=None) -> bool:
+        """Delete a document by id, dropping the cached listings of its user"""
+        if user is None:
+            found = await cls.find(ref)
+            user = getattr(found, "user", None)
+        deleted = await super().delete(ref)
+        if user is not None:
+            await cls.invalidate(user)
+        return deleted
+
         
 class User(Q):
     """
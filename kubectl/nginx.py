@@ -0,0 +1,171 @@
+"""
+Nginx Proxy Configuration
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Optional as O, Dict as D, List as L, Tuple as T, Any as A
+from kubectl.config import env
+from kubectl.metrics import span
+
+class ProxyError(Exception):
+    """
+    Raised when nginx rejects the configuration or fails to reload
+    """
+
+class ProxyManager:
+    """
+
+    Nginx server blocks of the deployments
+
+    The template is compiled once, config files are written atomically off the
+    event loop and changes arriving within `NGINX_RELOAD_DEBOUNCE` seconds of
+    each other are applied with a single `nginx -t` plus graceful reload. When
+    the test fails, the configs of the batch are tested one at a time and only
+    the ones nginx rejects are removed, the others are still applied.
+
+    """
+    def __init__(self,
+        binary:str=env.NGINX_BIN,
+        directories:O[L[str]]=None,
+        debounce:float=env.NGINX_RELOAD_DEBOUNCE,
+        templates:str=env.TEMPLATES_DIR
+    ):
+        self.binary = binary
+        self.directories = directories if directories is not None else env.NGINX_CONF_DIRS.split(",")
+        self.debounce = debounce
+        self.templates = templates
+        self._template:A = None
+        self._pending:O[asyncio.Future] = None
+        self._batch:D[str,str] = {}
+        self._lock:O[asyncio.Lock] = None
+        self.stats:D[str,A] = {"reloads": 0, "failures": 0, "changes": 0, "last_latency": None, "total_latency": 0.0}
+
+    @property
+    def template(self) -> A:
+        """Compiled server block template, jinja2 is imported on first render"""
+        if self._template is None:
+            import jinja2 # pylint: disable=import-outside-toplevel
+            jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(self.templates))
+            self._template = jinja_env.get_template("nginx.conf")
+        return self._template
+
+    def _write_files(self, name:str, config:str) -> None:
+        for directory in self.directories:
+            tmp = os.path.join(directory, f".{name}.conf.tmp")
+            with open(tmp, "w", encoding="utf-8") as file_:
+                file_.write(config)
+            os.replace(tmp, os.path.join(directory, f"{name}.conf"))
+
+    def _remove_files(self, name:str) -> None:
+        for directory in self.directories:
+            try:
+                os.remove(os.path.join(directory, f"{name}.conf"))
+            except FileNotFoundError:
+                pass
+
+    async def _run(self, *args:str) -> str:
+        process = await asyncio.create_subprocess_exec(
+            self.binary, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        output = (stdout + stderr).decode("utf-8", "replace")
+        if process.returncode != 0:
+            raise ProxyError(output.strip() or f"{self.binary} {' '.join(args)} exited with {process.returncode}")
+        return output
+
+    async def _rejected(self, batch:D[str,str]) -> D[str,ProxyError]:
+        """
+        Configs of a batch that failed `nginx -t`, found by testing them one at a time,
+        the rejected ones are removed. When the configuration fails even without the
+        batch, every config of the batch is removed and counted as rejected
+        """
+        loop = asyncio.get_running_loop()
+        for name in batch:
+            await loop.run_in_executor(None, self._remove_files, name)
+        try:
+            await self._run("-t")
+        except ProxyError as exc:
+            return {name: exc for name in batch}
+        rejected = {}
+        for name, config in sorted(batch.items()):
+            await loop.run_in_executor(None, self._write_files, name, config)
+            try:
+                await self._run("-t")
+            except ProxyError as exc:
+                rejected[name] = exc
+                await loop.run_in_executor(None, self._remove_files, name)
+        return rejected
+
+    async def _flush(self, future:asyncio.Future) -> None:
+        await asyncio.sleep(self.debounce)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._pending is future:
+                self._pending = None
+            batch, self._batch = self._batch, {}
+            started = time.perf_counter()
+            rejected:D[str,ProxyError] = {}
+            try:
+                with span("nginx_reload"):
+                    try:
+                        await self._run("-t")
+                    except ProxyError as exc:
+                        if not batch:
+                            raise
+                        rejected = await self._rejected(batch)
+                        logging.error("Nginx rejected %s, rolled back: %s", sorted(rejected), exc)
+                    if len(rejected) < len(batch) or not batch:
+                        await self._run("-s", "reload")
+            except Exception as exc: # pylint: disable=broad-except
+                self.stats["failures"] += 1
+                logging.error("Nginx reload failed for %s: %s", sorted(batch), exc)
+                future.set_exception(exc)
+                future.exception()
+                return
+            latency = time.perf_counter() - started
+            if rejected:
+                self.stats["failures"] += 1
+            else:
+                self.stats["reloads"] += 1
+            self.stats["changes"] += len(batch) - len(rejected)
+            self.stats["last_latency"] = latency
+            self.stats["total_latency"] += latency
+            future.set_result((latency, rejected))
+
+    async def _applied(self) -> T[float,D[str,ProxyError]]:
+        if self._pending is None:
+            self._pending = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._flush(self._pending))
+        return await asyncio.shield(self._pending)
+
+    async def reload(self) -> float:
+        """
+        Schedules a debounced validation and graceful reload, returns its latency once applied
+        """
+        latency, _ = await self._applied()
+        return latency
+
+    async def apply(self, name:str, **context:A) -> float:
+        """
+        Writes the server block of a deployment and waits for the reload that applies it
+        """
+        config = self.template.render(name=name, **context)
+        await asyncio.get_running_loop().run_in_executor(None, self._write_files, name, config)
+        self._batch[name] = config
+        latency, rejected = await self._applied()
+        if name in rejected:
+            raise ProxyError(str(rejected[name]))
+        return latency
+
+    async def remove(self, name:str) -> float:
+        """
+        Removes the server block of a deployment and waits for the reload that applies it
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self._remove_files, name)
+        return await self.reload()
+
+proxy = ProxyManager()
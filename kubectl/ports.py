@@ -0,0 +1,152 @@
+"""
+Host Port Allocation
+"""
+
+import json
+import time
+import asyncio
+import logging
+from typing import Optional as O, Dict as D, Set as S, Any as A
+from kubectl.config import env, DOCKER_HOSTS
+from kubectl.client import client
+from kubectl.decorators import redis
+
+RESERVE = """
+local pos = redis.call('BITPOS', KEYS[1], 0)
+if pos < 0 or pos >= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call('SETBIT', KEYS[1], pos, 1)
+redis.call('HSET', KEYS[2], pos, ARGV[2])
+return pos
+"""
+
+RELEASE = """
+redis.call('SETBIT', KEYS[1], ARGV[1], 0)
+return redis.call('HDEL', KEYS[2], ARGV[1])
+"""
+
+class PortExhausted(Exception):
+    """
+    Raised when every port of the configured range is leased
+    """
+
+class PortAllocator:
+    """
+
+    Host ports of the deployments
+
+    A Redis bitmap holds one bit per port of the configured range, so every API
+    node shares it, and reservations run as Lua scripts so two nodes can never
+    lease the same port. Each port has a lease naming its deployment or
+    container, leases whose container is gone are reclaimed periodically.
+
+    """
+    def __init__(self,
+        start:int=env.PORT_RANGE_START,
+        end:int=env.PORT_RANGE_END,
+        grace:float=env.PORT_LEASE_GRACE,
+        interval:float=env.PORT_RECLAIM_INTERVAL,
+        namespace:str="kubectl:ports"
+    ):
+        self.start = start
+        self.end = end
+        self.grace = grace
+        self.interval = interval
+        self.bitmap_key = f"{namespace}:bitmap"
+        self.leases_key = f"{namespace}:leases"
+        self._reserve:A = None
+        self._release:A = None
+        self._task:O[asyncio.Task] = None
+
+    def _register(self) -> None:
+        # Registered on first use so importing the module needs no Redis
+        if self._reserve is None:
+            self._reserve = redis.register_script(RESERVE)
+            self._release = redis.register_script(RELEASE)
+
+    @property
+    def size(self) -> int:
+        """Number of ports in the range"""
+        return self.end - self.start + 1
+
+    async def reserve(self, owner:str) -> int:
+        """
+        Leases the first free port of the range to the given owner
+        """
+        lease = json.dumps({"owner": owner, "since": time.time()})
+        self._register()
+        offset = await self._reserve(keys=[self.bitmap_key, self.leases_key], args=[self.size, lease])
+        if int(offset) < 0:
+            raise PortExhausted(f"No free ports between {self.start} and {self.end}")
+        return self.start + int(offset)
+
+    async def bind(self, port:int, container:str) -> None:
+        """
+        Ties the lease of a port to the container that uses it
+        """
+        lease = json.dumps({"owner": container, "since": time.time()})
+        await redis.hset(self.leases_key, port - self.start, lease)
+
+    async def release(self, port:int) -> None:
+        """
+        Returns a port to the pool
+        """
+        if self.start <= port <= self.end:
+            self._register()
+            await self._release(keys=[self.bitmap_key, self.leases_key], args=[port - self.start])
+
+    async def leases(self) -> D[int,D[str,A]]:
+        """
+        Current leases by port
+        """
+        leases = await redis.hgetall(self.leases_key)
+        return {self.start + int(offset): json.loads(lease) for offset, lease in leases.items()}
+
+    async def reclaim(self) -> int:
+        """
+        Releases the ports whose container no longer exists, returns how many were released
+        """
+        hosts = await asyncio.gather(*[client.fetch(f"{host}/containers/json?all=1") for host in DOCKER_HOSTS])
+        alive:S[str] = set()
+        for container in (container for containers in hosts for container in containers):
+            alive.add(container["Id"])
+            alive.add(container["Id"][:12])
+            alive.update(name.lstrip("/") for name in container.get("Names", []))
+        now = time.time()
+        released = 0
+        for port, lease in (await self.leases()).items():
+            if lease["owner"] not in alive and now - lease["since"] > self.grace:
+                await self.release(port)
+                released += 1
+        return released
+
+    async def _reclaim_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                released = await self.reclaim()
+                if released:
+                    logging.info("Reclaimed %s ports", released)
+            except Exception as exc: # pylint: disable=broad-except
+                logging.warning("Port reclamation failed: %s", exc)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts the periodic reclamation, meant to run on application startup
+        """
+        if not env.configured("redis"):
+            logging.warning("Port reclamation disabled, set %s", ", ".join(env.missing("redis")))
+            return
+        self._task = asyncio.create_task(self._reclaim_forever())
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the periodic reclamation, meant to run on application shutdown
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+ports = PortAllocator()
@@ -0,0 +1,225 @@
+"""
+Docker Host Scheduling
+"""
+
+import asyncio
+import logging
+from typing import Optional as O, Dict as D, List as L, Set as S, Any as A
+from yarl import URL
+from kubectl.config import env, DOCKER_HOSTS, DOCKER_URL
+from kubectl.client import client
+from kubectl.decorators import redis
+
+class DockerHost:
+    """
+
+    Load of a Docker engine as sampled from its `/info` and container stats
+
+    """
+    def __init__(self, url:str):
+        self.url = url
+        self.healthy = True
+        self.cpus = 1
+        self.memory = 0
+        self.containers = 0
+        self.cpu = 0.0
+        self.memory_used = 0
+        self.pending = 0
+
+    @property
+    def address(self) -> str:
+        """Address the proxy uses to reach the published ports of the host"""
+        return URL(self.url).host or "localhost"
+
+    @property
+    def load(self) -> float:
+        """
+        CPU and memory in use as fractions of the host plus running containers,
+        ten containers per core counting as one fully used resource
+        """
+        memory = self.memory_used / self.memory if self.memory else 0.0
+        return self.cpu + memory + (self.containers + self.pending) / (10 * self.cpus)
+
+    def dict(self) -> D[str,A]:
+        """
+        Serializable snapshot of the host
+        """
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "cpus": self.cpus,
+            "memory": self.memory,
+            "containers": self.containers,
+            "cpu": self.cpu,
+            "memory_used": self.memory_used,
+            "load": self.load
+        }
+
+class Scheduler:
+    """
+
+    Places builds and containers on the least loaded Docker host
+
+    Hosts are sampled in the background, placements made between two samples
+    are counted as pending containers so bursts spread across hosts, and hosts
+    that already have the image get a `DOCKER_LOCALITY_BONUS` head start.
+    The host of every container is recorded in Redis so later calls reach the
+    right daemon.
+
+    """
+    def __init__(self,
+        urls:L[str]=DOCKER_HOSTS,
+        interval:float=env.DOCKER_SAMPLE_INTERVAL,
+        locality_bonus:float=env.DOCKER_LOCALITY_BONUS,
+        namespace:str="kubectl:containers:hosts"
+    ):
+        self.hosts:D[str,DockerHost] = {url: DockerHost(url) for url in urls}
+        self.interval = interval
+        self.locality_bonus = locality_bonus
+        self.namespace = namespace
+        self._locations:D[str,str] = {}
+        self._sampled = False
+        self._task:O[asyncio.Task] = None
+
+    async def _container_usage(self, host:DockerHost, container:str, semaphore:asyncio.Semaphore) -> D[str,float]:
+        async with semaphore:
+            stats = await client.fetch(f"{host.url}/containers/{container}/stats?stream=false")
+        cpu_delta = stats["cpu_stats"]["cpu_usage"]["total_usage"] - stats["precpu_stats"].get("cpu_usage", {}).get("total_usage", 0)
+        system_delta = stats["cpu_stats"].get("system_cpu_usage", 0) - stats["precpu_stats"].get("system_cpu_usage", 0)
+        return {
+            "cpu": cpu_delta / system_delta if system_delta > 0 else 0.0,
+            "memory": stats.get("memory_stats", {}).get("usage", 0)
+        }
+
+    async def sample(self, host:DockerHost) -> None:
+        """
+        Refreshes the capacity and usage of a host
+        """
+        try:
+            info = await client.fetch(f"{host.url}/info")
+            containers = await client.fetch(f"{host.url}/containers/json")
+            semaphore = asyncio.Semaphore(8)
+            usage = await asyncio.gather(*[self._container_usage(host, c["Id"], semaphore) for c in containers])
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Docker host %s unavailable: %s", host.url, exc)
+            host.healthy = False
+            return
+        host.healthy = True
+        host.cpus = info.get("NCPU") or 1
+        host.memory = info.get("MemTotal") or 0
+        host.containers = info.get("ContainersRunning", len(containers))
+        host.cpu = sum(u["cpu"] for u in usage)
+        host.memory_used = int(sum(u["memory"] for u in usage))
+        host.pending = 0
+
+    async def sample_all(self) -> None:
+        """
+        Refreshes every host concurrently
+        """
+        await asyncio.gather(*[self.sample(host) for host in self.hosts.values()])
+        self._sampled = True
+
+    async def has_image(self, url:str, image:str) -> bool:
+        """
+        Whether the given host already has the image
+        """
+        try:
+            async with client.request(f"{url}/images/{image}/json") as response:
+                return response.status == 200
+        except Exception: # pylint: disable=broad-except
+            return False
+
+    async def place(self, image:O[str]=None, prefer:O[S[str]]=None) -> str:
+        """
+        Picks the host for a new build or container, favouring the hosts in `prefer`
+        and, when an image is given, the hosts that already have it
+        """
+        if not self._sampled:
+            await self.sample_all()
+        candidates = [host for host in self.hosts.values() if host.healthy] or list(self.hosts.values())
+        local = set(prefer or ())
+        if image is not None:
+            found = await asyncio.gather(*[self.has_image(host.url, image) for host in candidates])
+            local.update(host.url for host, has in zip(candidates, found) if has)
+        host = min(candidates, key=lambda h: h.load - (self.locality_bonus if h.url in local else 0.0))
+        host.pending += 1
+        return host.url
+
+    def address(self, url:str) -> str:
+        """
+        Address the proxy uses to reach the given host
+        """
+        host = self.hosts.get(url)
+        return host.address if host else URL(url).host or "localhost"
+
+    async def assign(self, container:str, url:str) -> None:
+        """
+        Records the host a container lives on
+        """
+        self._locations[container] = url
+        if not redis.configured:
+            return
+        try:
+            await redis.hset(self.namespace, container, url)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Recording the host of %s failed: %s", container, exc)
+
+    async def _recorded(self, container:str) -> O[str]:
+        """Host recorded by any node, None when Redis is unavailable"""
+        if not redis.configured:
+            return None
+        try:
+            return await redis.hget(self.namespace, container)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Reading the host of %s failed: %s", container, exc)
+            return None
+
+    async def locate(self, container:str) -> str:
+        """
+        Host of the given container, probing every host when it is not recorded
+        """
+        url = self._locations.get(container) or await self._recorded(container)
+        if url:
+            self._locations[container] = url
+            return url
+        for candidate in self.hosts:
+            try:
+                async with client.request(f"{candidate}/containers/{container}/json") as response:
+                    found = response.status == 200
+            except Exception: # pylint: disable=broad-except
+                continue
+            if found:
+                await self.assign(container, candidate)
+                return candidate
+        return DOCKER_URL
+
+    async def forget(self, *refs:str) -> None:
+        """
+        Drops the recorded host of a removed container, by id and names
+        """
+        for ref in refs:
+            self._locations.pop(ref, None)
+        if refs and redis.configured:
+            await redis.hdel(self.namespace, *refs)
+
+    async def _sample_forever(self) -> None:
+        while True:
+            await self.sample_all()
+            await asyncio.sleep(self.interval)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts the periodic sampling, meant to run on application startup
+        """
+        self._task = asyncio.create_task(self._sample_forever())
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops the periodic sampling, meant to run on application shutdown
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+scheduler = Scheduler()
@@ -0,0 +1,62 @@
+"""
+Service Registry
+"""
+
+from typing import Optional as O, Dict as D, Any as A, Callable as C
+from kubectl.config import env
+
+class Service:
+    """
+
+    Shared client created on first use
+
+    Attribute access is forwarded to the client, which the factory builds the
+    first time it is needed, after checking the settings of its subsystem.
+    Importing a module that holds a service creates nothing and needs no
+    settings, a missing setting fails the calls of that subsystem only. The
+    service's own methods are named so they never hide a client method, so
+    `redis.get` is the Redis client's `get`.
+
+    """
+    def __init__(self, name:str, factory:C[[],A], subsystem:O[str]=None):
+        self.name = name
+        self.factory = factory
+        self.subsystem = subsystem
+        self._instance:A = None
+
+    @property
+    def created(self) -> bool:
+        """Whether the client was built already"""
+        return self._instance is not None
+
+    @property
+    def configured(self) -> bool:
+        """Whether the settings of the subsystem are set"""
+        return self.subsystem is None or env.configured(self.subsystem)
+
+    def instance(self) -> A:
+        """
+        Returns the client, building it on first use
+        """
+        if self._instance is None:
+            if self.subsystem is not None:
+                env.require(self.subsystem)
+            self._instance = self.factory()
+        return self._instance
+
+    def __getattr__(self, name:str) -> A:
+        return getattr(self.instance(), name)
+
+    def __repr__(self) -> str:
+        return f"<Service {self.name} {'created' if self.created else 'pending'}>"
+
+services:D[str,Service] = {}
+
+def service(name:str, subsystem:O[str]=None) -> C[[C[[],A]],Service]:
+    """
+    Registers a client factory as a lazily created service
+    """
+    def decorator(factory:C[[],A]) -> Service:
+        instance = services[name] = Service(name, factory, subsystem)
+        return instance
+    return decorator
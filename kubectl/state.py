@@ -0,0 +1,220 @@
+"""
+Container State
+"""
+
+import re
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from urllib.parse import quote
+from typing import Optional as O, Dict as D, List as L, Set as S, Any as A, AsyncGenerator as AG
+from kubectl.config import env, DOCKER_HOSTS
+from kubectl.client import client
+from kubectl.scheduler import scheduler
+
+DEPLOYMENT_LABEL = "kubectl.deployment"
+
+STATES = {
+    "start": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+    "kill": "exited",
+    "oom": "exited"
+}
+
+def _timestamp(value:str) -> float:
+    """
+    Unix time of an RFC 3339 daemon timestamp, nanoseconds included
+    """
+    match = re.match(r"^([^.]+?)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)$", value)
+    if match is None:
+        raise ValueError(f"Invalid timestamp {value}")
+    base, fraction, zone = match.groups()
+    seconds = datetime.fromisoformat(base + ("+00:00" if zone == "Z" else zone)).timestamp()
+    return seconds + float(f"0.{fraction or 0}")
+
+class ContainerStore:
+    """
+
+    In-memory state of the containers of every Docker host
+
+    Each host is listed once and then followed through a single long lived
+    `/events` subscription, so reads never reach the daemon. The subscription
+    starts at the daemon time taken before the list, so no change made while
+    listing is missed. Subscribers get
+    every change through a bounded queue; a subscriber that falls behind gets a
+    `resync` marker instead of the changes it missed.
+
+    """
+    def __init__(self, hosts:L[str]=DOCKER_HOSTS, buffer:int=env.CONTAINER_WATCH_BUFFER):
+        self.hosts = hosts
+        self.buffer = buffer
+        self.containers:D[str,D[str,A]] = {}
+        self.seeded:S[str] = set()
+        self._subscribers:S[asyncio.Queue] = set()
+        self._tasks:L[asyncio.Task] = []
+
+    @staticmethod
+    def _summary(container:D[str,A], host:str) -> D[str,A]:
+        return {
+            "Id": container["Id"],
+            "Names": [name.lstrip("/") for name in container.get("Names", [])],
+            "Image": container.get("Image"),
+            "State": container.get("State"),
+            "Status": container.get("Status"),
+            "Labels": container.get("Labels") or {},
+            "Ports": container.get("Ports", []),
+            "Created": container.get("Created"),
+            "Host": host
+        }
+
+    def _publish(self, action:str, container:D[str,A]) -> None:
+        change = {"action": action, "container": container}
+        for queue in self._subscribers:
+            if queue.full():
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"action": "resync"})
+            else:
+                queue.put_nowait(change)
+
+    async def seed(self, host:str) -> None:
+        """
+        Replaces the state of a host with a fresh container list
+        """
+        containers = await client.fetch(f"{host}/containers/json?all=1")
+        for id_ in [id_ for id_, c in self.containers.items() if c["Host"] == host]:
+            del self.containers[id_]
+        for container in containers:
+            self.containers[container["Id"]] = self._summary(container, host)
+        self.seeded.add(host)
+        for queue in self._subscribers:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({"action": "resync"})
+
+    async def _created(self, host:str, id_:str) -> O[D[str,A]]:
+        filters = quote(json.dumps({"id": [id_]}))
+        containers = await client.fetch(f"{host}/containers/json?all=1&filters={filters}")
+        if not containers:
+            return None
+        container = self.containers[id_] = self._summary(containers[0], host)
+        return container
+
+    async def apply(self, host:str, event:D[str,A]) -> None:
+        """
+        Applies a daemon container event to the state
+        """
+        action = (event.get("Action") or event.get("status") or "").split(":")[0]
+        id_ = event.get("Actor", {}).get("ID") or event.get("id")
+        if not id_:
+            return
+        if action == "destroy":
+            container = self.containers.pop(id_, None)
+            if container is not None:
+                self._publish(action, container)
+            await self._forget(id_, *(container["Names"] if container else []))
+            return
+        container = self.containers.get(id_)
+        if action == "create" or container is None:
+            container = await self._created(host, id_)
+            if container is None:
+                return
+        elif action in STATES:
+            container["State"] = STATES[action]
+        elif action == "rename":
+            container["Names"] = [event["Actor"].get("Attributes", {}).get("name", "")]
+        else:
+            return
+        self._publish(action, container)
+
+    @staticmethod
+    async def _forget(*refs:str) -> None:
+        try:
+            await scheduler.forget(*refs)
+        except Exception as exc: # pylint: disable=broad-except
+            logging.warning("Dropping the host of %s failed: %s", refs[0], exc)
+
+    @staticmethod
+    async def _clock(host:str) -> float:
+        """
+        Current daemon time, the local time when the daemon does not report it
+        """
+        info = await client.fetch(f"{host}/info")
+        system_time = info.get("SystemTime") if isinstance(info, dict) else None
+        return _timestamp(system_time) if system_time else time.time()
+
+    async def _watch(self, host:str) -> None:
+        filters = quote(json.dumps({"type": ["container"]}))
+        delay = 1.0
+        while True:
+            try:
+                since = await self._clock(host)
+                await self.seed(host)
+                delay = 1.0
+                async for event in client.ndjson(f"{host}/events?since={since:.9f}&filters={filters}"):
+                    await self.apply(host, event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc: # pylint: disable=broad-except
+                self.seeded.discard(host)
+                logging.warning("Docker events of %s interrupted: %s", host, exc)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    @property
+    def synced(self) -> bool:
+        """Whether every host is listed and followed, so missing containers are really gone"""
+        return self.seeded.issuperset(self.hosts)
+
+    def list(self, deployments:bool=True) -> L[D[str,A]]:
+        """
+        Known containers, only the deployed ones by default
+        """
+        return [c for c in self.containers.values() if not deployments or DEPLOYMENT_LABEL in c["Labels"]]
+
+    def get(self, ref:str) -> O[D[str,A]]:
+        """
+        Container by id, short id or name, None when a short id matches several
+        """
+        container = self.containers.get(ref)
+        if container is not None:
+            return container
+        for container in self.containers.values():
+            if ref in container["Names"]:
+                return container
+        found = [c for c in self.containers.values() if c["Id"].startswith(ref)]
+        return found[0] if len(found) == 1 else None
+
+    async def watch(self) -> AG[D[str,A], None]:
+        """
+        Yields every container change until the subscriber goes away
+        """
+        queue:asyncio.Queue = asyncio.Queue(maxsize=self.buffer)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers.discard(queue)
+
+    async def startup(self, *_:A) -> None:
+        """
+        Starts following every host, meant to run on application startup
+        """
+        self._tasks = [asyncio.create_task(self._watch(host)) for host in self.hosts]
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Stops following the hosts, meant to run on application shutdown
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+containers = ContainerStore()
@@ -0,0 +1,116 @@
+"""
+Object Storage
+"""
+
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from typing import Optional as O, Dict as D, List as L, Any as A
+from kubectl.config import env
+from kubectl.decorators import cache
+
+class S3Manager:
+    """
+
+    Application scoped S3 client
+
+    Building a botocore client resolves endpoints, loads the service model and
+    creates a connection pool, so a single client is opened on startup and shared
+    by every S3 operation. aioboto3 itself is imported with the first client,
+    which keeps it out of the import of the application.
+
+    """
+    def __init__(self, max_pool_connections:int=env.S3_MAX_POOL_CONNECTIONS):
+        self.max_pool_connections = max_pool_connections
+        self._stack:O[AsyncExitStack] = None
+        self._client:A = None
+        self._lock:O[asyncio.Lock] = None
+
+    async def startup(self, *_:A) -> None:
+        """
+        Opens the shared S3 client, meant to run on application startup
+        """
+        if not env.configured("storage"):
+            logging.warning("Object storage disabled, set %s", ", ".join(env.missing("storage")))
+            return
+        await self.client()
+
+    async def cleanup(self, *_:A) -> None:
+        """
+        Closes the shared S3 client, meant to run on application shutdown
+        """
+        if self._stack is not None:
+            await self._stack.aclose()
+        self._stack = None
+        self._client = None
+
+    async def client(self) -> A:
+        """
+        Returns the shared S3 client, opening it on first use
+        """
+        if self._client is not None:
+            return self._client
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._client is None:
+                env.require("storage")
+                import botocore.config # pylint: disable=import-outside-toplevel
+                from aioboto3 import Session # pylint: disable=import-outside-toplevel
+                stack = AsyncExitStack()
+                self._client = await stack.enter_async_context(Session().client(
+                    service_name="s3",
+                    aws_access_key_id=env.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=env.AWS_SECRET_ACCESS_KEY,
+                    endpoint_url=env.AWS_S3_ENDPOINT,
+                    config=botocore.config.Config( # type: ignore
+                        signature_version="s3v4",
+                        max_pool_connections=self.max_pool_connections
+                    )
+                ))
+                self._stack = stack
+        return self._client
+
+    async def presign(self, key:str, expires:int=env.PRESIGN_EXPIRES) -> str:
+        """
+        Presigned GET url for the given key
+        """
+        s3client = await self.client()
+        return await s3client.generate_presigned_url("get_object", Params={"Bucket": env.AWS_S3_BUCKET, "Key": key}, ExpiresIn=expires)
+
+    async def get(self, key:str, range_:O[str]=None) -> D[str,A]:
+        """
+        Object stored under the given key, its `Body` is a stream the caller must close
+        """
+        s3client = await self.client()
+        if range_ is None:
+            return await s3client.get_object(Bucket=env.AWS_S3_BUCKET, Key=key)
+        return await s3client.get_object(Bucket=env.AWS_S3_BUCKET, Key=key, Range=range_)
+
+    async def delete(self, key:str) -> None:
+        """
+        Deletes the object stored under the given key
+        """
+        s3client = await self.client()
+        await s3client.delete_object(Bucket=env.AWS_S3_BUCKET, Key=key)
+
+    async def list(self, prefix:str="") -> L[D[str,A]]:
+        """
+        Lists every object under the given prefix
+        """
+        s3client = await self.client()
+        objects = []
+        paginator = s3client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=env.AWS_S3_BUCKET, Prefix=prefix):
+            objects.extend(page.get("Contents", []))
+        return objects
+
+storage = S3Manager()
+
+@cache(ttl=env.PRESIGN_CACHE_TTL)
+async def presigned_url(key:str) -> str:
+    """
+    Presigned GET url for the given key, signed for `PRESIGN_EXPIRES` seconds and
+    reused for `PRESIGN_CACHE_TTL` so a returned url stays valid for the difference
+    """
+    return await storage.presign(key, env.PRESIGN_EXPIRES)
@@ -1,47 +1,135 @@
 """Utility functions for the API."""
 import os
-import socket
+import json
+from fnmatch import fnmatch
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from secrets import token_urlsafe
 from datetime import datetime
 from random import randint, choice
 
-def get_dir_size(path="."):
-    """Get the size of a directory in bytes."""
+IGNORE = (".git", "node_modules", "__pycache__", ".venv", "venv", ".mypy_cache", ".pytest_cache", "*.pyc")
+SNIFF_BYTES = 1024
+MAX_FILE_BYTES = 64 * 1024
+MAX_TREE_BYTES = 8 * 1024 * 1024
+PARALLEL_THRESHOLD = 8
+
+def is_ignored(name, ignore=IGNORE):
+    """Whether a file or directory name matches any of the ignore patterns."""
+    return any(fnmatch(name, pattern) for pattern in ignore)
+
+def scan_dir(path, ignore=IGNORE):
+    """List a directory once, returning its files as (entry, size) and its subdirectories."""
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it_:
+            for entry in it_:
+                if is_ignored(entry.name, ignore):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry, entry.stat(follow_symlinks=False).st_size))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, dirs
+
+def _map(pool, func, items):
+    """Fan out to the pool only when a level is wide enough to pay for it."""
+    if pool is None or len(items) < PARALLEL_THRESHOLD:
+        return list(map(func, items))
+    return list(pool.map(func, items))
+
+def get_dir_size(path=".", ignore=(), workers=None):
+    """Get the size of a directory in bytes, walking it level by level."""
     total = 0
-    with os.scandir(path) as it_:
-        for entry in it_:
-            if entry.is_file():
-                total += entry.stat().st_size
-            elif entry.is_dir():
-                total += get_dir_size(entry.path)
+    scan = partial(scan_dir, ignore=ignore)
+    with ThreadPoolExecutor(workers) as pool:
+        level = [path]
+        while level:
+            next_level = []
+            for files, dirs in _map(pool, scan, level):
+                total += sum(size for _, size in files)
+                next_level.extend(entry.path for entry in dirs)
+            level = next_level
     return total
 
-def build_file_tree(root_dir):
-    """Build a file tree from a given directory."""
-    file_tree = {
-        "name": os.path.basename(root_dir),
-        "type": "directory",
-        "children": [],
-    }
-
-    for file_name in os.listdir(root_dir):
-        file_path = os.path.join(root_dir, file_name)
+def read_content(path, limit=MAX_FILE_BYTES):
+    """Read at most `limit` bytes of a text file, None for binary files."""
+    try:
+        with open(path, "rb") as file_:
+            head = file_.read(min(limit, SNIFF_BYTES))
+            if b"\0" in head:
+                return None
+            data = head + file_.read(max(limit - len(head), 0))
+    except OSError:
+        return None
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError as exc:
+        # A multibyte character cut by the limit is not a binary file
+        if exc.start >= len(data) - 3 and exc.reason == "unexpected end of data":
+            return data[:exc.start].decode("utf-8")
+        return None
 
-        if os.path.isdir(file_path):
-            file_tree["children"].append(build_file_tree(file_path))
-        else:
-            try:
-                with open(file_path, "r","utf-8") as file_:
-                    file_content = file_.read()
-            except:
-                file_content = "[BINARY]"
+def walk_file_tree(
+    root_dir,
+    ignore=IGNORE,
+    max_file_bytes=MAX_FILE_BYTES,
+    max_total_bytes=MAX_TREE_BYTES,
+    workers=None
+):
+    """Yield the nodes of a file tree depth first, each directory before its children."""
+    budget = max_total_bytes
+    with ThreadPoolExecutor(workers) as pool:
+        stack = [(root_dir, "")]
+        while stack:
+            path, rel = stack.pop()
+            yield {"path": rel, "name": os.path.basename(path), "type": "directory"}
+            files, dirs = scan_dir(path, ignore)
+            files.sort(key=lambda file_: file_[0].name)
+            dirs.sort(key=lambda entry: entry.name)
+            grants = []
+            for entry, size in files:
+                grant = min(size, max_file_bytes, budget)
+                budget -= grant
+                grants.append(grant)
+            reads = [(entry.path, grant) for (entry, _), grant in zip(files, grants)]
+            contents = _map(pool, lambda read: read_content(*read), reads)
+            for (entry, size), grant, content in zip(files, grants, contents):
+                yield {
+                    "path": os.path.join(rel, entry.name),
+                    "name": entry.name,
+                    "type": "file",
+                    "size": size,
+                    "content": "[BINARY]" if content is None else content,
+                    "truncated": content is not None and grant < size
+                }
+            stack.extend((entry.path, os.path.join(rel, entry.name)) for entry in reversed(dirs))
 
-            file_tree["children"].append(
-                {"name": file_name, "type": "file", "content": file_content}
-            )
+def file_tree_ndjson(root_dir, **kwargs):
+    """Yield a file tree as newline delimited JSON, one node per line."""
+    for node in walk_file_tree(root_dir, **kwargs):
+        yield json.dumps(node) + "\n"
 
-    return file_tree
+def build_file_tree(root_dir, **kwargs):
+    """Build a file tree from a given directory."""
+    nodes = {}
+    root = None
+    for node in walk_file_tree(root_dir, **kwargs):
+        path = node.pop("path")
+        if node["type"] == "directory":
+            node["children"] = []
+            nodes[path] = node
+        if root is None:
+            root = node
+        else:
+            nodes[os.path.dirname(path)]["children"].append(node)
+    return root
 
 def gen_oid():
     """Generate a unique object id."""
@@ -66,13 +154,4 @@ def gen_password():
 
 def gen_secret():
     """Generate a random secret."""
-    return token_urlsafe(32)
-
-def gen_port():
-    """Generate a random port."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(("", 0))
-    s.listen(1)
-    port = s.getsockname()[1]
-    s.close()
-    return port
\ No newline at end of file
+    return token_urlsafe(32)
\ No newline at end of file
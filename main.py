@@ -1,31 +1,125 @@
 """Application endpoints"""
-import os
 import re
 from uuid import uuid4
-import jinja2
 from dotenv import load_dotenv
-from aiofauna import Api
-from kubectl.config import env
+from aiohttp import web
+from aiofauna import Api, json_response
+from kubectl.config import ConfigError
 from kubectl.client import client
-from kubectl.models import User, Upload
-from kubectl.utils import gen_port
+from kubectl.storage import storage
+from kubectl.content import content, describe_upload
+from kubectl.models import Upload, CursorError
+from kubectl.jobs import deploys
+from kubectl.ports import ports
+from kubectl.scheduler import scheduler
+from kubectl.state import containers
+from kubectl.dns import dns
+from kubectl.github import github
+from kubectl.nginx import proxy
+from kubectl.decorators import cache_stats
+from kubectl.metrics import registry, get_trace
+from kubectl.auth import auth, AuthError
+from kubectl.helpers import ssh_keys
+from kubectl.idle import reaper
 from kubectl.handlers import (
     upload_handler,
+    upload_content,
     DOCKER_URL,
     GITHUB_URL,
     GITHUB_HEADERS,
     CLOUDFLARE_URL,
-    CLOUDFLARE_HEADERS,
     docker_pull,
+    docker_build,
     get_latest_commit_sha,
     docker_build_from_github_tarball,
     create_dns_record,
-    docker_start
+    docker_start,
+    deploy_events,
+    deployment_events,
+    container_logs_stream,
 )  # pylint: disable=unused-import, line-too-long
 
 load_dotenv()
 
-app = Api()
+
+@web.middleware
+async def config_errors(request, handler):
+    """Answers 503 for endpoints of a subsystem whose settings are missing"""
+    try:
+        return await handler(request)
+    except ConfigError as exc:
+        return json_response({"message": str(exc), "status": "error"}, status=503)
+
+
+app = Api(middlewares=[config_errors])
+
+#### Lifecycle ####
+
+
+@app.on_event("startup")
+async def startup(_app):
+    """Open long lived upstream connections"""
+    await client.startup()
+    await Upload.provision()
+    await auth.startup()
+    await storage.startup()
+    await content.startup()
+    await deploys.startup()
+    await ports.startup()
+    await scheduler.startup()
+    await containers.startup()
+    await dns.startup()
+    await reaper.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown(_app):
+    """Close long lived upstream connections"""
+    await reaper.cleanup()
+    await deploys.cleanup()
+    await ports.cleanup()
+    await scheduler.cleanup()
+    await dns.cleanup()
+    await containers.cleanup()
+    await ssh_keys.cleanup()
+    await auth.cleanup()
+    await content.cleanup()
+    await client.cleanup()
+    await storage.cleanup()
+
+#### Metrics ####
+
+
+@registry.collector
+def collect_pools():
+    """Connection reuse, cache, key pool, proxy, DNS and content cache counters kept by the services"""
+    upstreams = client.stats()
+    caches = cache_stats()
+    return [
+        ("kubectl_http_connections_total", "counter", "Upstream connections opened",
+            [({"host": host}, c["connections"]) for host, c in upstreams.items()]),
+        ("kubectl_http_reused_connections_total", "counter", "Upstream requests sent on a pooled connection",
+            [({"host": host}, c["reused"]) for host, c in upstreams.items()]),
+        ("kubectl_cache_requests_total", "counter", "Cached function calls by outcome",
+            [({"cache": name, "outcome": outcome}, c[outcome]) for name, c in caches.items()
+                for outcome in ("local_hits", "remote_hits", "misses", "coalesced", "errors")]),
+        ("kubectl_ssh_key_pool_depth", "gauge", "Pre-generated SSH key pairs ready",
+            [({"algorithm": algorithm}, s["depth"]) for algorithm, s in ssh_keys.stats().items()]),
+        ("kubectl_nginx_reloads_total", "counter", "Nginx reloads by outcome",
+            [({"status": "ok"}, proxy.stats["reloads"]), ({"status": "error"}, proxy.stats["failures"])]),
+        ("kubectl_dns_operations_total", "counter", "Cloudflare DNS calls and record changes",
+            [({"operation": name}, value) for name, value in dns.stats.items()]),
+        ("kubectl_content_cache_operations_total", "counter", "Upload downloads and local content cache changes",
+            [({"operation": name}, value) for name, value in content.stats.items()]),
+        ("kubectl_content_cache_bytes", "gauge", "Bytes kept in the local content cache",
+            [({}, content.size)]),
+    ]
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return registry.render()
 
 #### Healthcheck Endpoint ####
 
@@ -41,11 +135,11 @@ async def healthcheck():
 
 @app.get("/api/auth")
 async def authorize(token: str):
-    """Authorization Endpoint"""
-    headers = {"Authorization": f"Bearer {token}"}
-    url = f"https://{env.AUTH0_DOMAIN}/userinfo"
-    user_dict = await client.fetch(url, headers=headers)
-    return await User(**user_dict).save()
+    """Authorization Endpoint, verifies the token locally against the Auth0 JWKS"""
+    try:
+        return await auth.authorize(token)
+    except AuthError as exc:
+        return json_response({"message": str(exc), "status": "error"}, status=401)
 
 
 #### Bucket obj Endpoints ####
@@ -54,16 +148,33 @@ async def authorize(token: str):
 @app.delete("/api/upload")
 async def delete_upload(ref: str):
     """Delete an uploaded file given it's document reference"""
-    await Upload.delete(ref)
+    upload = await Upload.find(ref)
+    if isinstance(upload, Upload):
+        await storage.delete(upload.key)
+        await Upload.delete(ref, user=upload.user)
+        await describe_upload.invalidate(ref)
+        content.discard(upload.dict())
+    else:
+        await Upload.delete(ref)
     return {"message": "Asset deleted successfully", "status": "success"}
 
 
 @app.get("/api/upload")
-async def get_upload(user: str):
-    """Fetch Uploaded files for a given user"""
-    return await Upload.find_many("user", user)
+async def get_upload(
+    user: str, type: str = None, size: int = 50, after: str = None, fields: str = "full"
+):  # pylint: disable=redefined-builtin
+    """Fetch Uploaded files for a given user, newest first, one page at a time.
+    Pass the returned `after` cursor to get the next page and `fields=summary` to
+    skip the documents and their presigned urls"""
+    try:
+        return await Upload.page(
+            user, type or None, max(1, min(size, 200)), after or None, fields == "summary"
+        )
+    except CursorError as exc:
+        return json_response({"message": str(exc), "status": "error"}, status=400)
 
 app.router.add_post("/api/upload", upload_handler)  # type: ignore
+app.router.add_get("/api/upload/{ref}/content", upload_content)  # type: ignore
 app.openapi["paths"].setdefault(
     "/api/upload",
     {
@@ -77,10 +188,10 @@ app.openapi["paths"].setdefault(
                     "schema": {"type": "string"},
                 },
                 {
-                    "name": "size",
+                    "name": "user",
                     "in": "query",
                     "required": True,
-                    "schema": {"type": "integer"},
+                    "schema": {"type": "string"},
                 },
             ],
             "requestBody": {
@@ -103,52 +214,75 @@ app.openapi["paths"].setdefault(
 ##### Pipeline Endpoints #####
 
 app.router.add_get("/api/docker/pull", docker_pull)  # type: ignore
+app.router.add_get("/api/docker/build", docker_build)  # type: ignore
+
+
+@app.get("/api/docker/hosts")
+async def docker_hosts():
+    """Sampled load of every Docker host"""
+    return {"hosts": [host.dict() for host in scheduler.hosts.values()]}
+
+
+@app.get("/api/github/quota")
+async def github_quota():
+    """GitHub API rate limit state"""
+    return github.quota()
+
+
+@app.get("/api/ssh/stats")
+async def ssh_key_stats():
+    """SSH key pool depth and generation latency"""
+    return ssh_keys.stats()
+
 
 @app.post("/api/github/deploy/{owner}/{repo}")
 async def deploy_from_repo_endpoint(
     owner:str, repo:str, port: int = 8080, env_vars: str = "DOCKER=1"
 ):
+    """Queues a deploy of the latest commit of a GitHub repository"""
     name = f"{owner}-{repo}-{str(uuid4())[:8]}"
-    image = await docker_build_from_github_tarball(owner, repo)
-    if "error" in image:
-        return image
-    host_port = str(gen_port())
-    payload = {
-        "Image": image,
-        "Env": env_vars.split(","),
-        "ExposedPorts": {f"{str(port)}/tcp": {"HostPort": host_port}},
-        "HostConfig": {"PortBindings": {f"{str(port)}/tcp": [{"HostPort": host_port}]}},
-    }
-    container = await client.fetch(
-        f"{DOCKER_URL}/containers/create?name={name}",
-        "POST",
-        headers={"Content-Type": "application/json"},
-        data=payload,
+    job = await deploys.submit(
+        {"owner": owner, "repo": repo, "name": name, "port": port, "env_vars": env_vars}
     )
-    try:
-        _id = container["Id"]
-        await docker_start(_id)
-        res = await create_dns_record(name)
-        jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"))
-        template = jinja_env.get_template("nginx.conf")
-        nginx_config = template.render(
-            name=name, port=port
-        )
-        for path in ["/etc/nginx/conf.d", "/etc/nginx/sites-enabled", "/etc/nginx/sites-available"]:
-            with open(f"{path}/{name}.conf", "w", encoding="utf-8") as file_:
-                file_.write(nginx_config)
-        os.system("nginx -t")
-        os.system("nginx -s reload")
-        os.system("systemctl restart nginx")
-        os.system("systemctl enable nginx")
-        os.system("systemctl status nginx")
-        data = await client.fetch(f"{DOCKER_URL}/containers/{_id}/json")
-        return {
-            "url": f"{name}.smartpro.solutions",
-            "port": host_port,
-            "container": data,
-            "dns": res,
-        }
-    except Exception as e:
-        print(e)
-        return container
\ No newline at end of file
+    return {"job": job.id, "status": job.status}
+
+
+@app.get("/api/deploys/{job}")
+async def get_deploy(job: str):
+    """Deploy job status, stages and result"""
+    found = await deploys.get(job)
+    if found is None:
+        return {"message": "Job not found", "status": "error"}
+    return found
+
+
+app.router.add_get("/api/deploys/{job}/events", deploy_events)  # type: ignore
+
+
+@app.get("/api/deploys/{job}/trace")
+async def get_deploy_trace(job: str):
+    """Spans of a recent deploy, recorded when tracing is enabled"""
+    trace = get_trace(job)
+    if trace is None:
+        return {"message": "Trace not found", "status": "error"}
+    return trace.dict()
+
+
+app.router.add_get("/api/deployments/events", deployment_events)  # type: ignore
+app.router.add_get("/api/deployments/{ref}/logs", container_logs_stream)  # type: ignore
+app.router.add_get("/api/logs", container_logs_stream)  # type: ignore
+
+
+@app.get("/api/deployments")
+async def list_deployments():
+    """Deployed containers, served from the container state store"""
+    return {"deployments": containers.list()}
+
+
+@app.get("/api/deployments/{ref}")
+async def get_deployment(ref: str):
+    """Deployed container by id or name, served from the container state store"""
+    container = containers.get(ref)
+    if container is None:
+        return {"message": "Deployment not found", "status": "error"}
+    return container